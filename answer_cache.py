@@ -0,0 +1,188 @@
+# answer_cache.py
+# Семантический кэш ответов на первые вопросы о товарах ("чай для похудения",
+# "шампунь от выпадения" — самые частые запросы после /start).
+# Кэшируются только ответы на первое сообщение без истории диалога: тогда ответ
+# зависит лишь от запроса и каталога. Поиск — по косинусной близости эмбеддинга
+# запроса (тот же, что нужен векторному поиску, берётся из кэша эмбеддингов).
+# Запись сбрасывается, если изменился любой из товаров, на которых построен ответ:
+# сразу — по событию обновления снимка каталога, и при выдаче — сверкой с актуальными
+# карточками (снимок каталога или RPC, но не TTL-кэш карточек, который может отставать).
+
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional
+
+import numpy as np
+
+import db
+from cache import normalize_query_text
+
+logger = logging.getLogger(__name__)
+
+_NUMBER = re.compile(r"\d+")
+
+
+class CachedAnswer(NamedTuple):
+    query: str            # нормализованный текст запроса
+    answer: str           # готовый HTML ответа
+    product_ids: tuple    # товары из контекста ответа (в порядке выдачи)
+    sources: tuple        # _source каждого товара (для сессии)
+    fingerprints: tuple   # отпечатки карточек на момент ответа
+    stored_at: float
+
+
+def product_fingerprint(product: dict) -> int:
+    """Отпечаток полей карточки, влияющих на ответ (процесс-локальный hash — кэш живёт в памяти)."""
+    return hash((product.get("name"), product.get("price"), product.get("description"), product.get("search_tags")))
+
+
+async def current_cards(product_ids: list) -> list:
+    """
+    Актуальные карточки в порядке product_ids. Со снимком каталога — из него (его свежесть
+    держит сверка catalog_version), без снимка — RPC мимо кэша карточек db.product_cache:
+    там правка цены или описания была бы видна только через PRODUCT_CACHE_TTL.
+    """
+    rows = await db.get_products_by_ids_async(product_ids)
+    db.remember_products(rows)
+    by_id = {p["id"]: p for p in rows}
+    return [by_id[pid] for pid in product_ids if pid in by_id]
+
+
+def _numbers(text: str) -> tuple:
+    return tuple(_NUMBER.findall(text))
+
+
+class AnswerCache:
+    """
+    lookup(text) — (запись, товары) при близости не ниже threshold и актуальных карточках, иначе None.
+    store(text, answer, products, source) — сохраняет ответ.
+    invalidate_products(changed_ids) — обработчик CatalogIndex.add_listener.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, threshold: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self._entries: "OrderedDict[str, CachedAnswer]" = OrderedDict()
+        self._vectors: dict = {}  # query -> единичный вектор float32
+        self._keys: List[str] = []
+        self._matrix: Optional[np.ndarray] = None
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.invalidated = 0
+
+    # ------------------------------------------------------------------
+    # ИНДЕКС
+    # ------------------------------------------------------------------
+
+    def _discard(self, query: str) -> None:
+        if self._entries.pop(query, None) is not None:
+            self._vectors.pop(query, None)
+            self._matrix = None
+
+    def _purge_expired(self) -> None:
+        if not self.ttl:
+            return
+        now = time.time()
+        for query in [q for q, e in self._entries.items() if now - e.stored_at > self.ttl]:
+            self._discard(query)
+
+    def _match(self, vector: list, query: str) -> Optional[tuple]:
+        """Ближайшая запись не ниже порога с теми же числами в запросе: (запись, близость)."""
+        self._purge_expired()
+        if not self._entries:
+            return None
+        if self._matrix is None:
+            self._keys = list(self._entries)
+            self._matrix = np.stack([self._vectors[q] for q in self._keys])
+        q = np.asarray(vector, dtype=np.float32)
+        q /= np.linalg.norm(q) or 1.0
+        similarities = self._matrix @ q
+        numbers = _numbers(query)
+        for i in np.argsort(-similarities):
+            if similarities[i] < self.threshold:
+                break
+            entry = self._entries[self._keys[i]]
+            # "шампунь до 3000" и "шампунь до 5000" почти совпадают по смыслу, но не по ответу
+            if _numbers(entry.query) == numbers:
+                return entry, float(similarities[i])
+        return None
+
+    def _put(self, vector: list, entry: CachedAnswer) -> None:
+        v = np.asarray(vector, dtype=np.float32)
+        self._discard(entry.query)
+        self._entries[entry.query] = entry
+        self._vectors[entry.query] = v / (np.linalg.norm(v) or 1.0)
+        while len(self._entries) > self.maxsize:
+            self._discard(next(iter(self._entries)))
+        self._matrix = None
+
+    def invalidate_products(self, changed_ids: set) -> int:
+        if not changed_ids:
+            return 0
+        stale = [q for q, e in self._entries.items() if changed_ids.intersection(e.product_ids)]
+        for query in stale:
+            self._discard(query)
+        self.invalidated += len(stale)
+        if stale:
+            logger.info(f"[ANSWER_CACHE] Сброшено {len(stale)} ответов: изменились товары")
+        return len(stale)
+
+    # ------------------------------------------------------------------
+    # ВЫДАЧА И ЗАПИСЬ
+    # ------------------------------------------------------------------
+
+    async def lookup(self, text: str) -> Optional[tuple]:
+        """(CachedAnswer, карточки товаров) или None."""
+        query = normalize_query_text(text)
+        vector = await db.embed_text_async(query)
+        found = self._match(vector, query) if vector else None
+        if found is None:
+            self.misses += 1
+            return None
+        entry, similarity = found
+        products = await current_cards(list(entry.product_ids))
+        if tuple(product_fingerprint(p) for p in products) != entry.fingerprints:
+            self._discard(entry.query)
+            self.stale += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(entry.query)
+        self.hits += 1
+        logger.info(f"[ANSWER_CACHE] ✅ '{query}' → ответ на '{entry.query}' (близость {similarity:.3f})")
+        return entry, products
+
+    async def store(self, text: str, answer: str, products: list, source: str) -> None:
+        if not answer or not products:
+            return
+        query = normalize_query_text(text)
+        vector = await db.embed_text_async(query)
+        if not vector:
+            return
+        ids = [p["id"] for p in products]
+        # Отпечатки — с тех же карточек, с которыми их будет сверять lookup()
+        cards = await current_cards(ids)
+        if len(cards) != len(ids):
+            return
+        self._put(vector, CachedAnswer(
+            query=query,
+            answer=answer,
+            product_ids=tuple(ids),
+            sources=tuple(p.get("_source") or source for p in products),
+            fingerprints=tuple(product_fingerprint(p) for p in cards),
+            stored_at=time.time(),
+        ))
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "stale": self.stale,
+            "invalidated": self.invalidated,
+        }
@@ -0,0 +1,135 @@
+# answer_stream.py
+# Потоковая доставка ответа LLM в Telegram: первое сообщение отправляется
+# сразу после первых токенов, дальше оно редактируется пачками не чаще,
+# чем позволяет лимит Telegram на edit_message_text.
+
+import asyncio
+import logging
+import re
+
+from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_TEXT_LIMIT = 4096
+# Запас под теги <b></b>, которые добавляет конвертация Markdown → HTML
+SEGMENT_LIMIT = 3800
+
+_BOLD_MD = re.compile(r'\*\*(.*?)\*\*')
+_TAG = re.compile(r'<(/?)([a-zA-Z][\w-]*)[^>]*>')
+
+
+def render_html(text: str, partial: bool = False) -> str:
+    """
+    Принудительно заменяет **текст** на <b>текст</b> (как и раньше в on_text).
+    Для partial=True (текст ещё дописывается) дополнительно делает HTML валидным:
+    - незакрытый `**` в конце превращается в открытый <b>;
+    - обрезается недописанный тег (`<b`) или сущность (`&amp`);
+    - все открытые теги закрываются.
+    """
+    html = _BOLD_MD.sub(r'<b>\1</b>', text)
+    if not partial:
+        return html
+
+    # Половинка маркера в самом конце: "...**" уже обработано выше, остаётся одиночная "*"
+    if html.endswith("*") and not html.endswith("**"):
+        html = html[:-1]
+    # Незакрытый ** на последней строке — жирный уже начался
+    last_line_start = html.rfind("\n") + 1
+    open_marker = html.rfind("**", last_line_start)
+    if open_marker != -1:
+        html = html[:open_marker] + "<b>" + html[open_marker + 2:]
+
+    html = re.sub(r'<[^>]*$', '', html)
+    html = re.sub(r'&[#\w]*$', '', html)
+
+    stack = []
+    for m in _TAG.finditer(html):
+        closing, tag = m.group(1), m.group(2).lower()
+        if closing:
+            if tag in stack:
+                while stack and stack.pop() != tag:
+                    pass
+        else:
+            stack.append(tag)
+    return html + "".join(f"</{tag}>" for tag in reversed(stack))
+
+
+class StreamingReply:
+    """
+    Накапливает дельты ответа и показывает их пользователю одним (или
+    несколькими, если текст длиннее лимита Telegram) редактируемым сообщением.
+    """
+
+    def __init__(self, message: Message, edit_interval: float = 1.0, first_chunk_chars: int = 40):
+        self.message = message
+        self.edit_interval = edit_interval
+        self.first_chunk_chars = first_chunk_chars
+        self.text = ""
+        self._sent = None           # текущее сообщение бота, которое редактируем
+        self._offset = 0            # начало текущего сегмента в self.text
+        self._last_rendered = ""
+        self._next_edit_at = 0.0
+
+    async def push(self, delta: str) -> None:
+        self.text += delta
+        now = asyncio.get_running_loop().time()
+        if self._sent is None and self._offset == 0:
+            # Первое сообщение — как только набралось немного текста
+            if len(self.text.strip()) >= self.first_chunk_chars:
+                await self._flush()
+        elif now >= self._next_edit_at:
+            await self._flush()
+
+    async def finish(self) -> str:
+        """Показывает финальный текст и возвращает его в HTML (для сохранения в историю)."""
+        await self._flush(final=True)
+        return render_html(self.text.strip())
+
+    async def _flush(self, final: bool = False) -> None:
+        segment = self.text[self._offset:]
+        # Текст перерос лимит сообщения — закрываем текущее и начинаем новое
+        while len(segment) > SEGMENT_LIMIT:
+            cut = segment.rfind("\n", 0, SEGMENT_LIMIT)
+            if cut <= 0:
+                cut = SEGMENT_LIMIT
+            await self._show(render_html(segment[:cut]), must=True)
+            self._sent = None
+            self._last_rendered = ""
+            self._offset += cut
+            segment = self.text[self._offset:]
+
+        await self._show(render_html(segment.strip() if final else segment, partial=not final), must=final)
+
+    async def _show(self, html: str, must: bool = False) -> None:
+        if not html.strip() or html == self._last_rendered:
+            return
+        loop = asyncio.get_running_loop()
+        parse_mode = ParseMode.HTML
+        while True:
+            try:
+                if self._sent is None:
+                    self._sent = await self.message.answer(html[:TELEGRAM_TEXT_LIMIT], parse_mode=parse_mode)
+                else:
+                    await self._sent.edit_text(html[:TELEGRAM_TEXT_LIMIT], parse_mode=parse_mode)
+                self._last_rendered = html
+                self._next_edit_at = loop.time() + self.edit_interval
+                return
+            except TelegramRetryAfter as e:
+                # Упёрлись в лимит Telegram: промежуточные правки просто пропускаем,
+                # финальную — дожидаемся.
+                self._next_edit_at = loop.time() + e.retry_after
+                if not must:
+                    return
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                if "not modified" in str(e):
+                    return
+                logger.warning(f"[STREAM] Telegram отклонил правку: {e}")
+                if not must or parse_mode is None:
+                    return
+                # Финальный текст обязан дойти: отправляем без разметки
+                html = re.sub(r'<[^>]+>', '', html)
+                parse_mode = None
@@ -2,7 +2,6 @@ import asyncio
 import logging
 import ast
 import re
-import time
 from typing import Optional
 from aiogram import Bot, Dispatcher, Router, F, types
 from aiogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
@@ -14,7 +13,19 @@ from aiogram.enums.chat_action import ChatAction # <-- ДОБАВИТЬ ЭТОТ
 print("🚀 [BOT] Запуск: импорт модулей...")
 
 # ❌ ИСПРАВЛЕНИЕ: Заменяем удаленный get_query_type на is_product_query
-from llm import generate_answer, is_product_query 
+from llm import generate_answer_async, generate_answer_stream, is_product_query_async, understand_query_async
+from answer_stream import StreamingReply, render_html
+from query_classifier import QueryClassifier, classify_with_fallback
+from session_store import SessionStore
+from conversation_memory import ConversationMemory
+from answer_cache import AnswerCache
+from webhook import run_webhook
+from multiworker import consume, run_ingress
+from shared_state import create_store
+from user_mailbox import Turn, UserMailbox
+from rate_limit import KeyedRateLimiter
+from throttling import ThrottlingMiddleware
+from openai_gateway import BACKGROUND, OpenAIUnavailable, gateway
 print("✅ [BOT] Модуль LLM загружен.")
 
 import config
@@ -44,7 +55,46 @@ dp.include_router(router)
 
 # 🛡️ НАСТРОЙКИ БЕЗОПАСНОСТИ
 MAX_MESSAGE_LENGTH = 2000  # Максимальная длина сообщения (символов)
-USER_LAST_MSG_TIME = {}    # Словарь для анти-спама {user_id: timestamp}
+
+# 🛡️ Анти-спам: token bucket на пользователя для сообщений и нажатий кнопок (до хендлеров)
+rate_limiter = KeyedRateLimiter(
+    rate=config.RATE_LIMIT_PER_SECOND,
+    burst=config.RATE_LIMIT_BURST,
+    maxsize=config.RATE_LIMIT_MAX_USERS,
+)
+message_throttling = ThrottlingMiddleware(rate_limiter, "message")
+callback_throttling = ThrottlingMiddleware(rate_limiter, "callback")
+dp.message.outer_middleware(message_throttling)
+dp.callback_query.outer_middleware(callback_throttling)
+
+# 🗄 Общее состояние (сессии): память процесса или SQLite / Redis для нескольких воркеров
+state = create_store(config.STATE_BACKEND, config.STATE_SQLITE_PATH, config.STATE_REDIS_URL)
+
+# ⚡ Локальный классификатор: очевидные сообщения решаются без LLM
+query_classifier = QueryClassifier(config.CLASSIFIER_THRESHOLD, config.CLASSIFIER_SHADOW_RATE)
+
+# 🗂 Сессии: последние найденные товары (ID) в памяти, запись в Supabase — в фоне
+sessions = SessionStore(config.SESSION_CACHE_SIZE, config.SESSION_TTL, config.SESSION_FLUSH_INTERVAL,
+                        shared=state if state.shared else None)
+
+# 💬 Память диалога: сжатие старых реплик и сводка, обновляемая в фоне
+memory = ConversationMemory(
+    window=config.HISTORY_WINDOW,
+    verbatim=config.HISTORY_VERBATIM_MESSAGES,
+    min_new=config.HISTORY_SUMMARY_MIN_NEW,
+    cache_size=config.SESSION_CACHE_SIZE,
+    ttl=config.SESSION_TTL,
+)
+
+# 💾 Готовые ответы на популярные первые вопросы (сбрасываются при изменении товаров)
+answer_cache = AnswerCache(
+    maxsize=config.ANSWER_CACHE_SIZE,
+    ttl=config.ANSWER_CACHE_TTL,
+    threshold=config.ANSWER_CACHE_THRESHOLD,
+) if config.ANSWER_CACHE_ENABLED else None
+
+# 📬 Почтовые ящики пользователей: один конвейер on_text на пользователя (обработчики объявлены ниже)
+mailbox = UserMailbox(lambda turn: process_turn(turn), on_failure=lambda turn: reply_turn_failed(turn))
 
 # --- Загрузка текста инструкции при старте ---
 try:
@@ -122,14 +172,13 @@ def extract_price_from_query(text: str) -> Optional[float]:
 async def on_start(message: Message, command: CommandObject):
     u = message.from_user
     # ⚠️ ОБЕРТКА DB: upsert_user
-    await asyncio.to_thread(db.upsert_user, u.id, u.first_name or "", u.last_name or "", u.username or "")
+    await db.upsert_user_async(u.id, u.first_name or "", u.last_name or "", u.username or "")
     
     # 💡 ПРОВЕРКА РЕФЕРАЛЬНОЙ ССЫЛКИ (Deep Linking)
     # Если есть аргумент (например, /start partner1), пробуем привязать партнера
     args = command.args
     if args:
-        # Запускаем привязку в фоне, не блокируя ответ
-        await asyncio.to_thread(db.assign_partner_by_code, u.id, args)
+        await db.assign_partner_by_code_async(u.id, args)
 
     # Формируем текст приветствия
     welcome_text = (
@@ -173,7 +222,7 @@ async def handle_view_catalog_reply(message: Message):
 @router.message(F.text == "📞 Связь с менеджером")
 async def handle_manager_reply(message: Message):
     # 💡 Получаем динамический номер
-    phone = await asyncio.to_thread(db.get_manager_phone_for_user, message.from_user.id)
+    phone = await db.get_manager_phone_for_user_async(message.from_user.id)
     
     await message.answer(
         "Вы можете связаться с нашим менеджером 👇",
@@ -201,31 +250,14 @@ async def on_media(message: Message):
 
 @router.message(F.text)
 async def on_text(message: Message):
-    
-    # 🛡️ 1. АНТИ-СПАМ ПРОВЕРКА
+    # 🛡️ 1. АНТИ-СПАМ — ThrottlingMiddleware (сообщения сверх лимита сюда не доходят)
     user_id = message.from_user.id
-    current_time = time.time()
-    last_time = USER_LAST_MSG_TIME.get(user_id, 0)
-
-    # Если прошло меньше 2 секунд с последнего сообщения
-    if current_time - last_time < 2.0:
-        # Можно просто игнорировать или мягко предупредить (лучше игнорировать, чтобы не спамить в ответ)
-        return 
-    
-    USER_LAST_MSG_TIME[user_id] = current_time
 
     # 🛡️ 2. ПРОВЕРКА ДЛИНЫ СООБЩЕНИЯ
     if len(message.text) > MAX_MESSAGE_LENGTH:
         await message.answer("Сообщение слишком длинное. Пожалуйста, сформулируйте вопрос короче.")
         return
 
-    # ... (Оставим реакцию и typing_task без изменений)
-    typing_task = asyncio.create_task(
-        # ... (код для отправки "печатает")
-        bot.send_chat_action(chat_id=message.chat.id, action=ChatAction.TYPING)
-    )
-    await asyncio.sleep(0.3) 
-    
     try:
         # ... (код для установки реакции)
         await bot.set_message_reaction(
@@ -236,9 +268,28 @@ async def on_text(message: Message):
     except Exception as e:
         logging.info(f"Не удалось установить реакцию: {e}")
 
+    if not (message.text or "").strip():
+        return
+
+    # 📬 Один конвейер на пользователя: сообщения, пришедшие во время обработки, объединяются
+    mailbox.submit(user_id, message)
+
+
+async def reply_turn_failed(turn: Turn):
+    """Ответ, если ход прервался не из-за нового сообщения пользователя (см. user_mailbox.py)."""
+    await turn.message.answer("Упс, что-то пошло не так 🙏")
+
+
+async def process_turn(turn: Turn):
+    """Обработка хода: одно или несколько подряд присланных сообщений (см. user_mailbox.py)."""
+    message = turn.message
+    typing_task = asyncio.create_task(
+        # ... (код для отправки "печатает")
+        bot.send_chat_action(chat_id=message.chat.id, action=ChatAction.TYPING)
+    )
     try:
         u = message.from_user
-        text = (message.text or "").strip()
+        text = turn.text
         if not text:
             return
 
@@ -248,34 +299,59 @@ async def on_text(message: Message):
 
         # Проверка на прямой запрос менеджера
         if any(word in text.lower() for word in ["менеджер", "заказ", "связь", "оператор"]):
+            turn.commit()
             # 💡 Получаем динамический номер
-            phone = await asyncio.to_thread(db.get_manager_phone_for_user, u.id)
+            phone = await db.get_manager_phone_for_user_async(u.id)
             await message.answer(
                 "Вы можете связаться с нашим менеджером 👇",
                 reply_markup=get_manager_keyboard(phone)
             )
             # 💡 ВАЖНО: При запросе менеджера очищаем контекст товаров, так как диалог окончен
-            await asyncio.to_thread(db.clear_last_products, u.id)
+            await sessions.clear(u.id)
             return
 
-        # Сохранение пользователя и сообщения
-        await asyncio.to_thread(db.upsert_user, u.id, u.first_name or "", u.last_name or "", u.username or "")
-        await asyncio.to_thread(db.save_message, u.id, "user", text)
+        # Сохранение пользователя и сообщений (уже сохранённые отменённым ходом не дублируются)
+        await db.upsert_user_async(u.id, u.first_name or "", u.last_name or "", u.username or "")
+        for user_text in turn.texts[turn.saved:]:
+            await db.save_message_async(u.id, "user", user_text)
+            turn.saved += 1
 
-        # Получение истории диалога
-        history = await asyncio.to_thread(db.get_recent_messages, u.id, limit=8)
+        # Получение истории диалога: последние реплики как есть, старые — сжатыми / сводкой
+        history, history_summary = await memory.load(u.id)
 
         # --------------------------------------------------------
         # --- ШАГ 1: КЛАССИФИКАЦИЯ И RAG (ПРЯМОЙ ПОИСК) ---
         # --------------------------------------------------------
         
-        do_rag_search = await asyncio.to_thread(is_product_query, text)
+        # 🧠 Разбор запроса (классификация + ключевые слова + категория + цена) — ОДИН вызов LLM,
+        # запускается лениво и переиспользуется всеми шагами ниже.
+        understanding_task = None
+
+        def get_understanding():
+            nonlocal understanding_task
+            if understanding_task is None:
+                understanding_task = asyncio.ensure_future(understand_query_async(text))
+            return understanding_task
+
+        async def llm_is_product(query: str) -> bool:
+            understanding = await get_understanding()
+            if understanding is None:
+                return await is_product_query_async(query)
+            return understanding["is_product_query"]
+
+        # ⚡ Сначала локальный классификатор, в LLM уходят только неоднозначные сообщения.
+        # Теневые проверки ответу не нужны — в очереди к OpenAI они идут с фоновым приоритетом.
+        do_rag_search, decision = await classify_with_fallback(
+            query_classifier, text, llm_is_product,
+            shadow_call=lambda query: is_product_query_async(query, priority=BACKGROUND),
+        )
 
         # 💡 СТРАХОВКА: Если LLM считает, что это не товар, но в базе есть точное совпадение — ищем.
         # Это решает проблему, когда LLM думает, что "жидкое иглоукалывание" — это процедура, а не товар.
-        if not do_rag_search:
+        # Для уверенного локального "нет" (привет / спасибо) страховка не нужна.
+        if not do_rag_search and not query_classifier.is_confident(decision):
             # Проверяем быстро, есть ли такой товар по точному вхождению
-            exact_hits = await asyncio.to_thread(db.search_products_by_exact_match, text)
+            exact_hits = await db.search_products_by_exact_match_async(text)
             if exact_hits:
                 logging.info(f"🛡️ Сработала страховка: '{text}' найден в базе, хотя LLM классифицировала как не-товар.")
                 do_rag_search = True
@@ -286,8 +362,21 @@ async def on_text(message: Message):
         chunks_for_text_gen = []
         # Эта переменная будет хранить товары ТОЛЬКО из нового поиска для отображения кнопок
         newly_matched_products = []
+        matched_source = "search"  # Откуда взяты товары без своего _source (фолбэки по цене / категории)
+
+        # 💾 Первый вопрос без истории: ответ зависит только от запроса и каталога — пробуем готовый
+        answer_cacheable = (answer_cache is not None and do_rag_search
+                            and len(history) <= 1 and not history_summary)
+        cached = await answer_cache.lookup(text) if answer_cacheable else None
 
-        if do_rag_search:
+        if cached is not None:
+            entry, cached_products = cached
+            products_for_text_gen = newly_matched_products = [
+                {**p, "_source": source} for p, source in zip(cached_products, entry.sources)
+            ]
+            await sessions.set_products(u.id, newly_matched_products, query=text)
+
+        elif do_rag_search:
             # --- СЦЕНАРИЙ 1: ПОИСК ТОВАРА (RAG) ---
             
             # 1. Ищем товары и релевантные фрагменты.
@@ -301,20 +390,28 @@ async def on_text(message: Message):
             # 💡 НОВЫЙ ШАГ: "ВТОРОЙ ШАНС" ДЛЯ ПОИСКА (если первый не сработал)
             if not newly_matched_products:
                 logging.info(f"Прямой поиск не дал результатов. Ищу альтернативные варианты для: '{text}'")
+                # Все фолбэки ниже читают из одного разбора запроса (кэшированного)
+                understanding = await get_understanding()
                 
                 # Сценарий 1: Поиск по цене
                 user_price = extract_price_from_query(text)
+                if not user_price and understanding:
+                    user_price = understanding["price"]
                 if user_price:
                     logging.info(f"Найдена цена в запросе: {user_price}. Запускаю поиск по диапазону цен.")
-                    candidate_products = await asyncio.to_thread(db.search_products_by_price_range, user_price)
+                    candidate_products = await db.search_products_by_price_range_async(user_price)
                     if candidate_products:
                         products_for_text_gen = candidate_products
                         newly_matched_products = candidate_products
+                        matched_source = "price"
                         logging.info(f"Поиск по цене нашел {len(candidate_products)} товаров.")
                 
                 # Сценарий 2: Переформулирование запроса с помощью LLM
                 if not newly_matched_products:
-                    reformulated_query = await asyncio.to_thread(db.reformulate_query_with_llm, text)
+                    if understanding is not None:
+                        reformulated_query = understanding["keywords"] or None
+                    else:
+                        reformulated_query = await db.reformulate_query_with_llm_async(text)
                     if reformulated_query:
                         logging.info(f"Запрос переформулирован в: '{reformulated_query}'. Запускаю повторный поиск.")
                         final_products, chunks_for_text_gen = await db.search_products(reformulated_query)
@@ -324,14 +421,16 @@ async def on_text(message: Message):
                 # Сценарий 3: Широкий поиск по категории (если все остальное не сработало)
                 if not newly_matched_products:
                     logging.info(f"Переформулировка не помогла. Запускаю широкий поиск по категории для: '{text}'")
-                    candidate_products = await asyncio.to_thread(db.filter_products_by_category, text)
+                    category = understanding["category"] if understanding is not None else None
+                    candidate_products = await db.filter_products_by_category_async(text, category=category)
                     if candidate_products:
                         products_for_text_gen = candidate_products
                         newly_matched_products = candidate_products # Отобразим кандидатов в кнопках
+                        matched_source = "category"
                         logging.info(f"Широкий поиск нашел {len(candidate_products)} кандидатов. Передаю их LLM для фильтрации.")
 
-            # 2. Сохраняем ПОЛНЫЙ список товаров в Supabase для навигации
-            await asyncio.to_thread(db.save_last_products, u.id, newly_matched_products)
+            # 2. Сохраняем список товаров в сессию для навигации (в Supabase — отложенно)
+            await sessions.set_products(u.id, newly_matched_products, query=text, default_source=matched_source)
 
         else:
             # --- СЦЕНАРИЙ 2: ПРОСТОЙ ДИАЛОГ (Проверка на продолжение контекста) ---
@@ -340,10 +439,14 @@ async def on_text(message: Message):
             # чтобы бот не предлагал старые товары в ответ на "спасибо" или "нет".
             # Мы оставим контекст только если это уточняющий вопрос по списку.
             is_clarification = any(word in text.lower() for word in ["первый", "второй", "третий", "номер", "подробнее", "о нем"])
+            # Если разбор запроса уже сделан (LLM классифицировала), учитываем и его мнение
+            if not is_clarification and understanding_task is not None and understanding_task.done():
+                understanding = understanding_task.result()
+                is_clarification = bool(understanding and understanding["is_clarification"])
             if is_clarification:
-                products_for_text_gen = await asyncio.to_thread(db.get_last_products, u.id)
+                products_for_text_gen = await sessions.get_products(u.id)
             else:
-                await asyncio.to_thread(db.clear_last_products, u.id)
+                await sessions.clear(u.id)
                 products_for_text_gen = []
 
         # 💡 ФИНАЛЬНАЯ ПРОВЕРКА: Если после всех поисков и фолбэков мы так и не нашли
@@ -354,27 +457,56 @@ async def on_text(message: Message):
         # --------------------------------------------------------
         # --- ШАГ 2: ГЕНЕРАЦИЯ ОТВЕТА (ОБЩЕЕ) ---
         # --------------------------------------------------------
+
+        # 📬 Дальше ход не отменяется новыми сообщениями: пользователь начинает получать ответ
+        turn.commit()
         
-        # 💡 ИЗМЕНЕНИЕ: Вызываем LLM с правильными аргументами (products, chunks)
-        answer = await asyncio.to_thread(
-            generate_answer, 
-            history_rows=history, 
-            user_query=text, 
-            products=products_for_text_gen, 
-            chunks=chunks_for_text_gen
-        )
-        
-        # --------------------------------------------------------
-        # --- ШАГ 2: ОТВЕТ И ПОСТ-ОБРАБОТКА (ОБЩЕЕ) ---
-        # --------------------------------------------------------
-        
-        if answer:
-            # 💡 ГАРАНТИРОВАННОЕ ИСПРАВЛЕНИЕ: Принудительно заменяем Markdown на HTML-теги.
-            # Это надежнее, чем полагаться на LLM.
-            # Ищем все вхождения **текст** и заменяем на <b>текст</b>.
-            answer = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', answer)
-            await asyncio.to_thread(db.save_message, u.id, "assistant", answer)
+        if cached is not None:
+            answer = cached[0].answer
+            await db.save_message_async(u.id, "assistant", answer)
+            memory.schedule_update(u.id)
             await message.answer(answer, parse_mode=ParseMode.HTML)
+        elif config.STREAM_ANSWERS:
+            # ✍️ Потоковый режим: пользователь видит ответ по мере генерации,
+            # сообщение редактируется пачками (render_html держит HTML валидным на частичном тексте).
+            reply = StreamingReply(message, config.STREAM_EDIT_INTERVAL, config.STREAM_FIRST_CHUNK_CHARS)
+            async for delta in generate_answer_stream(
+                history_rows=history,
+                user_query=text,
+                products=products_for_text_gen,
+                chunks=chunks_for_text_gen,
+                history_summary=history_summary,
+            ):
+                await reply.push(delta)
+            answer = await reply.finish()
+            if answer:
+                await db.save_message_async(u.id, "assistant", answer)
+                memory.schedule_update(u.id)
+        else:
+            # 💡 ИЗМЕНЕНИЕ: Вызываем LLM с правильными аргументами (products, chunks)
+            answer = await generate_answer_async(
+                history_rows=history, 
+                user_query=text, 
+                products=products_for_text_gen, 
+                chunks=chunks_for_text_gen,
+                history_summary=history_summary,
+            )
+            
+            # --------------------------------------------------------
+            # --- ШАГ 2: ОТВЕТ И ПОСТ-ОБРАБОТКА (ОБЩЕЕ) ---
+            # --------------------------------------------------------
+            
+            if answer:
+                # 💡 ГАРАНТИРОВАННОЕ ИСПРАВЛЕНИЕ: Принудительно заменяем Markdown на HTML-теги.
+                # Это надежнее, чем полагаться на LLM.
+                # Ищем все вхождения **текст** и заменяем на <b>текст</b>.
+                answer = render_html(answer)
+                await db.save_message_async(u.id, "assistant", answer)
+                memory.schedule_update(u.id)
+                await message.answer(answer, parse_mode=ParseMode.HTML)
+
+        if answer_cacheable and cached is None and answer and newly_matched_products:
+            await answer_cache.store(text, answer, products_for_text_gen, matched_source)
 
         # Вывод кнопок для товаров (только если был RAG-поиск и товары найдены)
         # Кнопки должны выводиться только после НОВОГО поиска.
@@ -412,13 +544,16 @@ async def on_text(message: Message):
                     reply_markup=kb
                 )
 
+    except OpenAIUnavailable as e:
+        logging.warning(f"[OPENAI] Ответ {u.id} не сформирован: {e}")
+        await message.answer("Сейчас очень много обращений, я не успеваю ответить 🙏 Напишите, пожалуйста, через минуту.")
     except Exception as e:
         logging.error(f"Ошибка в on_text: {e}")
         await message.answer("Упс, что-то пошло не так 🙏")
-    
-    # Отменяем задачу "Печатает..."
-    if not typing_task.done():
-        typing_task.cancel()
+    finally:
+        # Отменяем задачу "Печатает..." (в т.ч. если ход отменён новым сообщением)
+        if not typing_task.done():
+            typing_task.cancel()
 
         
 # ================== КОЛЛБЕКИ НАВИГАЦИИ ПО ТОВАРАМ ===================
@@ -435,8 +570,8 @@ async def show_page(callback: types.CallbackQuery):
         await callback.answer("Ошибка навигации: некорректный индекс.")
         return
 
-    # ********** ИЗВЛЕКАЕМ ИЗ SUPABASE **********
-    all_products = await asyncio.to_thread(db.get_last_products, user_id)
+    # ********** ИЗВЛЕКАЕМ ИЗ СЕССИИ (память, при промахе — Supabase) **********
+    all_products = await sessions.get_products(user_id)
     total = len(all_products)
 
     if not all_products:
@@ -518,8 +653,8 @@ async def on_product_detail(callback: types.CallbackQuery):
         await callback.answer()
         return
 
-    # ********** ИЗВЛЕКАЕМ ИЗ SUPABASE **********
-    products = await asyncio.to_thread(db.get_last_products, user_id)
+    # ********** ИЗВЛЕКАЕМ ИЗ СЕССИИ (память, при промахе — Supabase) **********
+    products = await sessions.get_products(user_id)
     
     # 💡 ИСПРАВЛЕНИЕ: Сравниваем ID как целые числа для надежности.
     # Это предотвратит ошибки, если product_id - int, а p.get("id") - str, и наоборот.
@@ -608,7 +743,7 @@ async def on_product_detail(callback: types.CallbackQuery):
 
     # ----------------- КНОПКИ -----------------
     # 💡 ИЗМЕНЕНИЕ: Получаем динамический номер менеджера
-    phone = await asyncio.to_thread(db.get_manager_phone_for_user, user_id)
+    phone = await db.get_manager_phone_for_user_async(user_id)
     
     # Кнопка теперь сразу ведет на WhatsApp
     buttons = [
@@ -625,11 +760,94 @@ async def on_product_detail(callback: types.CallbackQuery):
     await callback.answer()
 
 
+async def startup():
+    """Подготовка процесса, который обрабатывает сообщения (один процесс или каждый воркер)."""
+    # 📦 Загружаем снимок каталога в память и держим его свежим в фоне
+    if config.CATALOG_INDEX_ENABLED:
+        db.catalog_index.add_listener(
+            lambda products, _changed: query_classifier.update_lexicon(products.values(), db.STOPWORDS)
+        )
+        if answer_cache is not None:
+            db.catalog_index.add_listener(lambda _products, changed: answer_cache.invalidate_products(changed))
+        await db.catalog_index.refresh(force=True)
+        asyncio.create_task(db.catalog_index.run_refresh_loop(
+            config.CATALOG_VERSION_CHECK_INTERVAL, config.CATALOG_REFRESH_INTERVAL
+        ))
+    else:
+        try:
+            query_classifier.update_lexicon(await db.get_catalog_terms_async(), db.STOPWORDS)
+        except Exception as e:
+            logging.warning(f"Не удалось загрузить лексикон каталога для классификатора: {e}")
+
+    asyncio.create_task(sessions.run_flush_loop())
+    # 🚦 Очередь и токены в минуту общего шлюза к OpenAI — в лог раз в OPENAI_STATS_INTERVAL
+    gateway.start_reporter(config.OPENAI_STATS_INTERVAL)
+
+
+async def shutdown():
+    # Дожидаемся начатых ответов пользователям
+    await mailbox.close(timeout=30)
+    logging.info(f"[MAILBOX] Итоговая статистика: {mailbox.stats()}")
+    logging.info(f"[THROTTLE] Итоговая статистика: {rate_limiter.stats()}, "
+                 f"сообщений пропущено: {message_throttling.throttled}, нажатий: {callback_throttling.throttled}")
+    logging.info(f"[CLASSIFIER] Итоговая статистика: {query_classifier.stats()}")
+    await sessions.flush()
+    logging.info(f"[SESSION] Итоговая статистика: {sessions.stats()}")
+    logging.info(f"[MEMORY] Итоговая статистика: {memory.stats()}")
+    if answer_cache is not None:
+        logging.info(f"[ANSWER_CACHE] Итоговая статистика: {answer_cache.stats()}")
+    if db.reranker is not None:
+        logging.info(f"[RERANK] Итоговая статистика: {db.reranker.stats()}")
+    await state.close()
+    # Закрываем общие пулы HTTP-соединений (Supabase / OpenAI)
+    await db.close_async_clients()
+
+
+def worker_main(index: int, work_queue):
+    """Точка входа процесса-воркера (BOT_WORKERS > 1): обновления приходят от процесса-приёмника."""
+    import signal
+    # Ctrl+C получает вся группа процессов — останавливает воркеров приёмник (через очередь)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_run_worker(index, work_queue))
+
+
+async def _run_worker(index: int, work_queue):
+    await startup()
+    print(f"🚀 [BOT] Воркер {index} готов к обработке обновлений")
+    try:
+        stats = await consume(
+            work_queue,
+            handle=lambda update: dp.feed_update(bot, update),
+            parse=lambda raw: types.Update.model_validate(raw, context={"bot": bot}),
+            workers=config.BOT_WORKERS,
+            concurrency=config.WORKER_CONCURRENCY,
+            queue_size=config.WORKER_QUEUE_SIZE,
+        )
+        logging.info(f"[WORKERS] Воркер {index}: {stats}")
+    finally:
+        await shutdown()
+        await bot.session.close()
+
+
 async def main():
-    print("🚀 [BOT] Запуск polling (ожидание сообщений)...")
-    # Удаляем вебхук перед запуском polling, чтобы Telegram знал, что нужно отдавать сообщения напрямую
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    if config.BOT_WORKERS > 1:
+        # 🧩 Этот процесс только принимает обновления и раскладывает их по воркерам (multiworker.py)
+        await run_ingress(bot, dp, config.BOT_WORKERS, config.WORKER_QUEUE_SIZE, worker_main)
+        await state.close()
+        return
+
+    await startup()
+    try:
+        if config.BOT_MODE == "webhook":
+            # 🌐 Обновления приходят POST-запросами и обрабатываются пулом воркеров (webhook.py)
+            await run_webhook(bot, dp)
+        else:
+            print("🚀 [BOT] Запуск polling (ожидание сообщений)...")
+            # Удаляем вебхук перед запуском polling, чтобы Telegram знал, что нужно отдавать сообщения напрямую
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot)
+    finally:
+        await shutdown()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
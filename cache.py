@@ -0,0 +1,204 @@
+# cache.py
+# Простые in-memory кэши процесса: LRU с TTL и кэш эмбеддингов запросов.
+
+import asyncio
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Ограниченный LRU-кэш с временем жизни записей.
+    - При переполнении вытесняется самая давно использованная запись.
+    - Просроченная запись считается промахом и удаляется при обращении.
+    Потокобезопасен: синхронные функции db.py могут вызываться из пула потоков.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                self.misses += 1
+                return default
+            stored_at, value = item
+            if self.ttl and time.time() - stored_at > self.ttl:
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, stored_at: Optional[float] = None) -> None:
+        with self._lock:
+            self._data[key] = (stored_at or time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.pop(key, _MISSING)
+            return default if item is _MISSING else item[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def items(self) -> list:
+        """Снимок живых записей: [(key, stored_at, value)] от старых к новым."""
+        now = time.time()
+        with self._lock:
+            return [(k, ts, v) for k, (ts, v) in self._data.items() if not self.ttl or now - ts <= self.ttl]
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+def normalize_query_text(text: str) -> str:
+    """Нормализация запроса для ключей кэша: нижний регистр и схлопнутые пробелы."""
+    return " ".join((text or "").lower().split())
+
+
+class EmbeddingCache(TTLCache):
+    """
+    Кэш эмбеддингов запросов, ключ — (модель, нормализованный текст).
+    Векторы хранятся как float32 (в ~8 раз компактнее списка float).
+
+    Опционально сохраняется на диск в два файла:
+    - `<path>.<версия>.npy` — матрица float32 [N, dim], открывается через mmap при старте;
+    - `<path>.json` — имя файла матрицы и ключи со временем записи в том же порядке, что строки.
+    Матрица каждого сохранения пишется в новый файл, а json заменяется последним: он и есть
+    точка фиксации, поэтому сбой посреди сохранения оставляет прежнюю согласованную пару.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, path: str = "", flush_every: int = 200):
+        super().__init__(maxsize, ttl)
+        self.path = path
+        self.flush_every = flush_every
+        self._unsaved = 0
+        self._save_lock = threading.Lock()
+        self._save_task: Optional[asyncio.Future] = None
+
+    @staticmethod
+    def key(model: str, text: str) -> tuple:
+        return (model, normalize_query_text(text))
+
+    def get_vector(self, model: str, text: str) -> Optional[list]:
+        vec = self.get(self.key(model, text))
+        return vec.tolist() if vec is not None else None
+
+    def put_vector(self, model: str, text: str, vector: list) -> None:
+        self.set(self.key(model, text), np.asarray(vector, dtype=np.float32))
+        if self.path:
+            self._unsaved += 1
+            if self._unsaved >= self.flush_every:
+                self._schedule_save()
+
+    def _schedule_save(self) -> None:
+        """В event loop запись матрицы уходит в поток, чтобы не задерживать ответы; без цикла — сразу."""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()
+            return
+        if self._save_task is None or self._save_task.done():
+            self._unsaved = 0
+            self._save_task = loop.create_task(asyncio.to_thread(self.save))
+
+    async def save_async(self) -> None:
+        await asyncio.to_thread(self.save)
+
+    def load(self) -> int:
+        """Поднимает кэш с диска (mmap, без копирования матрицы в память). Возвращает число записей."""
+        if not self.path or not os.path.exists(self.path + ".json"):
+            return 0
+        try:
+            with open(self.path + ".json", "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if isinstance(meta, list):  # Формат до версионирования: `<path>.npy` + список ключей
+                matrix_path, keys = self.path + ".npy", meta
+            else:
+                matrix_path, keys = os.path.join(os.path.dirname(self.path), meta["matrix"]), meta["keys"]
+            matrix = np.load(matrix_path, mmap_mode="r")
+            if len(keys) != matrix.shape[0]:
+                logger.warning("[CACHE] Файлы кэша эмбеддингов не согласованы, пропускаем загрузку.")
+                return 0
+            now = time.time()
+            loaded = 0
+            for row, (model, text, stored_at) in zip(matrix, keys):
+                if self.ttl and now - stored_at > self.ttl:
+                    continue
+                self.set((model, text), row, stored_at=stored_at)
+                loaded += 1
+            logger.info(f"[CACHE] Загружено {loaded} эмбеддингов из {matrix_path}")
+            return loaded
+        except Exception as e:
+            logger.error(f"[CACHE] Не удалось загрузить кэш эмбеддингов: {e}")
+            return 0
+
+    def save(self) -> None:
+        """
+        Атомарно записывает живые записи на диск: новая матрица, затем замена json (rename),
+        затем удаление матриц прежних сохранений. Блокирующая — в event loop вызывать через save_async.
+        """
+        if not self.path:
+            return
+        with self._save_lock:
+            entries = self.items()
+            self._unsaved = 0
+            if not entries:
+                return
+            try:
+                matrix = np.stack([np.asarray(v, dtype=np.float32) for _, _, v in entries])
+                matrix_path = f"{self.path}.{time.time_ns()}.npy"
+                with open(matrix_path, "wb") as f:
+                    np.save(f, matrix)
+                meta = {"matrix": os.path.basename(matrix_path),
+                        "keys": [[k[0], k[1], ts] for k, ts, _ in entries]}
+                with open(self.path + ".json.tmp", "w", encoding="utf-8") as f:
+                    json.dump(meta, f, ensure_ascii=False)
+                os.replace(self.path + ".json.tmp", self.path + ".json")
+                self._remove_stale_matrices(matrix_path)
+                logger.info(f"[CACHE] Сохранено {len(entries)} эмбеддингов в {matrix_path} ({self.stats()})")
+            except Exception as e:
+                logger.error(f"[CACHE] Не удалось сохранить кэш эмбеддингов: {e}")
+
+    def _remove_stale_matrices(self, current: str) -> None:
+        # Уже загруженные через mmap строки остаются доступны и после удаления файла (POSIX)
+        stale = glob.glob(glob.escape(self.path) + ".*.npy") + [self.path + ".npy"]
+        for old in stale:
+            if old != current and os.path.exists(old):
+                try:
+                    os.remove(old)
+                except OSError as e:
+                    logger.warning(f"[CACHE] Не удалось удалить старый файл кэша {old}: {e}")
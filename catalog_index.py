@@ -0,0 +1,210 @@
+# catalog_index.py
+# In-memory снимок каталога: товары + эмбеддинги фрагментов (catalog_chunks).
+# Каталог маленький и меняется редко, поэтому поиск можно обслуживать
+# из памяти процесса, без RPC match_chunks / get_products_by_ids на каждый запрос.
+
+import asyncio
+import json
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+import numpy as np
+
+from text_index import TextIndex
+
+logger = logging.getLogger(__name__)
+
+# Те же колонки, что возвращает RPC get_products_by_ids (см. schema.sql)
+PRODUCT_COLUMNS = "id, name, description, price, images, pv, search_tags"
+PAGE_SIZE = 1000  # Лимит строк PostgREST по умолчанию
+
+
+class _Snapshot:
+    """Неизменяемый снимок каталога. Заменяется целиком при обновлении."""
+
+    def __init__(self, products: dict, chunk_ids: list, chunk_product_ids: list,
+                 chunk_contents: list, matrix: np.ndarray, version: Optional[str]):
+        self.products = products                    # {product_id: product_dict}
+        self.chunk_ids = chunk_ids
+        self.chunk_product_ids = chunk_product_ids
+        self.chunk_contents = chunk_contents
+        self.matrix = matrix                        # [N, dim] float32, строки нормированы
+        self.version = version
+        self.loaded_at = time.time()
+
+
+def _parse_embedding(value) -> Optional[list]:
+    """pgvector через PostgREST приходит строкой '[0.1,0.2,...]'."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return None
+    return list(value)
+
+
+class CatalogIndex:
+    """
+    Локальный движок каталога.
+    - match_chunks(): косинусный top-k одним матричным умножением (аналог RPC match_chunks).
+    - get_products_by_ids(): карточки товаров из словаря (аналог RPC get_products_by_ids).
+    - text_index: n-граммный индекс для точного и keyword-поиска (см. text_index.py).
+    - refresh(): перезагрузка снимка, если изменилась версия каталога (RPC catalog_version).
+    """
+
+    def __init__(self, client_getter: Callable[[], Awaitable]):
+        self._client_getter = client_getter
+        self._snapshot: Optional[_Snapshot] = None
+        self.text_index = TextIndex()
+        self._listeners: list = []
+        self._refresh_lock = asyncio.Lock()
+
+    def add_listener(self, callback: Callable[[dict, set], None]) -> None:
+        """callback(products, changed_ids) вызывается после каждой замены снимка."""
+        self._listeners.append(callback)
+
+    def is_ready(self) -> bool:
+        return self._snapshot is not None
+
+    @property
+    def products(self) -> dict:
+        return self._snapshot.products if self._snapshot else {}
+
+    # ------------------------------------------------------------------
+    # ЗАГРУЗКА
+    # ------------------------------------------------------------------
+
+    async def _fetch_all(self, table: str, columns: str) -> list:
+        client = await self._client_getter()
+        rows, start = [], 0
+        while True:
+            res = await (client.table(table).select(columns)
+                         .order("id")
+                         .range(start, start + PAGE_SIZE - 1)
+                         .execute())
+            page = res.data or []
+            rows.extend(page)
+            if len(page) < PAGE_SIZE:
+                return rows
+            start += PAGE_SIZE
+
+    async def fetch_version(self) -> Optional[str]:
+        """Отпечаток содержимого каталога. None — RPC недоступна (тогда обновляемся только по интервалу)."""
+        try:
+            client = await self._client_getter()
+            res = await client.rpc("catalog_version", {}).execute()
+            return res.data if isinstance(res.data, str) else None
+        except Exception as e:
+            logger.warning(f"[CATALOG] Не удалось получить версию каталога: {e}")
+            return None
+
+    async def _load(self, version: Optional[str]) -> _Snapshot:
+        started = time.perf_counter()
+        product_rows, chunk_rows = await asyncio.gather(
+            self._fetch_all("products", PRODUCT_COLUMNS),
+            self._fetch_all("catalog_chunks", "id, product_id, content, embedding"),
+        )
+
+        chunk_ids, chunk_product_ids, chunk_contents, vectors = [], [], [], []
+        for row in chunk_rows:
+            vec = _parse_embedding(row.get("embedding"))
+            if not vec:
+                continue
+            chunk_ids.append(row["id"])
+            chunk_product_ids.append(row["product_id"])
+            chunk_contents.append(row.get("content") or "")
+            vectors.append(vec)
+
+        # Непрерывная float32-матрица с нормированными строками: cosine = dot product
+        if vectors:
+            matrix = np.ascontiguousarray(np.asarray(vectors, dtype=np.float32))
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            matrix /= np.maximum(norms, 1e-12)
+        else:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+
+        snapshot = _Snapshot(
+            products={p["id"]: p for p in product_rows},
+            chunk_ids=chunk_ids,
+            chunk_product_ids=chunk_product_ids,
+            chunk_contents=chunk_contents,
+            matrix=matrix,
+            version=version,
+        )
+        logger.info(f"[CATALOG] Снимок загружен: {len(snapshot.products)} товаров, "
+                    f"{len(chunk_ids)} фрагментов, {(time.perf_counter() - started) * 1000:.0f} мс")
+        return snapshot
+
+    async def refresh(self, force: bool = False) -> bool:
+        """Перезагружает снимок, если версия изменилась (или force). Возвращает True, если снимок обновлён."""
+        async with self._refresh_lock:
+            version = await self.fetch_version()
+            current = self._snapshot
+            if not force and current is not None and version is not None and version == current.version:
+                return False
+            try:
+                snapshot = await self._load(version)
+                # Без await между sync и заменой снимка: индекс и снимок всегда согласованы
+                self.text_index.sync(snapshot.products)
+                self._snapshot = snapshot
+            except Exception as e:
+                logger.error(f"[CATALOG] Ошибка загрузки снимка каталога: {e}")
+                return False
+
+            old_products = current.products if current else {}
+            changed_ids = {pid for pid, p in snapshot.products.items() if old_products.get(pid) != p}
+            changed_ids |= old_products.keys() - snapshot.products.keys()
+            for listener in self._listeners:
+                try:
+                    listener(snapshot.products, changed_ids)
+                except Exception as e:
+                    logger.error(f"[CATALOG] Ошибка обработчика обновления каталога: {e}")
+            return True
+
+    async def run_refresh_loop(self, check_interval: float, max_age: float):
+        """
+        Фоновый цикл: каждые check_interval секунд сверяет версию каталога,
+        а раз в max_age секунд перезагружает снимок безусловно.
+        """
+        while True:
+            await asyncio.sleep(check_interval)
+            snapshot = self._snapshot
+            expired = snapshot is None or time.time() - snapshot.loaded_at > max_age
+            await self.refresh(force=expired)
+
+    # ------------------------------------------------------------------
+    # ЗАПРОСЫ (тот же формат, что у RPC)
+    # ------------------------------------------------------------------
+
+    def match_chunks(self, query_embedding: list, match_count: int) -> list:
+        snapshot = self._snapshot
+        if snapshot is None or not snapshot.chunk_ids or not query_embedding:
+            return []
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        scores = snapshot.matrix @ query
+
+        k = min(match_count, scores.shape[0])
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        return [
+            {
+                "id": snapshot.chunk_ids[i],
+                "product_id": snapshot.chunk_product_ids[i],
+                "content": snapshot.chunk_contents[i],
+                "similarity": float(scores[i]),
+            }
+            for i in top
+        ]
+
+    def get_products_by_ids(self, product_ids: list) -> list:
+        products = self.products
+        # Копии, чтобы вызывающий код не мог испортить общий снимок
+        return [dict(products[pid]) for pid in product_ids if pid in products]
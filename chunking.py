@@ -0,0 +1,70 @@
+# chunking.py
+# Нарезка описаний товаров на фрагменты для catalog_chunks (RAG-поиск match_chunks).
+# Фрагменты режутся по границам предложений и перекрываются, чтобы мысль,
+# разорванная границей фрагмента, целиком попала хотя бы в один из них.
+
+import re
+from typing import List
+
+CHUNK_MAX_CHARS = 600      # верхняя граница длины фрагмента
+CHUNK_OVERLAP_CHARS = 150  # сколько хвостовых предложений переносить в следующий фрагмент
+CHUNK_MIN_CHARS = 40       # более короткий хвост приклеивается к предыдущему фрагменту
+
+_SENTENCE_END = re.compile(r'(?<=[.!?…])\s+(?=[«"(\[A-ZА-ЯЁ0-9•-])|\n+')
+_SPACES = re.compile(r'[ \t\r\f\v]+')
+
+
+def split_sentences(text: str) -> List[str]:
+    """Предложения и строки (списки ингредиентов, пункты) описания без пустых кусков."""
+    text = _SPACES.sub(" ", text or "").strip()
+    return [s.strip() for s in _SENTENCE_END.split(text) if s and s.strip()]
+
+
+def _split_long(sentence: str, max_chars: int) -> List[str]:
+    """Слишком длинное «предложение» (без точек) режется по словам."""
+    parts, current = [], ""
+    for word in sentence.split(" "):
+        if current and len(current) + 1 + len(word) > max_chars:
+            parts.append(current)
+            current = word
+        else:
+            current = f"{current} {word}" if current else word
+    if current:
+        parts.append(current)
+    return parts
+
+
+def chunk_text(text: str, max_chars: int = CHUNK_MAX_CHARS, overlap_chars: int = CHUNK_OVERLAP_CHARS) -> List[str]:
+    """
+    Жадно набирает предложения во фрагмент до max_chars. Следующий фрагмент
+    начинается с последних предложений предыдущего общей длиной не больше overlap_chars.
+    """
+    sentences = []
+    for sentence in split_sentences(text):
+        sentences.extend(_split_long(sentence, max_chars) if len(sentence) > max_chars else [sentence])
+
+    chunks, current = [], []
+    for sentence in sentences:
+        if current and len(" ".join(current + [sentence])) > max_chars:
+            chunks.append(" ".join(current))
+            overlap = []
+            for prev in reversed(current):
+                if len(" ".join([prev] + overlap + [sentence])) > max_chars or \
+                        len(" ".join([prev] + overlap)) > overlap_chars:
+                    break
+                overlap.insert(0, prev)
+            current = overlap
+        current.append(sentence)
+
+    if current:
+        tail = " ".join(current)
+        if chunks and len(tail) < CHUNK_MIN_CHARS and len(chunks[-1]) + 1 + len(tail) <= max_chars:
+            chunks[-1] = f"{chunks[-1]} {tail}"
+        else:
+            chunks.append(tail)
+    return chunks
+
+
+def chunk_embedding_input(product_name: str, chunk: str) -> str:
+    """Текст для эмбеддинга фрагмента: название товара даёт фрагменту контекст (нижний регистр, как у товаров)."""
+    return f"Товар: {product_name}\nФрагмент: {chunk}".lower()
@@ -23,13 +23,155 @@ GOOGLE_SHEET_URL = "https://drive.google.com/file/d/11Q-jcD1z6jnHwaxAqN69YpFiCee
 
 # 💡 Ссылка на видео-инструкцию (Google Drive, YouTube или др.)
 # Если оставить пустой (""), ссылка в приветствии отображаться не будет.
-VIDEO_INSTRUCTION_URL = "https://drive.google.com/file/d/1ptS9_SCRPk8E9KSojGyZ4LRGu9gdmRDm/view?usp=sharing" 
+VIDEO_INSTRUCTION_URL = "https://drive.google.com/file/d/1ptS9_SCRPk8E9KSojGyZ4LRGu9gdmRDm/view?usp=sharing"
+
+# ⏱ ДЕДЛАЙНЫ ПОИСКА (секунды)
+# Ретривер, не уложившийся в дедлайн, отбрасывается, а поиск продолжается с остальными.
+SEARCH_RETRIEVER_TIMEOUT = float(os.getenv("SEARCH_RETRIEVER_TIMEOUT", "6.0"))
+# Загрузка полных карточек товаров (get_products_by_ids) — без неё ответа не будет, поэтому дольше.
+SEARCH_HYDRATE_TIMEOUT = float(os.getenv("SEARCH_HYDRATE_TIMEOUT", "15.0"))
+
+# 🏅 РАНЖИРОВАНИЕ РЕЗУЛЬТАТОВ ПОИСКА (ranking.py, взвешенный Reciprocal Rank Fusion)
+SEARCH_RRF_K = int(os.getenv("SEARCH_RRF_K", "60"))
+# Товар с оценкой ниже этой доли от лучшей отбрасывается
+SEARCH_MIN_RELATIVE_SCORE = float(os.getenv("SEARCH_MIN_RELATIVE_SCORE", "0.2"))
+# Товар, найденный только векторным поиском, с косинусной близостью ниже порога — шум
+SEARCH_MIN_CHUNK_SIMILARITY = float(os.getenv("SEARCH_MIN_CHUNK_SIMILARITY", "0.25"))
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", "10"))
+# Сколько лучших фрагментов одного товара передавать в контекст LLM
+SEARCH_CHUNKS_PER_PRODUCT = int(os.getenv("SEARCH_CHUNKS_PER_PRODUCT", "2"))
+
+# 🎯 ЛОКАЛЬНЫЙ РЕРАНКЕР (reranker.py, cross-encoder в ONNX на CPU; нужны onnxruntime и tokenizers)
+RERANKER_ENABLED = os.getenv("RERANKER_ENABLED", "0").lower() in ("1", "true", "yes")
+# Папка с model.onnx и tokenizer.json
+RERANKER_MODEL_PATH = os.getenv("RERANKER_MODEL_PATH", "")
+RERANKER_TOP_N = int(os.getenv("RERANKER_TOP_N", "10"))
+# Не успел за бюджет — остаётся порядок RRF
+RERANKER_BUDGET_MS = float(os.getenv("RERANKER_BUDGET_MS", "150"))
+RERANKER_MAX_LENGTH = int(os.getenv("RERANKER_MAX_LENGTH", "256"))
+RERANKER_THREADS = int(os.getenv("RERANKER_THREADS", "2"))
+
+# 🧾 КОНТЕКСТ ДЛЯ ОТВЕТА (context_builder.py): бюджет токенов на товары и фрагменты в промте
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+# Максимум токенов на описание одного товара (режется по предложениям)
+CONTEXT_DESCRIPTION_TOKENS = int(os.getenv("CONTEXT_DESCRIPTION_TOKENS", "200"))
+
+# 💬 ПАМЯТЬ ДИАЛОГА (conversation_memory.py)
+# Сколько последних сообщений читать, сколько из них передавать в промт без сжатия
+HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", "8"))
+HISTORY_VERBATIM_MESSAGES = int(os.getenv("HISTORY_VERBATIM_MESSAGES", "4"))
+# Сводка обновляется (в фоне), когда накопилось столько несжатых старых сообщений
+HISTORY_SUMMARY_MIN_NEW = int(os.getenv("HISTORY_SUMMARY_MIN_NEW", "4"))
+
+# 🌐 ПОЛУЧЕНИЕ ОБНОВЛЕНИЙ: "polling" (по умолчанию) или "webhook" (webhook.py)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Публичный https-адрес сервера (например, "https://bot.example.com"); к нему добавляется WEBHOOK_PATH
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+# Секретный токен: Telegram присылает его в каждом запросе (символы A-Z, a-z, 0-9, _ и -)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Воркеры (шарды по пользователю) и общий лимит очереди; при переполнении — ответ 503
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "32"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "2000"))
+# Сколько одновременных соединений Telegram открывает к серверу (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# 🧩 НЕСКОЛЬКО ПРОЦЕССОВ-ВОРКЕРОВ (multiworker.py): обновления делятся между ними по user_id
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+# Очередь на процесс-воркер и число параллельных шардов (пользователей) внутри него
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", "1000"))
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "32"))
+
+# 🗄 ОБЩЕЕ СОСТОЯНИЕ (shared_state.py: сессии): "memory", "sqlite" или "redis"
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+STATE_SQLITE_PATH = os.getenv("STATE_SQLITE_PATH", "bot_state.sqlite")
+STATE_REDIS_URL = os.getenv("STATE_REDIS_URL", "redis://localhost:6379/0")
+
+# 🔌 ПУЛ HTTP-СОЕДИНЕНИЙ для асинхронных клиентов (Supabase, OpenAI)
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+
+# 🚦 ОБЩИЙ ШЛЮЗ К OPENAI (openai_gateway.py): один клиент, очередь с приоритетами, бюджеты, повторы
+# Одновременных запросов на процесс; фоновым задачам (сводки, теневые проверки, backfill) — не больше
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+OPENAI_BACKGROUND_CONCURRENCY = int(os.getenv("OPENAI_BACKGROUND_CONCURRENCY", "4"))
+# Бюджеты в минуту на весь бот (лимиты аккаунта OpenAI); при BOT_WORKERS > 1 делятся между воркерами
+OPENAI_CHAT_RPM = float(os.getenv("OPENAI_CHAT_RPM", "500"))
+OPENAI_CHAT_TPM = float(os.getenv("OPENAI_CHAT_TPM", "200000"))
+OPENAI_EMBED_RPM = float(os.getenv("OPENAI_EMBED_RPM", "3000"))
+OPENAI_EMBED_TPM = float(os.getenv("OPENAI_EMBED_TPM", "1000000"))
+# Попыток на запрос (429 / 5xx / сеть) и предохранитель: после N сбоев подряд запросы
+# не отправляются OPENAI_BREAKER_COOLDOWN секунд, затем пробный запрос
+OPENAI_MAX_ATTEMPTS = int(os.getenv("OPENAI_MAX_ATTEMPTS", "4"))
+OPENAI_BREAKER_THRESHOLD = int(os.getenv("OPENAI_BREAKER_THRESHOLD", "5"))
+OPENAI_BREAKER_COOLDOWN = float(os.getenv("OPENAI_BREAKER_COOLDOWN", "30"))
+# Как часто писать в лог очередь и токены в минуту, секунды (0 — не писать)
+OPENAI_STATS_INTERVAL = float(os.getenv("OPENAI_STATS_INTERVAL", "60"))
+
+# 🧠 КЭШ ЭМБЕДДИНГОВ ЗАПРОСОВ (LRU + TTL)
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "5000"))
+EMBED_CACHE_TTL = float(os.getenv("EMBED_CACHE_TTL", str(7 * 24 * 3600)))
+# Путь без расширения (например, "/data/embed_cache"). Пусто — кэш живёт только в памяти.
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "")
+
+# 🧠 КЭШ ДЕТЕРМИНИРОВАННЫХ ВЫЗОВОВ LLM (llm_cache.py: классификация, разбор запроса, категория)
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "5000"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+# Файл SQLite (например, "/data/llm_cache.sqlite"). Пусто — кэш живёт только в памяти.
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "")
+
+# 💾 СЕМАНТИЧЕСКИЙ КЭШ ОТВЕТОВ (answer_cache.py) — первые вопросы о товарах без истории диалога
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1").lower() in ("1", "true", "yes")
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "500"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(6 * 3600)))
+# Минимальная косинусная близость эмбеддингов запросов, чтобы отдать готовый ответ
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+
+# 📦 IN-MEMORY СНИМОК КАТАЛОГА (векторный поиск и карточки товаров без RPC)
+CATALOG_INDEX_ENABLED = os.getenv("CATALOG_INDEX_ENABLED", "0").lower() in ("1", "true", "yes")
+# Как часто сверять версию каталога (RPC catalog_version), секунды
+CATALOG_VERSION_CHECK_INTERVAL = float(os.getenv("CATALOG_VERSION_CHECK_INTERVAL", "60"))
+# Безусловная перезагрузка снимка не реже, чем раз в N секунд
+CATALOG_REFRESH_INTERVAL = float(os.getenv("CATALOG_REFRESH_INTERVAL", "3600"))
+
+# ✍️ ПОТОКОВАЯ ВЫДАЧА ОТВЕТА (первое сообщение сразу, затем правки по мере генерации)
+STREAM_ANSWERS = os.getenv("STREAM_ANSWERS", "1").lower() in ("1", "true", "yes")
+# Не чаще одной правки сообщения в N секунд (лимиты Telegram на editMessageText)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+# Сколько символов накопить перед отправкой первого сообщения
+STREAM_FIRST_CHUNK_CHARS = int(os.getenv("STREAM_FIRST_CHUNK_CHARS", "40"))
+
+# ⚡ ЛОКАЛЬНЫЙ КЛАССИФИКАТОР перед is_product_query
+# Решения с уверенностью не ниже порога принимаются без LLM (порог > 1 — всегда спрашивать LLM).
+CLASSIFIER_THRESHOLD = float(os.getenv("CLASSIFIER_THRESHOLD", "0.85"))
+# Доля локальных решений, которые в фоне перепроверяются LLM для статистики согласия
+CLASSIFIER_SHADOW_RATE = float(os.getenv("CLASSIFIER_SHADOW_RATE", "0.05"))
+
+# 🛡️ АНТИ-СПАМ (throttling.py): token bucket на пользователя для сообщений и нажатий кнопок
+# Подряд можно прислать RATE_LIMIT_BURST сообщений, дальше — RATE_LIMIT_PER_SECOND в секунду
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "3"))
+RATE_LIMIT_PER_SECOND = float(os.getenv("RATE_LIMIT_PER_SECOND", "0.5"))
+# Сколько пользователей помнить (LRU); давно неактивные вытесняются
+RATE_LIMIT_MAX_USERS = int(os.getenv("RATE_LIMIT_MAX_USERS", "100000"))
+
+# 🗂 СЕССИИ ПОЛЬЗОВАТЕЛЕЙ (последние найденные товары для пагинации и карточек)
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(6 * 3600)))
+# Отложенная запись (write-behind) в users.last_search_results раз в N секунд
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "2.0"))
+# Общий кэш карточек товаров (когда снимок каталога выключен)
+PRODUCT_CACHE_SIZE = int(os.getenv("PRODUCT_CACHE_SIZE", "5000"))
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL", "3600"))
 
 missing = []
 if not TELEGRAM_TOKEN: missing.append("TELEGRAM_TOKEN (или BOT_TOKEN)")
 if not SUPABASE_URL:  missing.append("SUPABASE_URL")
 if not SUPABASE_KEY:  missing.append("SUPABASE_KEY")
 if not OPENAI_API_KEY: missing.append("OPENAI_API_KEY")
+if BOT_MODE == "webhook" and not WEBHOOK_URL: missing.append("WEBHOOK_URL (для BOT_MODE=webhook)")
+if BOT_MODE == "webhook" and not WEBHOOK_SECRET: missing.append("WEBHOOK_SECRET (для BOT_MODE=webhook)")
 
 if missing:
     print("----------------------------------------------------------------")
@@ -0,0 +1,164 @@
+# context_builder.py
+# Сборка контекста каталога для generate_answer в пределах бюджета токенов.
+# Товары идут в порядке ранжирования (см. ranking.py), фрагменты — по близости;
+# описания режутся по границам предложений, а фрагменты, чей текст уже есть
+# в описании товара или в другом фрагменте, не дублируются.
+
+import logging
+from functools import lru_cache
+from typing import List, Tuple
+
+from chunking import split_sentences
+
+logger = logging.getLogger(__name__)
+
+TOKENIZER_MODEL = "gpt-4o-mini"
+CHARS_PER_TOKEN = 3.0        # Оценка без tiktoken: кириллица — примерно 2-4 символа на токен
+PRODUCTS_SHARE = 0.7         # Доля бюджета на товары в первом проходе; остаток — фрагментам
+MIN_CHUNK_SIMILARITY = 0.2   # Совсем нерелевантные фрагменты не берём
+CHUNK_COVERED_RATIO = 0.8    # Фрагмент, чьи предложения уже на 80% в контексте, — дубль
+
+NOTHING_FOUND = "Контекст из каталога: (ничего релевантного не найдено)."
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    try:
+        import tiktoken
+    except ImportError:
+        logger.info("[CONTEXT] tiktoken не установлен — токены считаются приблизительно")
+        return None
+    try:
+        return tiktoken.encoding_for_model(TOKENIZER_MODEL)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    """Число токенов текста. Кэшируется: одни и те же описания товаров приходят в разных запросах."""
+    if not text:
+        return 0
+    encoding = _encoding()
+    if encoding is None:
+        return int(len(text) / CHARS_PER_TOKEN) + 1
+    return len(encoding.encode(text))
+
+
+def truncate_sentences(text: str, max_tokens: int) -> str:
+    """Первые предложения текста, уместившиеся в max_tokens. Первое слишком длинное предложение режется по словам."""
+    text = (text or "").strip()
+    if max_tokens <= 0 or not text:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    kept = []
+    for sentence in split_sentences(text):
+        candidate = " ".join(kept + [sentence])
+        if count_tokens(candidate) > max_tokens:
+            break
+        kept.append(sentence)
+    if kept:
+        return " ".join(kept) + " …"
+    words, result = text.split(), ""
+    for word in words:
+        candidate = f"{result} {word}" if result else word
+        if count_tokens(candidate) > max_tokens:
+            break
+        result = candidate
+    return result + " …" if result else ""
+
+
+def _sentence_keys(text: str) -> set:
+    return {" ".join(s.lower().split()) for s in split_sentences(text)}
+
+
+def _product_block(p: dict, description: str) -> str:
+    price_info = f"\nЦена: {p['price']} тг" if p.get("price") else ""
+    block = f"Товар: {p.get('name', '')}{price_info}\nТеги: {p.get('search_tags') or ''}"
+    if description:
+        block += f"\nОписание: {description}"
+    return block
+
+
+def build_context(products: list, chunks: list, budget_tokens: int,
+                  description_tokens: int = 200, max_products: int = 15,
+                  max_chunks: int = 5) -> Tuple[str, dict]:
+    """
+    Возвращает (текст контекста, отчёт) — отчёт с числом токенов и попавших в контекст товаров и фрагментов.
+    1. Товары по порядку ранга: заголовок + описание (до description_tokens, по предложениям),
+       пока не исчерпана доля бюджета товаров; если описание не влезает — только заголовок.
+    2. Фрагменты по убыванию близости в оставшийся бюджет, без повторов уже включённого текста.
+    """
+    if not products and not chunks:
+        return NOTHING_FOUND, {"tokens": count_tokens(NOTHING_FOUND), "products": 0, "chunks": 0}
+
+    header = "Контекст из каталога (наиболее релевантные фрагменты):"
+    products_title = "--- Найденные товары (по названию или тегам) ---"
+    chunks_title = "\n--- Релевантные фрагменты из описаний (найдены по смыслу) ---"
+    used = count_tokens(header)
+
+    product_map = {p["id"]: p for p in products}
+    included_sentences: dict = {}  # product_id -> ключи предложений, уже попавших в контекст
+    product_lines: List[str] = []
+
+    products_budget = int(budget_tokens * PRODUCTS_SHARE)
+    if products:
+        used += count_tokens(products_title)
+    for p in products[:max_products]:
+        remaining = products_budget - used
+        description = truncate_sentences(p.get("description") or "", min(description_tokens, remaining))
+        block = _product_block(p, description)
+        cost = count_tokens(block)
+        if cost > remaining:
+            block, description = _product_block(p, ""), ""
+            cost = count_tokens(block)
+            if cost > remaining:
+                break
+        product_lines.append(block)
+        included_sentences[p["id"]] = _sentence_keys(description.removesuffix(" …"))
+        used += cost
+
+    chunk_lines: List[str] = []
+    relevant = sorted((c for c in chunks or [] if (c.get("similarity") or 0) > MIN_CHUNK_SIMILARITY
+                       and c.get("product_id") in product_map),
+                      key=lambda c: c.get("similarity") or 0, reverse=True)
+    if relevant:
+        used += count_tokens(chunks_title)
+    for chunk in relevant:
+        if len(chunk_lines) >= max_chunks:
+            break
+        content = (chunk.get("content") or "").strip()
+        seen = included_sentences.setdefault(chunk["product_id"], set())
+        keys = _sentence_keys(content)
+        if keys and len(keys & seen) >= CHUNK_COVERED_RATIO * len(keys):
+            continue  # Этот текст уже есть в описании товара или в соседнем (перекрывающемся) фрагменте
+        product = product_map[chunk["product_id"]]
+        prefix = (f"Фрагмент #{len(chunk_lines) + 1} для товара '{product.get('name', '')}' "
+                  f"(релевантность: {chunk.get('similarity', 0):.2f}):\n")
+        room = budget_tokens - used - count_tokens(prefix) - 2
+        content = truncate_sentences(content, room)
+        if not content:
+            break
+        line = f"{prefix}\"{content}\""
+        chunk_lines.append(line)
+        seen |= keys
+        used += count_tokens(line)
+
+    lines = []
+    if product_lines:
+        lines.append(products_title)
+        lines.extend(product_lines)
+    if chunk_lines:
+        lines.append(chunks_title)
+        lines.extend(chunk_lines)
+    text = header + "\n" + "\n".join(lines)
+    report = {
+        "tokens": count_tokens(text),
+        "budget": budget_tokens,
+        "products": len(product_lines),
+        "products_total": len(products),
+        "chunks": len(chunk_lines),
+        "chunks_total": len(chunks or []),
+    }
+    return text, report
@@ -0,0 +1,136 @@
+# conversation_memory.py
+# Память диалога для generate_answer: последние реплики уходят в промт как есть,
+# более старые — сжатыми (списки товаров → названия и ID), а всё, что уже
+# вошло в сводку (users.history_summary), заменяется самой сводкой.
+# Сводка обновляется фоновой задачей после ответа и не влияет на задержку.
+
+import asyncio
+import logging
+import re
+
+import db
+from cache import TTLCache
+from llm import summarize_history_async
+
+logger = logging.getLogger(__name__)
+
+USER_MESSAGE_CHARS = 300
+ASSISTANT_INTRO_CHARS = 300
+MAX_NAMES = 10
+
+_TAG = re.compile(r"<[^>]+>")
+# Жирный текст, если за ним не идёт двоеточие ("<b>Важно</b>:" — подпись, а не товар)
+_BOLD = re.compile(r"<b>([^<]*?)</b>(?!\s*:)|\*\*([^*]*?)\*\*(?!\s*:)")
+_LIST_LINE = re.compile(r"^\s*(?:\d+[.)]|[-•*])\s+")
+
+
+def _catalog_ids_by_name() -> dict:
+    """{название в нижнем регистре: ID} из снимка каталога или кэша карточек."""
+    if db.catalog_index.is_ready():
+        products = db.catalog_index.products.values()
+    else:
+        products = (p for _, _, p in db.product_cache.items())
+    return {(p.get("name") or "").strip().casefold(): p["id"] for p in products if p.get("name")}
+
+
+def compact_message(row: dict, ids_by_name: dict = None) -> str:
+    """
+    Сжатая реплика для старой части истории.
+    Ответ консультанта: первая фраза + названия предложенных товаров (с ID, если товар есть в каталоге).
+    Сообщение клиента: обрезается до USER_MESSAGE_CHARS.
+    """
+    content = row.get("content") or ""
+    if row.get("role") != "assistant":
+        return content[:USER_MESSAGE_CHARS]
+
+    plain = _TAG.sub("", content).replace("**", "")
+    lines = [line.strip() for line in plain.splitlines() if line.strip()]
+    intro = next((line for line in lines if not _LIST_LINE.match(line)), "")
+    names = [n for n in dict.fromkeys(" ".join((a or b).split()).rstrip(":") for a, b in _BOLD.findall(content)) if n]
+    if not names:
+        return plain.strip() if len(plain) <= ASSISTANT_INTRO_CHARS else intro[:ASSISTANT_INTRO_CHARS]
+
+    labels = []
+    for name in names[:MAX_NAMES]:
+        pid = (ids_by_name or {}).get(name.casefold())
+        labels.append(f"{name} (ID {pid})" if pid is not None else name)
+    return f"{intro[:ASSISTANT_INTRO_CHARS]}\nПредложенные товары: {', '.join(labels)}".strip()
+
+
+class ConversationMemory:
+    """
+    load() — история для промта: (строки сообщений, сводка).
+    schedule_update() — фоновое обновление сводки; одна задача на пользователя за раз.
+    Сводки кэшируются в памяти (TTLCache), в Supabase — users.history_summary / history_summary_upto.
+    """
+
+    def __init__(self, window: int, verbatim: int, min_new: int, cache_size: int, ttl: float):
+        self.window = window
+        self.verbatim = verbatim
+        self.min_new = min_new
+        self._summaries = TTLCache(maxsize=cache_size, ttl=ttl)  # user_id -> (summary, upto_id)
+        self._updating: set = set()
+        self._tasks: set = set()
+        self.updates = 0
+        self.failures = 0
+
+    async def _summary(self, user_id: int) -> tuple:
+        cached = self._summaries.get(user_id)
+        if cached is None:
+            cached = await db.get_history_summary_async(user_id)
+            self._summaries.set(user_id, cached)
+        return cached
+
+    async def load(self, user_id: int) -> tuple:
+        rows, (summary, upto) = await asyncio.gather(
+            db.get_recent_messages_async(user_id, limit=self.window),
+            self._summary(user_id),
+        )
+        verbatim = rows[-self.verbatim:] if self.verbatim else []
+        older = [r for r in rows[:len(rows) - len(verbatim)] if (r.get("id") or 0) > upto]
+        if older:
+            ids_by_name = _catalog_ids_by_name()
+            older = [{**r, "content": compact_message(r, ids_by_name)} for r in older]
+        return older + verbatim, summary
+
+    def schedule_update(self, user_id: int) -> None:
+        if user_id in self._updating:
+            return
+        self._updating.add(user_id)
+        task = asyncio.create_task(self._update(user_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _update(self, user_id: int) -> None:
+        try:
+            summary, upto = await self._summary(user_id)
+            recent = await db.get_recent_messages_async(user_id, limit=self.window)
+            if len(recent) <= self.verbatim:
+                return
+            boundary = recent[-self.verbatim]["id"] if self.verbatim else recent[-1]["id"] + 1
+            # Без сводки начинаем с окна истории: более старые реплики и раньше не попадали в промт
+            after = upto or recent[0]["id"] - 1
+            pending = await db.get_messages_between_async(user_id, after, boundary)
+            if len(pending) < self.min_new:
+                return
+
+            ids_by_name = _catalog_ids_by_name()
+            compacted = [{"role": m["role"], "content": compact_message(m, ids_by_name)} for m in pending]
+            new_summary = await summarize_history_async(summary, compacted)
+            if not new_summary:
+                self.failures += 1
+                return
+            new_upto = pending[-1]["id"]
+            await db.save_history_summary_async(user_id, new_summary, new_upto)
+            self._summaries.set(user_id, (new_summary, new_upto))
+            self.updates += 1
+            logger.info(f"[MEMORY] Сводка диалога {user_id} обновлена: +{len(pending)} сообщений (до ID {new_upto})")
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"[MEMORY] Ошибка обновления сводки для {user_id}: {e}")
+        finally:
+            self._updating.discard(user_id)
+
+    def stats(self) -> dict:
+        return {**self._summaries.stats(), "updates": self.updates, "failures": self.failures,
+                "in_flight": len(self._updating)}
@@ -1,23 +1,116 @@
-from supabase import create_client, ClientOptions
-from openai import OpenAI
+from supabase import acreate_client, AsyncClient, AsyncClientOptions
+import httpx
 import config
+from cache import EmbeddingCache, TTLCache, normalize_query_text
+from catalog_index import CatalogIndex
+from llm_cache import llm_cache
+from openai_gateway import gateway
+from ranking import rank_candidates
+from reranker import Reranker
 import logging
 import asyncio 
+import time
+import hashlib
 from typing import Optional
 from datetime import datetime, timezone # 💡 Для проверки даты подписки
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-print("⏳ [DB] Подключение к Supabase...")
-# 💡 Инициализация синхронных клиентов с увеличенным таймаутом
-# Это нужно, чтобы "холодный старт" базы на бесплатном тарифе не вызывал ошибку.
-options = ClientOptions(postgrest_client_timeout=30)
-supabase = create_client(config.SUPABASE_URL, config.SUPABASE_KEY, options=options)
-print("✅ [DB] Supabase клиент создан.")
 
-print("⏳ [DB] Подключение к OpenAI...")
-openai_client = OpenAI(api_key=config.OPENAI_API_KEY)
+# 💡 АСИНХРОННЫЕ КЛИЕНТЫ: один общий пул соединений (keep-alive) на процесс.
+# Запросы к OpenAI идут через общий шлюз openai_gateway (свой клиент и пул соединений).
+# Хендлеры бота вызывают *_async функции напрямую, не занимая потоки из default executor.
+def _make_async_http_client(timeout: float) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=timeout,
+        limits=httpx.Limits(
+            max_connections=config.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=config.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=30,
+        ),
+    )
+
+_async_supabase: Optional[AsyncClient] = None
+_async_supabase_lock = asyncio.Lock()
+
+
+async def get_async_supabase() -> AsyncClient:
+    """Лениво создаёт общий асинхронный клиент Supabase (создание требует event loop)."""
+    global _async_supabase
+    if _async_supabase is None:
+        async with _async_supabase_lock:
+            if _async_supabase is None:
+                async_options = AsyncClientOptions(
+                    postgrest_client_timeout=30,
+                    httpx_client=_make_async_http_client(timeout=30),
+                )
+                _async_supabase = await acreate_client(config.SUPABASE_URL, config.SUPABASE_KEY, options=async_options)
+                logger.info("✅ [DB] Асинхронный Supabase клиент создан.")
+    return _async_supabase
+
+
+# 💡 Локальный снимок каталога. Пока он не загружен (или выключен в конфиге),
+# поиск работает через RPC Supabase как раньше.
+catalog_index = CatalogIndex(get_async_supabase)
+
+# 🎯 Необязательный локальный реранкер после RRF (модель грузится лениво при первом поиске)
+reranker = Reranker(
+    config.RERANKER_MODEL_PATH,
+    top_n=config.RERANKER_TOP_N,
+    budget_ms=config.RERANKER_BUDGET_MS,
+    max_length=config.RERANKER_MAX_LENGTH,
+    threads=config.RERANKER_THREADS,
+) if config.RERANKER_ENABLED and config.RERANKER_MODEL_PATH else None
+
+
+def use_catalog_index() -> bool:
+    return config.CATALOG_INDEX_ENABLED and catalog_index.is_ready()
+
+
+# 💡 Общий кэш карточек товаров по ID. Когда снимок каталога загружен, источник — он;
+# иначе карточки, уже пришедшие из поиска, переиспользуются без повторных запросов.
+product_cache = TTLCache(maxsize=config.PRODUCT_CACHE_SIZE, ttl=config.PRODUCT_CACHE_TTL)
+
+
+def remember_products(products: list) -> None:
+    """Кладёт карточки в общий кэш (без тяжёлого поля embedding и служебных полей поиска)."""
+    for p in products or []:
+        if p and p.get("id") is not None:
+            product_cache.set(p["id"], {k: v for k, v in p.items() if k != "embedding" and not k.startswith("_")})
+
+
+async def get_products_cached_async(product_ids: list) -> list:
+    """Карточки по ID в исходном порядке: снимок каталога → кэш → RPC только для недостающих."""
+    found = {}
+    if use_catalog_index():
+        found.update((p["id"], p) for p in catalog_index.get_products_by_ids(product_ids))
+    for pid in product_ids:
+        if pid not in found:
+            cached = product_cache.get(pid)
+            if cached is not None:
+                found[pid] = dict(cached)
+    missing = [pid for pid in product_ids if pid not in found]
+    if missing:
+        fetched = await get_products_by_ids_async(missing)
+        remember_products(fetched)
+        found.update((p["id"], p) for p in fetched)
+    return [found[pid] for pid in product_ids if pid in found]
+
+
+async def close_async_clients():
+    """Закрывает общие HTTP-пулы при остановке бота и сохраняет кэш эмбеддингов."""
+    global _async_supabase
+    await embedding_cache.save_async()
+    logger.info(f"[CACHE] Эмбеддинги запросов: {embedding_cache.stats()}")
+    logger.info(f"[LLM_CACHE] Ответы LLM: {llm_cache.stats()}")
+    llm_cache.close()
+    await gateway.close()
+    if _async_supabase is not None:
+        http_client = _async_supabase.options.httpx_client
+        if http_client is not None:
+            await http_client.aclose()
+        _async_supabase = None
 
 # 💡 ОПТИМИЗАЦИЯ: Выносим стоп-слова в константу, чтобы не создавать set каждый раз
 STOPWORDS = {
@@ -28,16 +121,141 @@ STOPWORDS = {
 }
 
 # ==============================================================================
-# 1. ФУНКЦИИ РАБОТЫ С БАЗОЙ ДАННЫХ (С КОРРЕКЦИЕЙ ID И КОНТЕКСТА)
+# 1. ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ДЛЯ РАБОТЫ С ПАРТНЕРАМИ
 # ==============================================================================
 
-def upsert_user(user_id: int, first_name: str, last_name: str, username: str):
+def _phone_if_subscription_active(partner_id, partner: dict, default_phone: str) -> str:
+    """Возвращает номер партнера, если его подписка активна (или бессрочна), иначе дефолтный."""
+    phone = partner.get("phone_number")
+    end_date_str = partner.get("subscription_end_date")
+    
+    logger.debug(f"[PHONE] Партнер ID={partner_id}: phone={phone}, subscription_end={end_date_str}")
+    
+    # 1. Если даты нет — считаем подписку бессрочной
+    if not end_date_str:
+        logger.info(f"[PHONE] Партнер ID={partner_id}: подписка бессрочная. Отдаём номер партнера: {phone}")
+        return phone or default_phone
+
+    # 2. Если дата есть — парсим её аккуратно
+    try:
+        end_date = datetime.fromisoformat(end_date_str.replace('Z', '+00:00'))
+    except ValueError:
+        end_date = datetime.fromisoformat(end_date_str)
+    
+    # Если дата "наивная" (без таймзоны), принудительно ставим UTC
+    if end_date.tzinfo is None:
+        end_date = end_date.replace(tzinfo=timezone.utc)
+
+    if end_date > datetime.now(timezone.utc):
+        logger.info(f"[PHONE] Партнер ID={partner_id}: подписка активна до {end_date_str}. Отдаём номер партнера: {phone}")
+        return phone or default_phone
+
+    logger.info(f"[PHONE] Партнер ID={partner_id}: подписка ИСТЕКЛА {end_date_str}. Отдаём дефолтный номер.")
+    return default_phone
+
+# ==============================================================================
+# 2. ФУНКЦИИ LLM и УСКОРЕННЫЙ ПОИСК (ОСТАВЛЕНЫ БЕЗ ИЗМЕНЕНИЙ)
+# ==============================================================================
+def get_product_text_for_embedding(product_data: dict) -> str:
     """
-    Обновляет или создает пользователя. 
-    💡 Коррекция: Здесь используется 'user_id', что корректно.
+    💡 ИСПРАВЛЕНО: Эта функция должна быть точной копией
+    аналогичной функции из embeddings.py для консистентности векторов.
     """
+    name = product_data.get('name', '')
+    desc = product_data.get('description', '')
+    tags = product_data.get('search_tags', '')
+
+    combined_text = (f"Товар: {name}\nТеги для поиска: {tags}\nОписание: {desc}")
+    
+    # 💡 КРИТИЧЕСКОЕ ИЗМЕНЕНИЕ: Нормализация к нижнему регистру
+    return combined_text.lower()
+
+
+
+EMBED_MODEL = "text-embedding-3-small"
+
+
+def embedding_content_hash(text: str, model: str = EMBED_MODEL) -> str:
+    """Хэш входа эмбеддинга (модель + текст). Совпал с сохранённым — вектор актуален."""
+    return hashlib.sha256(f"{model}\n{text}".encode("utf-8")).hexdigest()
+
+# 💡 Кэш эмбеддингов запросов: пользователи часто повторяют одни и те же короткие запросы
+embedding_cache = EmbeddingCache(
+    maxsize=config.EMBED_CACHE_SIZE,
+    ttl=config.EMBED_CACHE_TTL,
+    path=config.EMBED_CACHE_PATH,
+)
+embedding_cache.load()
+
+CATEGORY_PROMPT = "Твоя задача - извлечь из запроса пользователя ОДНО слово, обозначающее категорию товара (например, 'шампунь', 'крем', 'чай', 'бальзам', 'капсулы'). Если категорию извлечь не удается, верни пустую строку."
+LLM_HELPER_MODEL = "gpt-4o-mini"
+
+
+# 💡 Извлечение категории и переформулирование детерминированы (temperature=0):
+# ответы кэшируются в llm_cache по модели, промту и нормализованному запросу.
+def _helper_messages(prompt: str, query: str) -> list:
+    return [
+        {"role": "system", "content": prompt},
+        {"role": "user", "content": normalize_query_text(query)}
+    ]
+
+
+async def _extract_category_async(query: str) -> str:
+    async def compute() -> str:
+        response = await gateway.chat(
+            model=LLM_HELPER_MODEL, messages=_helper_messages(CATEGORY_PROMPT, query), temperature=0
+        )
+        return response.choices[0].message.content.strip().lower()
+
+    return await llm_cache.get_or_compute_async(
+        llm_cache.key("category", LLM_HELPER_MODEL, CATEGORY_PROMPT, query), compute
+    )
+
+
+REFORMULATE_PROMPT = (
+    "Твоя задача — превратить запрос пользователя в простой и чистый поисковый запрос. "
+    "**Обязательно исправляй возможные опечатки в словах (например, 'шампун' -> 'шампунь', 'крил' -> 'криль').** "
+    "Извлеки только названия товаров, их компоненты или категории. "
+    "Также переводи иностранные названия на русский (например, 'krill oil' -> 'масло криля', 'ginseng' -> 'женьшень'). "
+    "Убери все лишние слова, такие как 'как принимать', 'сколько стоит', 'есть ли у вас'. "
+    "Результат верни в виде строки, где ключевые слова разделены запятой. "
+    "Если извлечь ключевые слова не удалось, верни пустую строку."
+)
+
+def _get_clean_words(query: str) -> list[str]:
+    if not query: return []
+    """Разбивает запрос на слова и убирает стоп-слова."""
+    words = query.lower().replace(',', ' ').replace('.', ' ').split()
+    return [w for w in words if w not in STOPWORDS]
+
+EXACT_MATCH_COLUMNS = "id, name, price, description, search_tags"
+
+def _exact_match_phrase(query: str) -> str:
+    """Готовит фразу для точного поиска. Пустая строка — искать нечего."""
+    # Очищаем запрос от лишних символов, но оставляем пробелы
+    # 💡 УЛУЧШЕНИЕ: Убираем стоп-слова из начала фразы (например, "есть жидкое..." -> "жидкое...")
+    words = query.lower().split()
+    while words and words[0] in STOPWORDS:
+        words.pop(0)
+    
+    clean_query = " ".join(words).strip()
+    return clean_query if len(clean_query) >= 3 else ""
+
+def _exact_match_filter(clean_query: str) -> str:
+    # 💡 ИЗМЕНЕНИЕ: Ищем фразу везде, включая ОПИСАНИЕ (description).
+    # Это позволит находить "L-теанин", даже если он есть только в тексте состава.
+    return f"name.ilike.%{clean_query}%,search_tags.ilike.%{clean_query}%,description.ilike.%{clean_query}%"
+
+# ==============================================================================
+# 3. ФУНКЦИИ РАБОТЫ С БАЗОЙ ДАННЫХ (native async I/O для хендлеров бота)
+# ==============================================================================
+# Синхронный клиент Supabase больше не используется: скрипты (embeddings.py,
+# import_catalog.py) тоже работают через get_async_supabase().
+
+async def upsert_user_async(user_id: int, first_name: str, last_name: str, username: str):
     try:
-        return supabase.table("users").upsert({
+        client = await get_async_supabase()
+        return await client.table("users").upsert({
             "user_id": user_id,
             "first_name": first_name,
             "last_name": last_name,
@@ -48,243 +266,204 @@ def upsert_user(user_id: int, first_name: str, last_name: str, username: str):
         return None
 
 
-def save_message(user_id: int, role: str, content: str):
-    """Сохраняет сообщение в историю диалога. Здесь user_id корректен."""
-    return supabase.table("messages").insert({
+async def save_message_async(user_id: int, role: str, content: str):
+    client = await get_async_supabase()
+    return await client.table("messages").insert({
         "user_id": user_id, "role": role, "content": content
     }).execute()
 
 
-def get_recent_messages(user_id: int, limit: int = 10):
-    """Извлекает последние сообщения пользователя. Здесь user_id корректен."""
-    res = (supabase.table("messages")
-           .select("*")
-           .eq("user_id", user_id)
-           .order("id", desc=True)
-           .limit(limit)
-           .execute())
+async def get_recent_messages_async(user_id: int, limit: int = 10):
+    client = await get_async_supabase()
+    res = await (client.table("messages")
+                 .select("*")
+                 .eq("user_id", user_id)
+                 .order("id", desc=True)
+                 .limit(limit)
+                 .execute())
     return list(reversed(res.data or []))
 
 
-def save_last_products(user_id: int, products: list):
-    """
-    СОХРАНЯЕТ список найденных продуктов в Supabase.
-    💡 ИСПРАВЛЕНО: Убеждаемся, что для поиска используется 'user_id'.
-    """
+async def get_messages_between_async(user_id: int, after_id: int, before_id: int, limit: int = 50) -> list:
+    """Сообщения с after_id < id < before_id в хронологическом порядке (для сводки диалога)."""
+    client = await get_async_supabase()
+    res = await (client.table("messages")
+                 .select("id, role, content")
+                 .eq("user_id", user_id)
+                 .gt("id", after_id)
+                 .lt("id", before_id)
+                 .order("id")
+                 .limit(limit)
+                 .execute())
+    return res.data or []
+
+
+async def get_history_summary_async(user_id: int) -> tuple:
+    """(history_summary, history_summary_upto) пользователя; ("", 0), если сводки ещё нет."""
+    try:
+        client = await get_async_supabase()
+        res = await (client.table("users")
+                     .select("history_summary, history_summary_upto")
+                     .eq("user_id", user_id)
+                     .limit(1)
+                     .execute())
+        row = (res.data or [{}])[0]
+        return row.get("history_summary") or "", row.get("history_summary_upto") or 0
+    except Exception as e:
+        logger.error(f"[DB] Ошибка при чтении сводки диалога для {user_id}: {e}")
+        return "", 0
+
+
+async def save_history_summary_async(user_id: int, summary: str, upto_id: int):
+    client = await get_async_supabase()
+    return await client.table("users").update({
+        "history_summary": summary,
+        "history_summary_upto": upto_id,
+    }).eq("user_id", user_id).execute()
+
+
+async def save_last_products_async(user_id: int, search_results):
+    """search_results — компактный формат сессии (см. session_store.encode_search_results)."""
     try:
-        response = supabase.table('users').update({
-            'last_search_results': products 
-        }).eq('user_id', user_id).execute() # <--- ИСПРАВЛЕНО: .eq('user_id', user_id)
-        return response
+        client = await get_async_supabase()
+        return await client.table('users').update({
+            'last_search_results': search_results
+        }).eq('user_id', user_id).execute()
     except Exception as e:
         logger.error(f"[DB] Ошибка при сохранении результатов для {user_id}: {e}")
         return None
 
 
-def get_last_products(user_id: int) -> list:
-    """
-    ИЗВЛЕКАЕТ список найденных продуктов из Supabase.
-    💡 ИСПРАВЛЕНО: Убеждаемся, что для поиска используется 'user_id'.
-    """
+async def get_last_products_async(user_id: int):
+    """Сырое значение users.last_search_results: компактный dict (v2) или старый список карточек."""
     try:
-        response = (supabase.table('users')
-                    .select('last_search_results')
-                    .eq('user_id', user_id) # <--- ИСПРАВЛЕНО: .eq('user_id', user_id)
-                    .single()
-                    .execute())
-
+        client = await get_async_supabase()
+        response = await (client.table('users')
+                          .select('last_search_results')
+                          .eq('user_id', user_id)
+                          .single()
+                          .execute())
         data = response.data
         if data and data.get('last_search_results'):
             return data['last_search_results']
-        
         return []
     except Exception as e:
         logger.warning(f"[DB] Контекст не найден для {user_id}: {e}")
         return []
 
-# 🚀 НОВАЯ/ИСПРАВЛЕННАЯ ФУНКЦИЯ
-def clear_last_products(user_id: int) -> None:
-    """
-    Очищает список последних найденных товаров (контекст RAG) для пользователя.
-    💡 КРИТИЧЕСКИ ИСПРАВЛЕНО: Теперь использует 'user_id' и 'last_search_results'.
-    """
+
+async def clear_last_products_async(user_id: int) -> None:
     try:
-        # Используем фактическое имя колонки 'last_search_results'
-        # Используем 'user_id' для поиска пользователя, чтобы избежать ошибки 42703 ('column users.id does not exist')
-        supabase.table("users").update({"last_search_results": None}).eq("user_id", user_id).execute() # <--- ИСПРАВЛЕНО
+        client = await get_async_supabase()
+        await client.table("users").update({"last_search_results": None}).eq("user_id", user_id).execute()
         logger.info("Контекст последних продуктов очищен для пользователя %d", user_id)
     except Exception as e:
         logger.error("Ошибка при очистке последних продуктов для %d: %s", user_id, e)
-        
 
-# ==============================================================================
-# 🚀 НОВЫЕ ФУНКЦИИ ДЛЯ РАБОТЫ С ПАРТНЕРАМИ
-# ==============================================================================
 
-def assign_partner_by_code(user_id: int, referral_code: str):
-    """
-    Находит партнера по коду и привязывает его к пользователю.
-    """
+async def assign_partner_by_code_async(user_id: int, referral_code: str):
     try:
-        code_clean = referral_code.strip() # Убираем лишние пробелы
-        # 1. Ищем партнера по коду
-        res = supabase.table("partners").select("id").eq("referral_code", code_clean).maybe_single().execute()
-        if res.data:
+        client = await get_async_supabase()
+        code_clean = referral_code.strip()
+        res = await client.table("partners").select("id").eq("referral_code", code_clean).maybe_single().execute()
+        if res and res.data:
             partner_id = res.data["id"]
-            # 2. Привязываем к пользователю
-            supabase.table("users").update({"partner_id": partner_id}).eq("user_id", user_id).execute()
+            await client.table("users").update({"partner_id": partner_id}).eq("user_id", user_id).execute()
             logger.info(f"Пользователь {user_id} привязан к партнеру {referral_code} (ID: {partner_id})")
             return True
     except Exception as e:
         logger.error(f"Ошибка при привязке партнера: {e}")
     return False
 
-def get_manager_phone_for_user(user_id: int) -> str:
-    """
-    Возвращает номер телефона менеджера для конкретного пользователя.
-    Логика:
-    1. Если у юзера есть партнер И подписка партнера активна -> номер партнера.
-    2. Иначе -> дефолтный номер из конфига.
-    
-    💡 ИСПРАВЛЕНО 2026-02-25: Заменён ненадёжный PostgREST JOIN на два отдельных запроса.
-    Старый вариант с select("partner_id, partners(...)") ломался при сбросе PostgREST schema cache.
-    """
+
+async def get_manager_phone_for_user_async(user_id: int) -> str:
     default_phone = config.DEFAULT_MANAGER_PHONE
-    
     try:
-        # --- Шаг 1: Получаем partner_id пользователя ---
-        user_res = supabase.table("users").select("partner_id").eq("user_id", user_id).single().execute()
-        
+        client = await get_async_supabase()
+        user_res = await client.table("users").select("partner_id").eq("user_id", user_id).single().execute()
         if not user_res.data or not user_res.data.get("partner_id"):
             logger.debug(f"[PHONE] У пользователя {user_id} нет привязанного партнера. Отдаём дефолтный номер.")
             return default_phone
-        
+
         partner_id = user_res.data["partner_id"]
-        logger.debug(f"[PHONE] Пользователь {user_id} привязан к партнеру ID={partner_id}.")
-        
-        # --- Шаг 2: Получаем данные партнера отдельным запросом ---
-        partner_res = supabase.table("partners").select("phone_number, subscription_end_date").eq("id", partner_id).single().execute()
-        
+        partner_res = await client.table("partners").select("phone_number, subscription_end_date").eq("id", partner_id).single().execute()
         if not partner_res.data:
             logger.warning(f"[PHONE] Партнер ID={partner_id} не найден в таблице partners! Отдаём дефолтный номер.")
             return default_phone
-        
-        partner = partner_res.data
-        phone = partner.get("phone_number")
-        end_date_str = partner.get("subscription_end_date")
-        
-        logger.debug(f"[PHONE] Партнер ID={partner_id}: phone={phone}, subscription_end={end_date_str}")
-        
-        # 1. Если даты нет — считаем подписку бессрочной
-        if not end_date_str:
-            logger.info(f"[PHONE] Партнер ID={partner_id}: подписка бессрочная. Отдаём номер партнера: {phone}")
-            return phone or default_phone
-
-        # 2. Если дата есть — парсим её аккуратно
-        try:
-            end_date = datetime.fromisoformat(end_date_str.replace('Z', '+00:00'))
-        except ValueError:
-            end_date = datetime.fromisoformat(end_date_str)
-        
-        # Если дата "наивная" (без таймзоны), принудительно ставим UTC
-        if end_date.tzinfo is None:
-            end_date = end_date.replace(tzinfo=timezone.utc)
-
-        if end_date > datetime.now(timezone.utc):
-            logger.info(f"[PHONE] Партнер ID={partner_id}: подписка активна до {end_date_str}. Отдаём номер партнера: {phone}")
-            return phone or default_phone
-        else:
-            logger.info(f"[PHONE] Партнер ID={partner_id}: подписка ИСТЕКЛА {end_date_str}. Отдаём дефолтный номер.")
-    
+
+        return _phone_if_subscription_active(partner_id, partner_res.data, default_phone)
     except Exception as e:
         logger.error(f"[PHONE] Ошибка при получении номера менеджера для {user_id}: {e}", exc_info=True)
-    
     return default_phone
 
-# ==============================================================================
-# 2. ФУНКЦИИ LLM и УСКОРЕННЫЙ ПОИСК (ОСТАВЛЕНЫ БЕЗ ИЗМЕНЕНИЙ)
-# ==============================================================================
-def get_product_text_for_embedding(product_data: dict) -> str:
-    """
-    💡 ИСПРАВЛЕНО: Эта функция должна быть точной копией
-    аналогичной функции из embeddings.py для консистентности векторов.
-    """
-    name = product_data.get('name', '')
-    desc = product_data.get('description', '')
-    tags = product_data.get('search_tags', '')
-
-    combined_text = (f"Товар: {name}\nТеги для поиска: {tags}\nОписание: {desc}")
-    
-    # 💡 КРИТИЧЕСКОЕ ИЗМЕНЕНИЕ: Нормализация к нижнему регистру
-    return combined_text.lower()
-
 
-
-def embed_text(text: str):
-    """Получает эмбеддинг текста через OpenAI."""
-    normalized_text = text.lower()  
+async def get_catalog_terms_async() -> list:
+    """Названия и теги всех товаров (для лексикона локального классификатора)."""
+    client = await get_async_supabase()
+    rows, start, page_size = [], 0, 1000
+    while True:
+        res = await (client.table("products").select("id, name, search_tags")
+                     .order("id").range(start, start + page_size - 1).execute())
+        page = res.data or []
+        rows.extend(page)
+        if len(page) < page_size:
+            return rows
+        start += page_size
+
+
+async def embed_text_async(text: str):
+    normalized_text = text.lower()
+    cached = embedding_cache.get_vector(EMBED_MODEL, normalized_text)
+    if cached is not None:
+        return cached
     try:
-        response = openai_client.embeddings.create(
-            input = normalized_text,
-            model="text-embedding-3-small"
-        )
-        return response.data[0].embedding
+        response = await gateway.embed(normalized_text, EMBED_MODEL)
+        vector = response.data[0].embedding
+        embedding_cache.put_vector(EMBED_MODEL, normalized_text, vector)
+        return vector
     except Exception as e:
         logger.error(f"[EMBED] Ошибка генерации эмбеддинга: {e}")
         return None
 
 
-def search_product_chunks(query: str, top_k: int = 10):
-    """
-    Ищет релевантные ФРАГМЕНТЫ (chunks) в базе данных.
-    Возвращает список словарей, каждый из которых содержит `product_id` и `content`.
-    """
-    normalized_query = query.lower()
-    query_vector = embed_text(normalized_query)
+async def search_product_chunks_async(query: str, top_k: int = 10):
+    query_vector = await embed_text_async(query.lower())
     if not query_vector:
         return []
 
-    response = supabase.rpc(
+    if use_catalog_index():
+        return catalog_index.match_chunks(query_vector, top_k)
+
+    client = await get_async_supabase()
+    response = await client.rpc(
         "match_chunks",
-        {
-            "query_embedding": query_vector, 
-            "match_count": top_k
-        }
+        {"query_embedding": query_vector, "match_count": top_k}
     ).execute()
+    return response.data or []
 
-    if not response.data:
-        return []
-
-    return response.data
 
-def get_products_by_ids(product_ids: list) -> list:
-    """Получает полную информацию о товарах по списку их ID."""
+async def get_products_by_ids_async(product_ids: list) -> list:
     if not product_ids:
         return []
-    
-    response = supabase.rpc(
-        "get_products_by_ids", # Предполагается, что такая RPC функция создана
-        {"p_ids": product_ids}
-    ).execute()
-    
+    if use_catalog_index():
+        return catalog_index.get_products_by_ids(product_ids)
+    client = await get_async_supabase()
+    response = await client.rpc("get_products_by_ids", {"p_ids": product_ids}).execute()
     return response.data or []
 
-def search_products_by_price_range(price: float, price_range: float = 200.0) -> list:
-    """
-    Ищет товары в заданном ценовом диапазоне.
-    """
+
+async def search_products_by_price_range_async(price: float, price_range: float = 200.0) -> list:
     min_price = price - price_range
     max_price = price + price_range
-    
     logger.info(f"[DB] Ищу товары в диапазоне цен: {min_price} - {max_price}")
-    
     try:
-        response = (
-            supabase.table("products")
+        client = await get_async_supabase()
+        response = await (
+            client.table("products")
             .select("*")
             .gte("price", min_price)
             .lte("price", max_price)
-            .order("price", desc=False) # Сортируем от дешевых к дорогим
+            .order("price", desc=False)
             .execute()
         )
         products = response.data or []
@@ -294,105 +473,66 @@ def search_products_by_price_range(price: float, price_range: float = 200.0) ->
         logger.error(f"[DB] Ошибка при поиске по диапазону цен: {e}")
         return []
 
-def filter_products_by_category(query: str) -> list:
-    """
-    Извлекает категорию из запроса и ищет ВСЕ товары в этой категории.
-    Используется, когда основной поиск не дал результатов.
-    """
-    try:
-        # Просим LLM извлечь только категорию
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "Твоя задача - извлечь из запроса пользователя ОДНО слово, обозначающее категорию товара (например, 'шампунь', 'крем', 'чай', 'бальзам', 'капсулы'). Если категорию извлечь не удается, верни пустую строку."},
-                {"role": "user", "content": query}
-            ],
-            temperature=0
-        )
-        category = response.choices[0].message.content.strip().lower()
 
+async def keyword_search_products_async(search_terms: list) -> list:
+    """Товары, у которых КАЖДЫЙ терм входит в name или search_tags (RPC или локальный индекс)."""
+    if use_catalog_index():
+        return catalog_index.text_index.all_terms(search_terms)
+    client = await get_async_supabase()
+    response = await client.rpc("keyword_search_products", {"search_terms": search_terms}).execute()
+    return response.data or []
+
+
+async def filter_products_by_category_async(query: str, category: Optional[str] = None) -> list:
+    """Если категория уже известна (из разбора запроса), LLM повторно не вызывается."""
+    try:
+        if category is None:
+            category = await _extract_category_async(query)
         if not category:
             return []
 
         logger.info(f"[DB] Извлечена категория для широкого поиска: '{category}'")
-
-        # Ищем все товары, где название или теги содержат эту категорию
-        # Используем существующую RPC-функцию для поиска по ключевым словам.
-        keyword_products_response = supabase.rpc(
-            "keyword_search_products",
-            {"search_terms": [category]}
-        ).execute()
-
-        products = keyword_products_response.data or []
+        products = await keyword_search_products_async([category])
         logger.info(f"[DB] Широкий поиск нашел {len(products)} товаров в категории '{category}'.")
         return products
-
     except Exception as e:
         logger.error(f"[DB] Ошибка при широком поиске по категории: {e}")
         return []
 
 
+async def reformulate_query_with_llm_async(query: str) -> Optional[str]:
+    async def compute() -> str:
+        response = await gateway.chat(
+            model=LLM_HELPER_MODEL, messages=_helper_messages(REFORMULATE_PROMPT, query), temperature=0
+        )
+        return response.choices[0].message.content.strip()
 
-def reformulate_query_with_llm(query: str) -> Optional[str]:
-    """
-    Использует LLM для извлечения ключевых поисковых терминов из сложного запроса.
-    "Как принимать женьшень и krill oil" -> "женьшень, масло криля"
-    """
     try:
-        system_prompt = (
-            "Твоя задача — превратить запрос пользователя в простой и чистый поисковый запрос. "
-            "**Обязательно исправляй возможные опечатки в словах (например, 'шампун' -> 'шампунь', 'крил' -> 'криль').** "
-            "Извлеки только названия товаров, их компоненты или категории. "
-            "Также переводи иностранные названия на русский (например, 'krill oil' -> 'масло криля', 'ginseng' -> 'женьшень'). "
-            "Убери все лишние слова, такие как 'как принимать', 'сколько стоит', 'есть ли у вас'. "
-            "Результат верни в виде строки, где ключевые слова разделены запятой. "
-            "Если извлечь ключевые слова не удалось, верни пустую строку."
+        reformulated_query = await llm_cache.get_or_compute_async(
+            llm_cache.key("reformulate", LLM_HELPER_MODEL, REFORMULATE_PROMPT, query), compute
         )
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": query}
-            ],
-            temperature=0
-        )
-        reformulated_query = response.choices[0].message.content.strip()
         return reformulated_query if reformulated_query else None
     except Exception as e:
         logger.error(f"[DB] Ошибка при переформулировании запроса: {e}")
         return None
 
-def _get_clean_words(query: str) -> list[str]:
-    if not query: return []
-    """Разбивает запрос на слова и убирает стоп-слова."""
-    words = query.lower().replace(',', ' ').replace('.', ' ').split()
-    return [w for w in words if w not in STOPWORDS]
 
-def search_products_by_exact_match(query: str) -> list:
-    """
-    Ищет точное совпадение фразы в названии или тегах.
-    Приоритетный поиск для фраз типа 'жидкое иглоукалывание'.
-    """
+async def search_products_by_exact_match_async(query: str) -> list:
     try:
-        # Очищаем запрос от лишних символов, но оставляем пробелы
-        # 💡 УЛУЧШЕНИЕ: Убираем стоп-слова из начала фразы (например, "есть жидкое..." -> "жидкое...")
-        words = query.lower().split()
-        while words and words[0] in STOPWORDS:
-            words.pop(0)
-        
-        clean_query = " ".join(words).strip()
-
-        if not clean_query or len(clean_query) < 3:
+        clean_query = _exact_match_phrase(query)
+        if not clean_query:
             return []
-            
-        # 💡 ИЗМЕНЕНИЕ: Ищем фразу везде, включая ОПИСАНИЕ (description).
-        # Это позволит находить "L-теанин", даже если он есть только в тексте состава.
-        response = supabase.table("products").select("id, name, price, description, search_tags") \
-            .or_(f"name.ilike.%{clean_query}%,search_tags.ilike.%{clean_query}%,description.ilike.%{clean_query}%") \
-            .limit(10) \
-            .execute()
-        
-        data = response.data or []
+
+        if use_catalog_index():
+            data = catalog_index.text_index.exact_match(clean_query, limit=10)
+        else:
+            client = await get_async_supabase()
+            response = await client.table("products").select(EXACT_MATCH_COLUMNS) \
+                .or_(_exact_match_filter(clean_query)) \
+                .limit(10) \
+                .execute()
+            data = response.data or []
+
         if data:
             logger.info(f"[DB] ✅ Точный поиск нашел {len(data)} товаров по запросу '{clean_query}'")
         return data
@@ -400,79 +540,149 @@ def search_products_by_exact_match(query: str) -> list:
         logger.error(f"[DB] Ошибка при точном поиске: {e}")
         return []
 
-# --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ПОИСКА (RETRIEVERS) ---
 
-def _fetch_keyword_candidates(user_query: str) -> set:
-    """Ищет ID товаров по ключевым словам (леммы и исходные формы)."""
+async def _fetch_keyword_candidates_async(user_query: str) -> set:
     ids = set()
-    
-    # По исходным словам
     clean_words = _get_clean_words(user_query)
     if clean_words:
         try:
-            res_orig = supabase.rpc("keyword_search_products", {"search_terms": clean_words}).execute()
-            if res_orig.data:
-                ids.update(p['id'] for p in res_orig.data)
+            ids.update(p['id'] for p in await keyword_search_products_async(clean_words))
         except Exception as e:
             logger.warning(f"[DB] Ошибка поиска по словам: {e}")
-            
     return ids
 
+
+async def _run_retriever(name: str, timeout: float, coro):
+    """
+    Ожидает корутину ретривера с дедлайном.
+    Возвращает (name, result). При таймауте или ошибке result = None —
+    медленный источник просто выпадает из выдачи, а не блокирует весь поиск.
+    """
+    started = time.perf_counter()
+    try:
+        result = await asyncio.wait_for(coro, timeout)
+        status = "ok"
+    except asyncio.TimeoutError:
+        result, status = None, f"таймаут {timeout:.1f}с, отброшен"
+    except Exception as e:
+        result, status = None, f"ошибка: {e}"
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    logger.info(f"[SEARCH] ⏱ {name}: {elapsed_ms:.0f} мс ({status})")
+    return name, result
+
+
 # ⚙️ ГЛАВНАЯ ФУНКЦИЯ ПОИСКА (Refactored)
 async def search_products(user_query: str):
     """
     Модульный гибридный поиск:
     1. Retrieve: Сбор кандидатов из разных источников (Exact, Vector, Keywords).
-    2. Rank: (В будущем) Переранжирование. Сейчас - объединение.
+       Все ретриверы запускаются ОДНОВРЕМЕННО, у каждого свой дедлайн.
+       Загрузка карточек (hydration) стартует сразу, как только очередной ретривер вернул ID.
+    2. Rank: Слияние ранжированных списков ретриверов (взвешенный RRF, см. ranking.py),
+       схлопывание фрагментов по товару и отсечение хвоста по порогу оценки.
     """
     logger.info(f"🔎 Запуск поиска товаров по запросу: '{user_query}'")
-    
-    loop = asyncio.get_running_loop()
-    
-    # --- ЭТАП 1: СБОР КАНДИДАТОВ (RETRIEVAL) ---
-    
-    # 1. Точное совпадение (High Precision)
-    exact_products = await loop.run_in_executor(None, search_products_by_exact_match, user_query)
-    exact_ids = {p['id'] for p in exact_products}
-    
-    # 2. Векторный поиск по чанкам (High Recall)
-    chunks = await loop.run_in_executor(None, search_product_chunks, user_query, 10)
-    chunk_ids = {chunk['product_id'] for chunk in chunks}
-    
-    # 3. Ключевые слова (Backup)
-    # Запускаем только если точный поиск дал мало результатов, чтобы не шуметь
-    keyword_ids = set()
-    if len(exact_ids) < 2:
-        keyword_ids = await loop.run_in_executor(None, _fetch_keyword_candidates, user_query)
+    search_started = time.perf_counter()
+
+    # --- ЭТАП 1: СБОР КАНДИДАТОВ (RETRIEVAL) — параллельно ---
+    timeout = config.SEARCH_RETRIEVER_TIMEOUT
+    retrievers = [
+        # 1. Точное совпадение (High Precision)
+        _run_retriever("exact", timeout, search_products_by_exact_match_async(user_query)),
+        # 2. Векторный поиск по чанкам (High Recall): эмбеддинг + RPC match_chunks
+        _run_retriever("chunks", timeout, search_product_chunks_async(user_query, 10)),
+        # 3. Ключевые слова (Backup). Запускаем сразу, но учитываем,
+        # только если точный поиск дал мало результатов, чтобы не шуметь.
+        _run_retriever("keywords", timeout, _fetch_keyword_candidates_async(user_query)),
+    ]
+
+    exact_ids, chunk_ids, keyword_ids = set(), set(), set()
+    exact_order = []  # ID точного поиска в порядке выдачи (для рангов)
+    chunks = []
+    exact_done = False
+
+    requested_ids = set()
+    hydrate_tasks = []
+
+    def hydrate(ids: set):
+        """Запускает загрузку карточек для ещё не запрошенных ID, не дожидаясь остальных ретриверов."""
+        new_ids = ids - requested_ids
+        if not new_ids:
+            return
+        requested_ids.update(new_ids)
+        hydrate_tasks.append(asyncio.create_task(
+            _run_retriever(f"hydrate[{len(new_ids)}]", config.SEARCH_HYDRATE_TIMEOUT, get_products_by_ids_async(list(new_ids)))
+        ))
+
+    for next_done in asyncio.as_completed(retrievers):
+        name, result = await next_done
+
+        if name == "exact":
+            exact_order = [p['id'] for p in (result or [])]
+            exact_ids = set(exact_order)
+            exact_done = True
+            hydrate(exact_ids)
+            # Ключевые слова могли прийти раньше — теперь ясно, нужны ли они
+            if len(exact_ids) < 2:
+                hydrate(keyword_ids)
+        elif name == "chunks":
+            chunks = result or []
+            chunk_ids = {chunk['product_id'] for chunk in chunks}
+            hydrate(chunk_ids)
+        elif name == "keywords":
+            keyword_ids = result or set()
+            if exact_done and len(exact_ids) < 2:
+                hydrate(keyword_ids)
+
+    if len(exact_ids) >= 2:
+        keyword_ids = set()
 
     # --- ЭТАП 2: ОБЪЕДИНЕНИЕ И РАНЖИРОВАНИЕ (RANKING) ---
     
-    # Здесь можно подключить ReRanker (например, Cohere Rerank или FlashRank).
-    # Пока используем эвристику: Точные > Векторные > Ключевые.
-    
     all_ids = set()
     all_ids.update(exact_ids)
     all_ids.update(chunk_ids)
     all_ids.update(keyword_ids)
     
     if not all_ids:
+        logger.info(f"[SEARCH] ⏱ Итого: {(time.perf_counter() - search_started) * 1000:.0f} мс, ничего не найдено")
         return [], [] # Ничего не найдено
 
-    # Превращаем set в список для запроса к БД
-    final_ids_list = list(all_ids)
-    
-    # Получаем полные данные товаров
-    products_data = await loop.run_in_executor(None, get_products_by_ids, final_ids_list)
-    
-    # 💡 ПРОСТАЯ СОРТИРОВКА (Вместо ReRanker пока что):
-    # Поднимаем наверх те, что нашлись точным поиском
-    def sort_key(p):
-        if p['id'] in exact_ids: return 0 # Самый высокий приоритет
-        if p['id'] in chunk_ids: return 1
-        return 2
-        
-    sorted_products = sorted(products_data, key=sort_key)
+    # Дожидаемся уже запущенных загрузок полных данных товаров
+    products_by_id = {}
+    for _, rows in await asyncio.gather(*hydrate_tasks):
+        for p in rows or []:
+            products_by_id[p['id']] = p
+
+    # Взвешенный RRF по рангам ретриверов (точные > векторные > ключевые по весу),
+    # внутри векторного списка — порядок по similarity фрагментов
+    ranked, chunks = rank_candidates(
+        exact_order, chunks, keyword_ids,
+        k=config.SEARCH_RRF_K,
+        min_relative_score=config.SEARCH_MIN_RELATIVE_SCORE,
+        min_chunk_similarity=config.SEARCH_MIN_CHUNK_SIMILARITY,
+        max_results=config.SEARCH_MAX_RESULTS,
+        chunks_per_product=config.SEARCH_CHUNKS_PER_PRODUCT,
+    )
+
+    # Служебные поля для компактной сессии: откуда пришёл товар и его итоговая оценка
+    sorted_products = []
+    for r in ranked:
+        p = products_by_id.get(r.product_id)
+        if p is None:
+            continue  # Карточка не загрузилась (таймаут) — товар выпадает из выдачи
+        p['_source'] = r.source
+        p['_score'] = round(r.score, 6)
+        sorted_products.append(p)
+
+    # Необязательный cross-encoder поверх RRF, в пределах бюджета времени
+    if reranker is not None:
+        sorted_products = await reranker.rerank(user_query, sorted_products)
     
-    logger.info(f"[DB] 🏁 Найдено {len(sorted_products)} товаров. Топ-3 ID: {[p['id'] for p in sorted_products[:3]]}")
+    logger.info(f"[SEARCH] ⏱ Итого: {(time.perf_counter() - search_started) * 1000:.0f} мс "
+                f"(exact={len(exact_ids)}, chunks={len(chunk_ids)}, keywords={len(keyword_ids)})")
+    logger.info(f"[DB] 🏁 Найдено {len(sorted_products)} товаров. Топ-3: "
+                f"{[(p['id'], p['_source'], p['_score']) for p in sorted_products[:3]]}")
 
-    return sorted_products, chunks
\ No newline at end of file
+    return sorted_products, chunks
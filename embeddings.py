@@ -1,47 +1,46 @@
 # embeddings.py
 
-# ...existing code...
+import asyncio
 import logging
 import time
-from typing import List, Optional
+from typing import Callable, List, Optional
 
-from openai import OpenAI
-import config
-from supabase import create_client
+from postgrest import ReturnMethod
 # 💡 ИЗМЕНЕНИЕ: Импортируем общую функцию из db.py, чтобы избежать дублирования
-from db import get_product_text_for_embedding
+from db import get_product_text_for_embedding, embedding_content_hash, get_async_supabase, close_async_clients
+from rate_limit import TokenBucket, retry_async
+from openai_gateway import BACKGROUND, estimate_tokens, gateway
+from chunking import chunk_text, chunk_embedding_input
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-client = OpenAI(api_key=config.OPENAI_API_KEY)
-supabase = create_client(config.SUPABASE_URL, config.SUPABASE_KEY)
-
 EMBED_MODEL = "text-embedding-3-small" # 1536 dims
+TAGS_MODEL = "gpt-3.5-turbo"
+
+TAGS_PROMPT = (
+    "Ты — эксперт по продуктам Greenleaf. Твоя задача — извлечь из описания продукта ключевые слова и фразы для поиска. "
+    "Сгенерируй список из 5-10 релевантных тегов, разделенных запятыми. "
+    "Правила: "
+    "1. ОБЯЗАТЕЛЬНО включи в теги ключевые ингредиенты или компоненты, упомянутые в описании (например, 'чернослив', 'коллаген', 'витамин C'). "
+    "2. Включи категорию товара (например, 'напиток', 'крем', 'шампунь'). "
+    "3. Включи решаемую проблему (например, 'для иммунитета', 'от запоров', 'для сухой кожи'). "
+    "Пример результата: 'пребиотический напиток, жкт, чернослив, пищеварение, иммунитет, очищение организма, от запоров'."
+)
 
 
 def generate_search_tags(description: str) -> str:
     """
     Использует LLM для генерации плотных, релевантных ключевых слов и терминов.
     """
-    if not client or not description or len(description) < 20:
+    if not description or len(description) < 20:
         return ""
 
-    prompt = (
-        "Ты — эксперт по продуктам Greenleaf. Твоя задача — извлечь из описания продукта ключевые слова и фразы для поиска. "
-        "Сгенерируй список из 5-10 релевантных тегов, разделенных запятыми. "
-        "Правила: "
-        "1. ОБЯЗАТЕЛЬНО включи в теги ключевые ингредиенты или компоненты, упомянутые в описании (например, 'чернослив', 'коллаген', 'витамин C'). "
-        "2. Включи категорию товара (например, 'напиток', 'крем', 'шампунь'). "
-        "3. Включи решаемую проблему (например, 'для иммунитета', 'от запоров', 'для сухой кожи'). "
-        "Пример результата: 'пребиотический напиток, жкт, чернослив, пищеварение, иммунитет, очищение организма, от запоров'."
-    )
-
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
+        response = gateway.chat_sync(
+            model=TAGS_MODEL,
             messages=[
-                {"role": "system", "content": prompt},
+                {"role": "system", "content": TAGS_PROMPT},
                 # Отправляем LLM описание как есть, но на выходе нормализуем
                 {"role": "user", "content": description}
             ],
@@ -74,7 +73,7 @@ def embed_text(text: str) -> Optional[List[float]]:
     normalized_text = text.lower()
     
     try:
-        resp = client.embeddings.create(model=EMBED_MODEL, input=normalized_text)
+        resp = gateway.embed_sync(normalized_text, EMBED_MODEL)
         emb = _extract_embedding(resp)
         if not emb:
             logger.warning("Пустой embedding для текста: %r", normalized_text[:200])
@@ -83,107 +82,367 @@ def embed_text(text: str) -> Optional[List[float]]:
         logger.exception("Ошибка при создании эмбеддинга: %s", e)
         return None
 
-# 💡 ИЗМЕНЕНИЕ: Добавлен аргумент force_regenerate
-def backfill_product_embeddings(batch_size: int = 500, pause_between: float = 0.1, force_regenerate: bool = False):
-    
-    # ====================================================
-    # 1. ТАГГИРОВАНИЕ: Ищем товары без search_tags
-    # Теги теперь всегда сохраняются в нижнем регистре.
-    # ====================================================
-    # ... (Код Шага 1 остается прежним, кроме того, что generate_search_tags возвращает lower())
-    logger.info("--- ШАГ 1: ГЕНЕРАЦИЯ ТЕГОВ (search_tags) ---")
-    
-    tag_res = (
-        supabase.table("products")
-        .select("id,name,description")
-        .not_.is_("description", None)
-        .is_("search_tags", None)
-        .limit(batch_size)
-        .execute()
+
+
+# ====================================================
+# ПАКЕТНЫЙ КОНВЕЙЕР BACKFILL
+# Keyset-пагинация по всему каталогу, много текстов в одном запросе к
+# embeddings API, ограничение параллелизма и бюджета OpenAI (token bucket),
+# повтор с backoff и запись результатов пачкой (upsert) вместо update по строке.
+# Запросы к OpenAI идут через общий шлюз (openai_gateway.py) с фоновым приоритетом:
+# его бюджеты, повторы и предохранитель действуют поверх лимитов конвейера.
+# ====================================================
+
+PAGE_SIZE = 1000            # строк products за один keyset-запрос (лимит PostgREST по умолчанию)
+EMBED_BATCH_SIZE = 100      # текстов в одном запросе к embeddings API (лимит OpenAI — 2048)
+MAX_BATCH_TOKENS = 200_000  # запас до лимита ~300k токенов на запрос
+CHUNK_PAGE_SIZE = 200       # товаров на страницу шага 3: их фрагменты держатся в памяти одновременно
+
+
+class BackfillLimits:
+    """Общие ограничения конвейера: число одновременных запросов и бюджеты OpenAI в минуту."""
+
+    def __init__(self, concurrency: int, embed_rpm: float, embed_tpm: float, chat_rpm: float):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.embed_requests = TokenBucket.per_minute(embed_rpm)
+        self.embed_tokens = TokenBucket.per_minute(embed_tpm)
+        self.chat_requests = TokenBucket.per_minute(chat_rpm)
+
+
+async def _iter_product_pages(columns: str, apply_filters: Callable, page_size: int = PAGE_SIZE):
+    """Страницы products по keyset: WHERE id > last_id ORDER BY id LIMIT page_size (без OFFSET)."""
+    sb = await get_async_supabase()
+    last_id = 0
+    while True:
+        def fetch(after=last_id):
+            query = apply_filters(sb.table("products").select(columns))
+            return query.gt("id", after).order("id").limit(page_size).execute()
+
+        res = await retry_async(fetch, "чтение products")
+        page = res.data or []
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        last_id = page[-1]["id"]
+
+
+async def _bulk_upsert(rows: list, what: str) -> None:
+    """
+    Одна запись на пачку строк. В строках обязательно есть name: upsert — это
+    INSERT ... ON CONFLICT (id) DO UPDATE, а name объявлен NOT NULL.
+    Обновляются только переданные колонки.
+    """
+    if not rows:
+        return
+    sb = await get_async_supabase()
+    await retry_async(
+        lambda: sb.table("products").upsert(rows, on_conflict="id", returning=ReturnMethod.minimal).execute(),
+        what,
     )
-    items_to_tag = tag_res.data
-    logger.info("Найдено %d продуктов, требующих тегирования", len(items_to_tag))
-    
-    # ... (Цикл по items_to_tag остается прежним: tags = generate_search_tags(description) теперь возвращает lower())
-    for p in items_to_tag:
-        pid = p.get("id")
-        desc = p.get("description", "")
-        
-        # 1. Генерация тегов
-        tags = generate_search_tags(desc) 
-        
-        if not tags:
-            logger.warning("Пропускаем продукт %s — не удалось сгенерировать теги.", pid)
-            time.sleep(pause_between)
-            continue
-            
-        # 2. Обновление в Supabase
+
+
+async def generate_search_tags_async(description: str, limits: BackfillLimits) -> str:
+    """Асинхронная версия generate_search_tags с учётом лимитов конвейера."""
+    if not description or len(description) < 20:
+        return ""
+
+    try:
+        await limits.chat_requests.acquire()
+        response = await gateway.chat(
+            BACKGROUND,
+            model=TAGS_MODEL,
+            messages=[
+                {"role": "system", "content": TAGS_PROMPT},
+                {"role": "user", "content": description}
+            ],
+            temperature=0.0
+        )
+        return response.choices[0].message.content.strip().lower()
+    except Exception as e:
+        logger.error(f"⚠️ Ошибка LLM при генерации тегов: {e}")
+        return ""
+
+
+async def embed_texts_async(texts: List[str], limits: BackfillLimits) -> List[Optional[List[float]]]:
+    """Эмбеддинги для списка текстов ОДНИМ запросом. Порядок результата совпадает с texts."""
+    normalized = [t.lower() for t in texts]
+    tokens = sum(estimate_tokens(t) for t in normalized)
+
+    await limits.embed_requests.acquire()
+    await limits.embed_tokens.acquire(tokens)
+    resp = await gateway.embed(normalized, EMBED_MODEL, BACKGROUND)
+    vectors: List[Optional[List[float]]] = [None] * len(texts)
+    for item in resp.data:
+        vectors[item.index] = list(item.embedding)
+    return vectors
+
+
+def _split_batches(items: list, texts: list, batch_size: int) -> list:
+    """Режет страницу на пачки не больше batch_size текстов и MAX_BATCH_TOKENS токенов."""
+    batches, current, current_tokens = [], [], 0
+    for item, text in zip(items, texts):
+        tokens = estimate_tokens(text)
+        if current and (len(current) >= batch_size or current_tokens + tokens > MAX_BATCH_TOKENS):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append((item, text))
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+async def _tag_page(page: list, limits: BackfillLimits, stats: dict) -> None:
+    async def tag_one(p):
+        async with limits.semaphore:
+            return p, await generate_search_tags_async(p.get("description"), limits)
+
+    rows = []
+    for p, tags in await asyncio.gather(*(tag_one(p) for p in page)):
+        if tags:
+            rows.append({"id": p["id"], "name": p["name"], "search_tags": tags})
+        else:
+            logger.warning("Пропускаем продукт %s — не удалось сгенерировать теги.", p["id"])
+    try:
+        await _bulk_upsert(rows, f"запись тегов ({len(rows)} шт.)")
+        stats["tagged"] += len(rows)
+    except Exception as e:
+        logger.error("Ошибка пакетной записи тегов: %s", e)
+        stats["failed"] += len(rows)
+
+
+async def _embed_batch(batch: list, limits: BackfillLimits, stats: dict) -> None:
+    async with limits.semaphore:
+        products = [p for p, _ in batch]
         try:
-            upd = supabase.table("products").update({"search_tags": tags}).eq("id", pid).execute()
-            logger.info("Успешно обновлен search_tags для ID=%s: %s", pid, tags)
+            vectors = await embed_texts_async([text for _, text in batch], limits)
+            rows = [{"id": p["id"], "name": p["name"], "embedding": vec,
+                     "embedding_hash": embedding_content_hash(text, EMBED_MODEL)}
+                    for (p, text), vec in zip(batch, vectors) if vec]
+            stats["empty"] += len(products) - len(rows)
+            await _bulk_upsert(rows, f"запись эмбеддингов ({len(rows)} шт.)")
+            stats["embedded"] += len(rows)
+            logger.info("Эмбеддинги записаны: ID %s…%s (%d шт.)", products[0]["id"], products[-1]["id"], len(rows))
         except Exception as e:
-            logger.error("Ошибка обновления тега для ID=%s: %s", pid, e)# ... (код обновления)
-        time.sleep(pause_between)
-    
+            logger.error("Ошибка пачки эмбеддингов ID %s…%s: %s", products[0]["id"], products[-1]["id"], e)
+            stats["failed"] += len(products)
+
+
+async def _fetch_chunk_hashes(product_ids: list) -> dict:
+    """{product_id: [embedding_hash, ...]} текущих фрагментов в порядке id."""
+    sb = await get_async_supabase()
+    hashes, start = {}, 0
+    while True:
+        def fetch(offset=start):
+            return (sb.table("catalog_chunks").select("product_id,embedding_hash")
+                    .in_("product_id", product_ids)
+                    .order("id")
+                    .range(offset, offset + PAGE_SIZE - 1)
+                    .execute())
+
+        page = (await retry_async(fetch, "чтение хэшей фрагментов")).data or []
+        for row in page:
+            hashes.setdefault(row["product_id"], []).append(row.get("embedding_hash"))
+        if len(page) < PAGE_SIZE:
+            return hashes
+        start += PAGE_SIZE
+
+
+async def iter_product_chunks(apply_filters: Callable, page_size: int = CHUNK_PAGE_SIZE):
+    """
+    Потоковый генератор по каталогу: на каждую страницу товаров отдаёт список
+    (product, [(content, embedding_input, embedding_hash), ...], old_hashes).
+    В памяти одновременно только одна страница.
+    """
+    async for page in _iter_product_pages("id,name,description", apply_filters, page_size):
+        old_hashes = await _fetch_chunk_hashes([p["id"] for p in page])
+        items = []
+        for p in page:
+            chunks = []
+            for content in chunk_text(p.get("description") or ""):
+                embedding_input = chunk_embedding_input(p["name"], content)
+                chunks.append((content, embedding_input, embedding_content_hash(embedding_input, EMBED_MODEL)))
+            items.append((p, chunks, old_hashes.get(p["id"], [])))
+        yield items
+
+
+async def _embed_chunk_batch(batch: list, limits: BackfillLimits, stats: dict) -> None:
+    async with limits.semaphore:
+        try:
+            vectors = await embed_texts_async([text for _, text in batch], limits)
+            for (entry, _), vec in zip(batch, vectors):
+                entry["embedding"] = vec
+            stats["chunks_embedded"] += sum(1 for vec in vectors if vec)
+        except Exception as e:
+            logger.error("Ошибка пачки эмбеддингов фрагментов (%d шт.): %s", len(batch), e)
+
+
+async def _replace_chunks(plan: dict, limits: BackfillLimits, stats: dict) -> None:
+    async with limits.semaphore:
+        try:
+            sb = await get_async_supabase()
+            await retry_async(
+                lambda: sb.rpc("replace_product_chunks", {
+                    "p_product_id": plan["product_id"],
+                    "p_chunks": plan["chunks"],
+                }).execute(),
+                f"замена фрагментов товара {plan['product_id']}",
+            )
+            stats["chunked_products"] += 1
+            stats["chunks_written"] += len(plan["chunks"])
+        except Exception as e:
+            logger.error("Ошибка замены фрагментов товара %s: %s", plan["product_id"], e)
+            stats["failed"] += 1
+
+
+async def _chunk_page(items: list, limits: BackfillLimits, stats: dict,
+                      batch_size: int, force_regenerate: bool) -> None:
+    plans, to_embed = [], []
+    for product, chunks, old_hashes in items:
+        if not force_regenerate and [h for _, _, h in chunks] == old_hashes:
+            stats["chunks_skipped_products"] += 1
+            continue
+        # Вектор фрагмента с тем же хэшем RPC возьмёт из старой строки — считать заново не нужно
+        reusable = set() if force_regenerate else set(old_hashes)
+        plan = {"product_id": product["id"], "chunks": [], "needs": []}
+        for content, embedding_input, content_hash in chunks:
+            entry = {"content": content, "embedding": None, "embedding_hash": content_hash}
+            plan["chunks"].append(entry)
+            if content_hash in reusable:
+                stats["chunks_reused"] += 1
+            else:
+                plan["needs"].append(entry)
+                to_embed.append((entry, embedding_input))
+        plans.append(plan)
+
+    entries, texts = [e for e, _ in to_embed], [t for _, t in to_embed]
+    await asyncio.gather(*(_embed_chunk_batch(batch, limits, stats)
+                           for batch in _split_batches(entries, texts, batch_size)))
+
+    ready = []
+    for plan in plans:
+        # Не хватает вектора — старые фрагменты товара остаются до следующего запуска
+        if any(entry["embedding"] is None for entry in plan.pop("needs")):
+            logger.warning("Фрагменты товара %s не обновлены: не все эмбеддинги получены", plan["product_id"])
+            stats["failed"] += 1
+        else:
+            ready.append(plan)
+    await asyncio.gather(*(_replace_chunks(plan, limits, stats) for plan in ready))
+
+
+async def backfill_product_embeddings_async(force_regenerate: bool = False,
+                                            batch_size: int = EMBED_BATCH_SIZE,
+                                            concurrency: int = 4,
+                                            embed_rpm: float = 3000,
+                                            embed_tpm: float = 1_000_000,
+                                            chat_rpm: float = 500,
+                                            product_ids: Optional[List[int]] = None,
+                                            with_chunks: bool = True) -> dict:
+    """
+    Полный проход по каталогу: теги → эмбеддинги товаров → фрагменты (catalog_chunks).
+    product_ids ограничивает все шаги указанными товарами (инкрементальное обновление).
+    """
+    started = time.perf_counter()
+    limits = BackfillLimits(concurrency, embed_rpm, embed_tpm, chat_rpm)
+    # new — вектора ещё нет (или нет хэша), changed — текст/модель изменились,
+    # skipped — хэш совпал, пересчёт не нужен, empty — нечего векторизовать
+    stats = {"tagged": 0, "new": 0, "changed": 0, "skipped": 0, "empty": 0, "embedded": 0,
+             "chunked_products": 0, "chunks_skipped_products": 0, "chunks_written": 0,
+             "chunks_embedded": 0, "chunks_reused": 0, "failed": 0}
+
+    def scope(query):
+        return query.in_("id", product_ids) if product_ids else query
+
     # ====================================================
-    # 2. ЭМБЕДДИНГ: Ищем товары без embedding ИЛИ все товары (если --force)
+    # 1. ТАГГИРОВАНИЕ: товары с описанием, но без search_tags
+    # Теги всегда сохраняются в нижнем регистре.
+    # ====================================================
+    logger.info("--- ШАГ 1: ГЕНЕРАЦИЯ ТЕГОВ (search_tags) ---")
+    async for page in _iter_product_pages(
+        "id,name,description",
+        lambda q: scope(q.not_.is_("description", None).is_("search_tags", None)),
+    ):
+        logger.info("Тегирование: %d продуктов (ID %s…%s)", len(page), page[0]["id"], page[-1]["id"])
+        await _tag_page(page, limits, stats)
+
+    # ====================================================
+    # 2. ЭМБЕДДИНГ: только товары, у которых изменился хэш входа (модель + текст),
+    # или все товары (если --force)
     # ====================================================
     logger.info("--- ШАГ 2: РАСЧЕТ ЭМБЕДДИНГОВ (embedding) ---")
-    
-    query = supabase.table("products").select("id,name,description,price,images,search_tags,pv,embedding")
-    
-    if not force_regenerate:
-        # Обычный Backfill: ищем только те, у кого нет вектора
-        query = query.is_("embedding", None)
-        logger.info("Запущен режим BACKFILL: ищем только товары без эмбеддинга.")
-    else: 
-        # Полная регенерация: выбираем все
+    if force_regenerate:
         logger.warning("Запущен режим ПОЛНОЙ РЕГЕНЕРАЦИИ (force=True). Будут обновлены ВСЕ эмбеддинги.")
-    
-    # ЗАПРОС
-    res = query.limit(batch_size).execute()
-    items_to_embed = res.data 
-    logger.info("Найдено %d продуктов, требующих эмбеддинга", len(items_to_embed))
-    
-    for p in items_to_embed:
-        pid = p.get("id")
-        tags = p.get("search_tags", "")
-        
-        if not tags and not p.get("description"):
-            logger.warning("Пропускаем продукт %s — нет ни описания, ни тегов", pid)
-            continue
-        
-        try:
-            # 💡 КЛЮЧЕВОЕ ИЗМЕНЕНИЕ: Используем новую функцию для подготовки текста (с .lower())
-            combined_text = get_product_text_for_embedding(p)
-            
-            # embed_text также делает .lower() (двойная защита)
-            vec = embed_text(combined_text) 
-            
-            if not vec:
-                logger.warning("Пропускаем продукт %s — пустой вектор", pid)
+    else:
+        logger.info("Запущен режим BACKFILL: пересчитываем только новые и изменённые товары (по embedding_hash).")
+
+    async for page in _iter_product_pages("id,name,description,search_tags,embedding_hash", scope):
+        items, texts = [], []
+        for p in page:
+            if not p.get("search_tags") and not p.get("description"):
+                logger.warning("Пропускаем продукт %s — нет ни описания, ни тегов", p["id"])
+                stats["empty"] += 1
                 continue
-            
-            logger.info("ID=%s, vector length=%d", pid, len(vec))
-            upd = supabase.table("products").update({"embedding": vec}).eq("id", pid).execute()
-            # ... (обработка ошибок)
-            
-        except Exception as e:
-            logger.exception("Ошибка для продукта %s: %s", pid, e)
+            text = get_product_text_for_embedding(p)
+            stored_hash = p.get("embedding_hash")
+            if not stored_hash:
+                stats["new"] += 1
+            elif stored_hash != embedding_content_hash(text, EMBED_MODEL):
+                stats["changed"] += 1
+            elif not force_regenerate:
+                stats["skipped"] += 1
+                continue
+            items.append(p)
+            texts.append(text)
+        await asyncio.gather(*(_embed_batch(batch, limits, stats)
+                               for batch in _split_batches(items, texts, batch_size)))
+
+    # ====================================================
+    # 3. ФРАГМЕНТЫ: нарезка описаний, эмбеддинги пачками, атомарная замена
+    # фрагментов товара (RPC replace_product_chunks). Товары, у которых набор
+    # фрагментов не изменился, пропускаются.
+    # ====================================================
+    if with_chunks:
+        logger.info("--- ШАГ 3: ФРАГМЕНТЫ ДЛЯ RAG (catalog_chunks) ---")
+        async for items in iter_product_chunks(scope):
+            await _chunk_page(items, limits, stats, batch_size, force_regenerate)
+
+    stats["seconds"] = round(time.perf_counter() - started, 1)
+    logger.info("Backfill завершён: %s", stats)
+    return stats
+
+
+def backfill_product_embeddings(**kwargs) -> dict:
+    """Синхронная точка входа для скриптов: запускает конвейер в собственном event loop."""
+    async def run():
+        try:
+            return await backfill_product_embeddings_async(**kwargs)
         finally:
-            time.sleep(pause_between)
-            
+            await close_async_clients()
+
+    return asyncio.run(run())
+
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument("--batch", type=int, default=100, help="Размер батча для backfill")
-    parser.add_argument("--pause", type=float, default=0.1, help="Пауза между запросами (с)")
-    # 💡 НОВЫЙ АРГУМЕНТ
-    parser.add_argument("--force", action='store_true', help="Принудительно перегенерировать ВСЕ эмбеддинги.") 
+    parser.add_argument("--batch", type=int, default=EMBED_BATCH_SIZE, help="Текстов в одном запросе к embeddings API")
+    parser.add_argument("--concurrency", type=int, default=4, help="Одновременных запросов к OpenAI")
+    parser.add_argument("--rpm", type=float, default=3000, help="Лимит запросов эмбеддингов в минуту")
+    parser.add_argument("--tpm", type=float, default=1_000_000, help="Лимит токенов эмбеддингов в минуту")
+    parser.add_argument("--chat-rpm", type=float, default=500, help="Лимит запросов генерации тегов в минуту")
+    parser.add_argument("--force", action='store_true', help="Принудительно перегенерировать ВСЕ эмбеддинги.")
+    parser.add_argument("--product", type=int, action="append", help="Обновить только указанный товар (можно несколько раз)")
+    parser.add_argument("--no-chunks", action="store_true", help="Не пересобирать фрагменты catalog_chunks")
     args = parser.parse_args()
-    
+
     backfill_product_embeddings(
-        batch_size=args.batch, 
-        pause_between=args.pause,
-        force_regenerate=args.force # Передаем аргумент
-    )
\ No newline at end of file
+        force_regenerate=args.force,
+        batch_size=args.batch,
+        concurrency=args.concurrency,
+        embed_rpm=args.rpm,
+        embed_tpm=args.tpm,
+        chat_rpm=args.chat_rpm,
+        product_ids=args.product,
+        with_chunks=not args.no_chunks,
+    )
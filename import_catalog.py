@@ -0,0 +1,475 @@
+# import_catalog.py
+# Импорт каталога из выгрузки Google Sheet (CSV / XLSX) в таблицу products.
+# Файл читается построчно, строки валидируются и нормализуются, затем
+# сравниваются с текущей таблицей по названию товара (естественный ключ).
+# В базу уходят только вставки, изменения и удаления — пачками.
+# Изменённые товары ставятся в очередь на теги и эмбеддинги (embeddings.py).
+#
+#   python import_catalog.py catalog.csv --dry-run
+#   python import_catalog.py catalog.xlsx
+#   python import_catalog.py --url "<ссылка на выгрузку>"       (по умолчанию config.GOOGLE_SHEET_URL)
+#   python import_catalog.py catalog.csv --dsn postgresql://localhost/greenleaf   (локальный Postgres, нужен psycopg)
+
+import asyncio
+import csv
+import json
+import logging
+import os
+import re
+import tempfile
+from typing import Iterator, List, Optional, Tuple
+
+import httpx
+
+import config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+WRITE_BATCH_SIZE = 500
+FETCH_PAGE_SIZE = 1000
+IMPORT_COLUMNS = ("name", "description", "price", "pv", "images")
+# search_tags читается, чтобы в пачке обновлений у всех строк был одинаковый набор колонок
+FETCH_COLUMNS = ("id",) + IMPORT_COLUMNS + ("search_tags",)
+
+# Заголовки колонок в таблице → поля products
+HEADER_ALIASES = {
+    "name": ("name", "название", "наименование", "товар", "продукт"),
+    "description": ("description", "описание"),
+    "price": ("price", "цена", "стоимость"),
+    "pv": ("pv", "баллы", "бонусы"),
+    "images": ("images", "image", "изображения", "изображение", "фото", "картинка", "картинки"),
+}
+
+_PRICE_JUNK = re.compile(r"[^\d,.\-]")
+_URL = re.compile(r"https?://[^\s,;\"'\]]+")
+
+
+class RowError(ValueError):
+    """Строка файла не прошла валидацию — пропускается с предупреждением."""
+
+
+# ------------------------------------------------------------------
+# НОРМАЛИЗАЦИЯ
+# ------------------------------------------------------------------
+
+def natural_key(name: str) -> str:
+    return " ".join((name or "").split()).casefold()
+
+
+def normalize_price(value) -> Optional[float]:
+    """'1 990 ₸', '1990,50', 1990 → число. Пусто → None."""
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    if isinstance(value, (int, float)):
+        number = float(value)
+    else:
+        text = _PRICE_JUNK.sub("", str(value).replace(" ", ""))
+        if text.count(",") == 1 and "." not in text:
+            text = text.replace(",", ".")
+        text = text.replace(",", "")
+        try:
+            number = float(text)
+        except ValueError:
+            raise RowError(f"некорректная цена: {value!r}")
+    if number < 0:
+        raise RowError(f"отрицательная цена: {value!r}")
+    return int(number) if number.is_integer() else round(number, 2)
+
+
+def normalize_pv(value) -> Optional[int]:
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    try:
+        return int(round(float(str(value).replace(",", ".").replace(" ", ""))))
+    except ValueError:
+        raise RowError(f"некорректные баллы PV: {value!r}")
+
+
+def normalize_images(value) -> Optional[str]:
+    """Любой список ссылок (через запятую, перенос строки, JSON) → JSON-массив строкой, как читает bot.py."""
+    if value is None:
+        return None
+    urls = _URL.findall(str(value))
+    if not urls:
+        return None
+    return json.dumps(list(dict.fromkeys(urls)), ensure_ascii=False)
+
+
+def _normalize_text(value) -> Optional[str]:
+    text = str(value).strip() if value is not None else ""
+    return text or None
+
+
+def normalize_row(raw: dict) -> dict:
+    name = " ".join(str(raw.get("name") or "").split())
+    if not name:
+        raise RowError("нет названия")
+    return {
+        "name": name,
+        "description": _normalize_text(raw.get("description")),
+        "price": normalize_price(raw.get("price")),
+        "pv": normalize_pv(raw.get("pv")),
+        "images": normalize_images(raw.get("images")),
+    }
+
+
+def _comparable(row: dict) -> tuple:
+    """Значения, по которым сравниваются строки файла и таблицы."""
+    price = row.get("price")
+    return (
+        row.get("name"),
+        _normalize_text(row.get("description")),
+        float(price) if price is not None else None,
+        row.get("pv"),
+        normalize_images(row.get("images")),
+    )
+
+
+# ------------------------------------------------------------------
+# ЧТЕНИЕ ФАЙЛА (построчно)
+# ------------------------------------------------------------------
+
+def _map_header(header: list) -> dict:
+    """{индекс колонки: поле products} по заголовку файла."""
+    mapping = {}
+    for index, title in enumerate(header):
+        title = natural_key(str(title or ""))
+        for field, aliases in HEADER_ALIASES.items():
+            if title in aliases and field not in mapping.values():
+                mapping[index] = field
+    if "name" not in mapping.values():
+        raise ValueError(f"В заголовке нет колонки с названием товара: {header}")
+    return mapping
+
+
+def _iter_csv(path: str) -> Iterator[list]:
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        sample = f.read(8192)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        yield from csv.reader(f, dialect)
+
+
+def _iter_xlsx(path: str) -> Iterator[list]:
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise RuntimeError("Для XLSX нужен пакет openpyxl: pip install openpyxl (или выгрузите таблицу в CSV)")
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for row in workbook.active.iter_rows(values_only=True):
+            yield list(row)
+    finally:
+        workbook.close()
+
+
+def iter_catalog_rows(path: str) -> Iterator[Tuple[int, dict]]:
+    """(номер строки, сырые поля) — файл не загружается в память целиком."""
+    rows = _iter_xlsx(path) if path.lower().endswith((".xlsx", ".xlsm")) else _iter_csv(path)
+    mapping = None
+    for line_no, values in enumerate(rows, start=1):
+        if not any(v not in (None, "") for v in values):
+            continue
+        if mapping is None:
+            mapping = _map_header(values)
+            continue
+        yield line_no, {field: values[i] for i, field in mapping.items() if i < len(values)}
+
+
+def download_export(url: str) -> str:
+    """
+    Скачивает выгрузку во временный файл (удаляет вызывающий). Ссылки Google Drive / Sheets
+    превращаются в прямые. При ошибке загрузки недокачанный файл удаляется здесь же.
+    """
+    sheet = re.search(r"docs\.google\.com/spreadsheets/d/([\w-]+)", url)
+    drive = re.search(r"drive\.google\.com/file/d/([\w-]+)", url)
+    if sheet:
+        url = f"https://docs.google.com/spreadsheets/d/{sheet.group(1)}/export?format=csv"
+    elif drive:
+        url = f"https://drive.google.com/uc?export=download&id={drive.group(1)}"
+
+    with httpx.stream("GET", url, follow_redirects=True, timeout=60) as response:
+        response.raise_for_status()
+        content_type = response.headers.get("content-type", "").lower()
+        if "csv" in content_type:
+            suffix = ".csv"
+        elif "spreadsheetml" in content_type:
+            suffix = ".xlsx"
+        else:
+            # Например, HTML-страница Google Drive (нет доступа по ссылке или предупреждение о проверке на вирусы)
+            raise RuntimeError(f"По ссылке не CSV/XLSX-выгрузка (content-type: {content_type or 'не указан'}). "
+                               f"Откройте доступ к таблице по ссылке или скачайте файл и передайте путь к нему.")
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for block in response.iter_bytes():
+                    f.write(block)
+        except BaseException:
+            os.remove(path)
+            raise
+    logger.info("Выгрузка скачана: %s", path)
+    return path
+
+
+# ------------------------------------------------------------------
+# ХРАНИЛИЩА (Supabase или локальный Postgres)
+# ------------------------------------------------------------------
+
+class SupabaseCatalogStore:
+    """Таблица products через асинхронный клиент Supabase (db.get_async_supabase)."""
+
+    supports_embeddings = True
+
+    async def _client(self):
+        from db import get_async_supabase
+        return await get_async_supabase()
+
+    async def fetch_all(self) -> list:
+        client = await self._client()
+        rows, last_id = [], 0
+        while True:
+            res = await (client.table("products").select(", ".join(FETCH_COLUMNS))
+                         .gt("id", last_id).order("id").limit(FETCH_PAGE_SIZE).execute())
+            page = res.data or []
+            rows.extend(page)
+            if len(page) < FETCH_PAGE_SIZE:
+                return rows
+            last_id = page[-1]["id"]
+
+    async def insert(self, rows: list) -> List[int]:
+        client = await self._client()
+        res = await client.table("products").insert(rows).execute()
+        return [r["id"] for r in res.data or []]
+
+    async def update(self, rows: list) -> None:
+        # upsert по id обновляет только переданные колонки
+        client = await self._client()
+        await client.table("products").upsert(rows, on_conflict="id").execute()
+
+    async def delete(self, ids: list) -> None:
+        client = await self._client()
+        await client.table("products").delete().in_("id", ids).execute()
+
+    async def close(self) -> None:
+        from db import close_async_clients
+        await close_async_clients()
+
+
+class PostgresCatalogStore:
+    """Прямое подключение к Postgres (локальная база для проверки импорта офлайн). Нужен psycopg 3."""
+
+    supports_embeddings = False
+
+    def __init__(self, dsn: str):
+        try:
+            import psycopg
+        except ImportError:
+            raise RuntimeError("Для --dsn нужен пакет psycopg: pip install 'psycopg[binary]'")
+        self._psycopg = psycopg
+        self._dsn = dsn
+        self._conn = None
+
+    async def _connection(self):
+        if self._conn is None:
+            self._conn = await self._psycopg.AsyncConnection.connect(self._dsn, autocommit=True)
+        return self._conn
+
+    async def fetch_all(self) -> list:
+        conn = await self._connection()
+        async with conn.cursor() as cur:
+            await cur.execute(f"select {', '.join(FETCH_COLUMNS)} from public.products order by id")
+            columns = [c.name for c in cur.description]
+            return [dict(zip(columns, row)) for row in await cur.fetchall()]
+
+    async def insert(self, rows: list) -> List[int]:
+        conn = await self._connection()
+        ids = []
+        async with conn.transaction(), conn.cursor() as cur:
+            for row in rows:
+                await cur.execute(
+                    f"insert into public.products ({', '.join(row)}) values ({', '.join(['%s'] * len(row))}) returning id",
+                    list(row.values()),
+                )
+                ids.append((await cur.fetchone())[0])
+        return ids
+
+    async def update(self, rows: list) -> None:
+        conn = await self._connection()
+        async with conn.transaction(), conn.cursor() as cur:
+            for row in rows:
+                fields = [f for f in row if f != "id"]
+                await cur.execute(
+                    f"update public.products set {', '.join(f'{f} = %s' for f in fields)} where id = %s",
+                    [row[f] for f in fields] + [row["id"]],
+                )
+
+    async def delete(self, ids: list) -> None:
+        conn = await self._connection()
+        await conn.execute("delete from public.products where id = any(%s)", (ids,))
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            await self._conn.close()
+
+
+# ------------------------------------------------------------------
+# СРАВНЕНИЕ И ПРИМЕНЕНИЕ
+# ------------------------------------------------------------------
+
+class ImportPlan:
+    def __init__(self):
+        self.inserts: list = []
+        self.updates: list = []
+        self.deletes: list = []
+        self.unchanged = 0
+        self.errors = 0
+        self.duplicates = 0
+
+    def summary(self) -> dict:
+        return {
+            "insert": len(self.inserts),
+            "update": len(self.updates),
+            "delete": len(self.deletes),
+            "unchanged": self.unchanged,
+            "errors": self.errors,
+            "duplicates": self.duplicates,
+        }
+
+
+def build_plan(file_rows: Iterator[Tuple[int, dict]], existing: list) -> ImportPlan:
+    plan = ImportPlan()
+
+    current = {}
+    for row in existing:
+        key = natural_key(row.get("name"))
+        if key in current:
+            logger.warning("В таблице дубль названия '%s' (ID %s и %s) — лишняя строка будет удалена",
+                           row.get("name"), current[key]["id"], row["id"])
+            plan.deletes.append(row["id"])
+            continue
+        current[key] = row
+
+    seen = set()
+    for line_no, raw in file_rows:
+        try:
+            row = normalize_row(raw)
+        except RowError as e:
+            logger.warning("Строка %d пропущена: %s", line_no, e)
+            plan.errors += 1
+            continue
+        key = natural_key(row["name"])
+        if key in seen:
+            logger.warning("Строка %d пропущена: товар '%s' уже встречался в файле", line_no, row["name"])
+            plan.duplicates += 1
+            continue
+        seen.add(key)
+
+        old = current.get(key)
+        if old is None:
+            plan.inserts.append(row)
+        elif _comparable(row) != _comparable(old):
+            # Описание изменилось — теги нужно сгенерировать заново (шаг 1 embeddings.py)
+            description_changed = _normalize_text(old.get("description")) != row["description"]
+            plan.updates.append({"id": old["id"], **row,
+                                 "search_tags": None if description_changed else old.get("search_tags")})
+        else:
+            plan.unchanged += 1
+
+    plan.deletes.extend(row["id"] for key, row in current.items() if key not in seen)
+    return plan
+
+
+def _batches(items: list, size: int = WRITE_BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+async def apply_plan(store, plan: ImportPlan, allow_delete: bool = True) -> List[int]:
+    """Применяет план пачками. Возвращает ID вставленных и изменённых товаров (очередь на эмбеддинги)."""
+    changed_ids = []
+    for batch in _batches(plan.inserts):
+        changed_ids.extend(await store.insert(batch))
+        logger.info("Добавлено товаров: %d", len(batch))
+    for batch in _batches(plan.updates):
+        await store.update(batch)
+        changed_ids.extend(row["id"] for row in batch)
+        logger.info("Обновлено товаров: %d", len(batch))
+    if allow_delete:
+        for batch in _batches(plan.deletes):
+            await store.delete(batch)
+            logger.info("Удалено товаров: %d", len(batch))
+    elif plan.deletes:
+        logger.info("Удаление отключено: %d товаров нет в файле, но они остаются в таблице", len(plan.deletes))
+    return changed_ids
+
+
+async def import_catalog(path: str, store, dry_run: bool = False, allow_delete: bool = True,
+                         max_delete_ratio: float = 0.5, embed: bool = True) -> dict:
+    existing = await store.fetch_all()
+    plan = build_plan(iter_catalog_rows(path), existing)
+    summary = plan.summary()
+    logger.info("План импорта: %s", summary)
+
+    # Защита от обрезанной / не той выгрузки: не удаляем большую часть каталога
+    if allow_delete and existing and len(plan.deletes) > max_delete_ratio * len(existing):
+        raise RuntimeError(f"Импорт удалил бы {len(plan.deletes)} из {len(existing)} товаров. "
+                           f"Проверьте файл или запустите с --max-delete-ratio / --no-delete.")
+    if dry_run:
+        for row in plan.inserts[:20]:
+            logger.info("  + %s", row["name"])
+        for row in plan.updates[:20]:
+            logger.info("  ~ [%s] %s", row["id"], row["name"])
+        logger.info("Режим --dry-run: изменения не применены.")
+        return summary
+
+    changed_ids = await apply_plan(store, plan, allow_delete)
+    summary["queued_for_embedding"] = len(changed_ids)
+    if changed_ids and embed:
+        if store.supports_embeddings:
+            from embeddings import backfill_product_embeddings_async
+            # ID уходят в фильтр in_() строкой запроса — пачками, чтобы не упереться в длину URL
+            totals = {}
+            for batch in _batches(changed_ids):
+                stats = await backfill_product_embeddings_async(product_ids=batch)
+                for name, value in stats.items():
+                    totals[name] = totals.get(name, 0) + value
+            summary["embeddings"] = totals
+        else:
+            logger.info("Эмбеддинги для локальной базы не считаются. Изменённые товары: %s", changed_ids)
+    return summary
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Импорт каталога из CSV/XLSX-выгрузки в products")
+    parser.add_argument("path", nargs="?", help="Локальный файл .csv / .xlsx")
+    parser.add_argument("--url", help="Скачать выгрузку по ссылке (по умолчанию config.GOOGLE_SHEET_URL)")
+    parser.add_argument("--dsn", help="Строка подключения к Postgres вместо Supabase (нужен psycopg)")
+    parser.add_argument("--dry-run", action="store_true", help="Только показать план изменений")
+    parser.add_argument("--no-delete", action="store_true", help="Не удалять товары, которых нет в файле")
+    parser.add_argument("--max-delete-ratio", type=float, default=0.5, help="Максимальная доля удаляемых товаров")
+    parser.add_argument("--no-embed", action="store_true", help="Не запускать теги и эмбеддинги для изменённых товаров")
+    args = parser.parse_args()
+
+    source = args.path or download_export(args.url or config.GOOGLE_SHEET_URL)
+    catalog_store = PostgresCatalogStore(args.dsn) if args.dsn else SupabaseCatalogStore()
+
+    async def run():
+        try:
+            return await import_catalog(
+                source, catalog_store,
+                dry_run=args.dry_run,
+                allow_delete=not args.no_delete,
+                max_delete_ratio=args.max_delete_ratio,
+                embed=not args.no_embed,
+            )
+        finally:
+            await catalog_store.close()
+            if not args.path:  # Временный файл, скачанный download_export
+                os.remove(source)
+
+    logger.info("Импорт завершён: %s", asyncio.run(run()))
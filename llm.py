@@ -1,9 +1,13 @@
-from openai import OpenAI
 import config
 import json 
 import logging
+from typing import Optional
+
+from cache import normalize_query_text
+from context_builder import build_context
+from llm_cache import llm_cache
+from openai_gateway import BACKGROUND, INTERACTIVE, gateway
 
-client = OpenAI(api_key=config.OPENAI_API_KEY)
 CHAT_MODEL = "gpt-4o-mini"  # 💡 Более быстрая и экономичная модель
 
 # Настраиваем логирование, чтобы видеть ошибки
@@ -83,93 +87,220 @@ PRODUCT_QUERY_CLASSIFIER = """
 """
 
 
+# ==============================================================================
+# 2.1. ПРОМТ "ПОНИМАНИЯ ЗАПРОСА" (understand_query_async)
+# Один вызов вместо is_product_query + reformulate_query_with_llm + извлечения категории.
+# ==============================================================================
+
+QUERY_UNDERSTANDING_PROMPT = PRODUCT_QUERY_CLASSIFIER.replace(
+    'Ответь СТРОГО в формате JSON, используя только схему: {"is_product_query": true/false}.',
+    ""
+) + """
+Дополнительно разбери запрос для поиска по каталогу:
+- "keywords": простой поисковый запрос — только названия товаров, компоненты или категории через запятую. Исправляй опечатки ('шампун' -> 'шампунь'), переводи иностранные названия на русский ('krill oil' -> 'масло криля'), убирай лишние слова ('как принимать', 'сколько стоит'). Если не удалось — пустая строка.
+- "category": ОДНО слово — категория товара ('шампунь', 'крем', 'чай', 'бальзам', 'капсулы'), иначе пустая строка.
+- "price": цена из запроса числом (например, 5000), иначе null.
+- "is_clarification": true, если это уточнение по ранее показанному списку товаров ('а второй?', 'подробнее о нем').
+
+Ответь СТРОГО в формате JSON по схеме:
+{"is_product_query": true/false, "keywords": "...", "category": "...", "price": число или null, "is_clarification": true/false}
+"""
+
+
 # ==============================================================================
 # 3. ФУНКЦИИ БИЗНЕС-ЛОГИКИ
 # ==============================================================================
 
 def build_context_snippet(products: list, chunks: list) -> str:
-    """Собирает контекст из найденных фрагментов для передачи в LLM."""
-    if not products and not chunks:
-        return "Контекст из каталога: (ничего релевантного не найдено)."
-
-    # Создаем словарь для быстрого доступа к данным товаров по ID
-    product_map = {p['id']: p for p in products}
-
-    lines = []
-
-    # Сначала добавляем информацию о найденных товарах
-    if products:
-        lines.append("--- Найденные товары (по названию или тегам) ---")
-        for p in products[:15]: # 💡 РАСШИРЯЕМ ЛИМИТ до 15 товаров
-            price_info = ""
-            if p.get("price"):
-                price_info = f"\nЦена: {p['price']} тг"
-            
-            lines.append(f"Товар: {p.get('name', '')}{price_info}\nТеги: {p.get('search_tags', '')}\nОписание: {p.get('description', '')[:800]}...")
-
-    # Затем добавляем наиболее релевантные фрагменты, если они есть
-    if chunks:
-        # Отсекаем совсем нерелевантные фрагменты
-        relevant_chunks = [c for c in chunks if c.get('similarity', 0) > 0.2]
-        if relevant_chunks:
-            lines.append("\n--- Релевантные фрагменты из описаний (найдены по смыслу) ---")
-            for i, chunk in enumerate(relevant_chunks[:5]): # 💡 РАСШИРЯЕМ ЛИМИТ до 5 фрагментов
-                product_id = chunk.get('product_id')
-                product = product_map.get(product_id)
-
-                if not product: continue
-
-                content = chunk.get('content', '').strip()
-                line = (f"Фрагмент #{i+1} для товара '{product.get('name', '')}' (релевантность: {chunk.get('similarity', 0):.2f}):\n"
-                        f"\"{content}\"")
-                lines.append(line)
-
-    return "Контекст из каталога (наиболее релевантные фрагменты):\n" + "\n".join(lines)
-
-
-def build_history_messages(history_rows: list):
+    """
+    Собирает контекст из найденных товаров и фрагментов для передачи в LLM
+    в пределах бюджета токенов (см. context_builder.py).
+    """
+    context, report = build_context(
+        products, chunks,
+        budget_tokens=config.CONTEXT_TOKEN_BUDGET,
+        description_tokens=config.CONTEXT_DESCRIPTION_TOKENS,
+    )
+    logging.info(f"[CONTEXT] Контекст: {report}")
+    return context
+
+
+def build_history_messages(history_rows: list, history_summary: str = ""):
     msgs = []
+    if history_summary:
+        # Старая часть диалога приходит сжатой (см. conversation_memory.py)
+        msgs.append({"role": "system", "content": f"Краткое содержание предыдущего диалога с клиентом:\n{history_summary}"})
     for row in history_rows:
         msgs.append({"role": row["role"], "content": row["content"]})
     return msgs
 
 
 # --- ФУНКЦИЯ БУЛЕВОЙ КЛАССИФИКАЦИИ ---
+# Ответы детерминированы (temperature=0), поэтому кэшируются в llm_cache по промту и тексту запроса.
+
+def _classifier_messages(text: str) -> list:
+    return [
+        {"role": "system", "content": PRODUCT_QUERY_CLASSIFIER}, 
+        {"role": "user", "content": f"ЗАПРОС: \"{normalize_query_text(text)}\""}
+    ]
+
+
+def _classifier_key(text: str) -> str:
+    return llm_cache.key("is_product_query", CHAT_MODEL, PRODUCT_QUERY_CLASSIFIER, text)
+
 
 def is_product_query(text: str) -> bool:
     """
     Проверяет, относится ли сообщение к поиску товаров (возвращает True/False).
     Это замена для get_query_type.
     """
-    normalized_text = text.strip().lower()
-    try:
-        response = client.chat.completions.create(
+    def compute() -> bool:
+        response = gateway.chat_sync(
             model=CHAT_MODEL,
-            messages=[
-                {"role": "system", "content": PRODUCT_QUERY_CLASSIFIER}, 
-                {"role": "user", "content": f"ЗАПРОС: \"{normalized_text}\""}
-            ],
+            messages=_classifier_messages(text),
             temperature=0,
             response_format={"type": "json_object"}
         )
-        
         # Надежный парсинг JSON
         result = json.loads(response.choices[0].message.content.strip())
-        return result.get("is_product_query", False)
-        
+        return bool(result.get("is_product_query", False))
+
+    try:
+        return llm_cache.get_or_compute(_classifier_key(text), compute)
     except Exception as e:
         logging.error(f"Ошибка классификации запроса: {e}")
         return False 
 
 
+async def is_product_query_async(text: str, priority: int = INTERACTIVE) -> bool:
+    """Асинхронная версия is_product_query (без занятия потока). priority — очередь в openai_gateway."""
+    async def compute() -> bool:
+        response = await gateway.chat(
+            priority,
+            model=CHAT_MODEL,
+            messages=_classifier_messages(text),
+            temperature=0,
+            response_format={"type": "json_object"}
+        )
+        result = json.loads(response.choices[0].message.content.strip())
+        return bool(result.get("is_product_query", False))
+
+    try:
+        return await llm_cache.get_or_compute_async(_classifier_key(text), compute)
+    except Exception as e:
+        logging.error(f"Ошибка классификации запроса: {e}")
+        return False
+
+
+# --- РАЗБОР ЗАПРОСА ОДНИМ ВЫЗОВОМ ---
+
+def _parse_understanding(raw: dict) -> dict:
+    price = raw.get("price")
+    try:
+        price = float(price) if price not in (None, "") else None
+    except (TypeError, ValueError):
+        price = None
+    return {
+        "is_product_query": bool(raw.get("is_product_query", False)),
+        "keywords": str(raw.get("keywords") or "").strip(),
+        "category": str(raw.get("category") or "").strip().lower(),
+        "price": price,
+        "is_clarification": bool(raw.get("is_clarification", False)),
+    }
+
+
+async def understand_query_async(text: str) -> Optional[dict]:
+    """
+    Разбирает запрос одним структурированным вызовом LLM:
+    {is_product_query, keywords, category, price, is_clarification}.
+    Результат кэшируется в llm_cache по нормализованному тексту. None — если вызов не удался
+    (тогда вызывающий код использует отдельные функции, как раньше).
+    """
+    key = normalize_query_text(text)
+
+    async def compute() -> dict:
+        response = await gateway.chat(
+            model=CHAT_MODEL,
+            messages=[
+                {"role": "system", "content": QUERY_UNDERSTANDING_PROMPT},
+                {"role": "user", "content": f"ЗАПРОС: \"{key}\""}
+            ],
+            temperature=0,
+            response_format={"type": "json_object"}
+        )
+        result = _parse_understanding(json.loads(response.choices[0].message.content.strip()))
+        logging.info(f"[LLM] Разбор запроса '{key}': {result}")
+        return result
+
+    try:
+        cache_key = llm_cache.key("understand_query", CHAT_MODEL, QUERY_UNDERSTANDING_PROMPT, key)
+        return dict(await llm_cache.get_or_compute_async(cache_key, compute))
+    except Exception as e:
+        logging.error(f"Ошибка разбора запроса: {e}")
+        return None
+
+
 # --- ОСНОВНОЙ ГЕНЕРАТОР ---
 
-def generate_answer(history_rows: list, user_query: str, products: list, chunks: list) -> str:
-    """Основной RAG-генератор, использующий SYSTEM_PROMPT."""
+def _answer_messages(history_rows: list, user_query: str, products: list, chunks: list,
+                     history_summary: str = "") -> list:
     context = build_context_snippet(products, chunks)
     messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-    messages += build_history_messages(history_rows)
+    messages += build_history_messages(history_rows, history_summary)
     messages.append({"role": "user", "content": f"{user_query}\n\n{context}"})
-    
-    resp = client.chat.completions.create(model=CHAT_MODEL, messages=messages, temperature=0.3)
-    return resp.choices[0].message.content.strip()
\ No newline at end of file
+    return messages
+
+
+def generate_answer(history_rows: list, user_query: str, products: list, chunks: list) -> str:
+    """Основной RAG-генератор, использующий SYSTEM_PROMPT."""
+    messages = _answer_messages(history_rows, user_query, products, chunks)
+    resp = gateway.chat_sync(model=CHAT_MODEL, messages=messages, temperature=0.3)
+    return resp.choices[0].message.content.strip()
+
+
+async def generate_answer_async(history_rows: list, user_query: str, products: list, chunks: list,
+                                history_summary: str = "") -> str:
+    """Асинхронная версия generate_answer."""
+    messages = _answer_messages(history_rows, user_query, products, chunks, history_summary)
+    resp = await gateway.chat(model=CHAT_MODEL, messages=messages, temperature=0.3)
+    return resp.choices[0].message.content.strip()
+
+
+async def generate_answer_stream(history_rows: list, user_query: str, products: list, chunks: list,
+                                 history_summary: str = ""):
+    """Потоковая версия generate_answer: отдаёт текст ответа по кусочкам (дельтам) по мере генерации."""
+    messages = _answer_messages(history_rows, user_query, products, chunks, history_summary)
+    stream = gateway.chat_stream(model=CHAT_MODEL, messages=messages, temperature=0.3)
+    async for event in stream:
+        if event.choices and event.choices[0].delta.content:
+            yield event.choices[0].delta.content
+
+
+# --- СВОДКА СТАРОЙ ЧАСТИ ДИАЛОГА (conversation_memory.py) ---
+
+HISTORY_SUMMARY_PROMPT = """Ты ведёшь краткие заметки о диалоге консультанта Greenleaf с клиентом.
+Тебе дают прежние заметки (могут быть пустыми) и новые сообщения диалога.
+Обнови заметки: что клиент ищет, для чего/для кого, какие товары ему предлагали (названия и ID, если указаны),
+что ему понравилось или не подошло, бюджет и важные детали (аллергии, возраст и т.п.).
+Пиши по-русски, кратко, списком, не больше 8 пунктов. Без приветствий и пояснений — только заметки."""
+
+
+async def summarize_history_async(previous_summary: str, messages: list) -> Optional[str]:
+    """Обновляет сводку диалога по новым (уже сжатым) сообщениям. None — при ошибке."""
+    dialog = "\n".join(f"{'Клиент' if m['role'] == 'user' else 'Консультант'}: {m['content']}" for m in messages)
+    try:
+        # Сводка не нужна для текущего ответа — в общей очереди к OpenAI она идёт после ответов
+        resp = await gateway.chat(
+            BACKGROUND,
+            model=CHAT_MODEL,
+            messages=[
+                {"role": "system", "content": HISTORY_SUMMARY_PROMPT},
+                {"role": "user", "content": f"ПРЕЖНИЕ ЗАМЕТКИ:\n{previous_summary or '(нет)'}\n\nНОВЫЕ СООБЩЕНИЯ:\n{dialog}"},
+            ],
+            temperature=0.0,
+            max_tokens=300,
+        )
+        return resp.choices[0].message.content.strip()
+    except Exception as e:
+        logging.error(f"Ошибка при обновлении сводки диалога: {e}")
+        return None
@@ -0,0 +1,202 @@
+# llm_cache.py
+# Мемоизация детерминированных вызовов LLM (temperature=0, фиксированный промт):
+# классификация запроса, разбор запроса, переформулирование, извлечение категории.
+# Ключ — (функция, модель, отпечаток системного промта, нормализованный ввод):
+# правка промта или смена модели сама делает старые ответы недействительными.
+#   1 уровень — LRU с TTL в памяти процесса (cache.TTLCache);
+#   2 уровень — необязательный SQLite-файл (LLM_CACHE_PATH), переживает перезапуск.
+# Одновременные одинаковые запросы не дублируются: второй ждёт ответа первого (single-flight).
+# Ошибки не кэшируются — исключение из compute пробрасывается вызывающему коду.
+
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+import config
+from cache import TTLCache, normalize_query_text
+
+logger = logging.getLogger(__name__)
+
+
+def prompt_fingerprint(prompt: str) -> str:
+    """Короткий отпечаток промта — «версия», меняется при любой правке текста."""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+
+
+class SQLiteTier:
+    """Второй уровень кэша: таблица key → (JSON-значение, время записи) в локальном файле."""
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("pragma journal_mode=wal")
+        self._conn.execute(
+            "create table if not exists llm_cache (key text primary key, value text not null, stored_at real not null)"
+        )
+        if ttl:
+            self._conn.execute("delete from llm_cache where stored_at < ?", (time.time() - ttl,))
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[tuple]:
+        """(stored_at, value) или None, если записи нет или она просрочена."""
+        with self._lock:
+            row = self._conn.execute("select value, stored_at from llm_cache where key = ?", (key,)).fetchone()
+        if row is None or (self.ttl and time.time() - row[1] > self.ttl):
+            return None
+        return row[1], json.loads(row[0])
+
+    def set(self, key: str, value: Any, stored_at: float) -> None:
+        with self._lock:
+            self._conn.execute(
+                "insert or replace into llm_cache (key, value, stored_at) values (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), stored_at),
+            )
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class LLMCache:
+    """
+    get_or_compute_async(key, compute) — ответ из памяти → из SQLite → вызов compute().
+    get_or_compute(key, compute) — то же для синхронных функций (без single-flight).
+    Значения должны сериализоваться в JSON (bool, str, dict и т.п.); None не кэшируется.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, path: str = ""):
+        self.ttl = ttl
+        self._memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._disk: Optional[SQLiteTier] = None
+        if path:
+            try:
+                self._disk = SQLiteTier(path, ttl)
+                logger.info(f"[LLM_CACHE] Дисковый уровень: {path}")
+            except sqlite3.Error as e:
+                logger.error(f"[LLM_CACHE] Не удалось открыть {path}, кэш только в памяти: {e}")
+        self._inflight: dict = {}
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def key(name: str, model: str, prompt: str, text: str) -> str:
+        raw = json.dumps([name, model, prompt_fingerprint(prompt), normalize_query_text(text)], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _lookup_memory(self, key: str) -> Any:
+        value = self._memory.get(key)
+        if value is not None:
+            self.memory_hits += 1
+        return value
+
+    def _lookup_disk(self, key: str) -> Any:
+        if self._disk is None:
+            return None
+        try:
+            found = self._disk.get(key)
+        except Exception as e:
+            logger.warning(f"[LLM_CACHE] Ошибка чтения SQLite: {e}")
+            return None
+        if found is None:
+            return None
+        stored_at, value = found
+        self._memory.set(key, value, stored_at=stored_at)
+        self.disk_hits += 1
+        return value
+
+    def _store(self, key: str, value: Any) -> None:
+        stored_at = time.time()
+        self._memory.set(key, value, stored_at=stored_at)
+        if self._disk is not None:
+            try:
+                self._disk.set(key, value, stored_at)
+            except Exception as e:
+                logger.warning(f"[LLM_CACHE] Ошибка записи SQLite: {e}")
+
+    async def get_or_compute_async(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        while True:
+            value = self._lookup_memory(key)
+            if value is not None:
+                return value
+
+            pending = self._inflight.get(key)
+            if pending is None:
+                return await self._compute_async(key, compute)
+
+            self.coalesced += 1
+            # wait() не отменяет future ведущего и бросает CancelledError, только если отменили
+            # эту задачу — тогда пробрасываем. Отменили ведущего (например, его ход вытеснен
+            # новым сообщением) — результат всё ещё нужен: следующий круг, первый ожидающий считает сам
+            await asyncio.wait((pending,))
+            if not pending.cancelled():
+                return pending.result()
+            self.coalesced -= 1
+
+    async def _compute_async(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        """Ведущий запрос: считает значение и раздаёт его ожидающим через future."""
+        value = None
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            if self._disk is not None:
+                value = await asyncio.to_thread(self._lookup_disk, key)
+            if value is None:
+                self.misses += 1
+                value = await compute()
+                if value is not None:
+                    if self._disk is not None:
+                        await asyncio.to_thread(self._store, key, value)
+                    else:
+                        self._store(key, value)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()  # Ожидающие не отменяются, а перехватывают вычисление (см. выше)
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Ожидающих может не быть — не оставляем «неполученное» исключение
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any]) -> Any:
+        value = self._lookup_memory(key)
+        if value is None:
+            value = self._lookup_disk(key)
+        if value is None:
+            self.misses += 1
+            value = compute()
+            if value is not None:
+                self._store(key, value)
+        return value
+
+    def close(self) -> None:
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
+
+    def stats(self) -> dict:
+        total = self.memory_hits + self.disk_hits + self.misses + self.coalesced
+        return {
+            "size": len(self._memory),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_rate": round((total - self.misses) / total, 3) if total else 0.0,
+        }
+
+
+# Общий кэш процесса для llm.py и db.py
+llm_cache = LLMCache(maxsize=config.LLM_CACHE_SIZE, ttl=config.LLM_CACHE_TTL, path=config.LLM_CACHE_PATH)
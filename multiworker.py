@@ -0,0 +1,217 @@
+# multiworker.py
+# Несколько процессов-воркеров (BOT_WORKERS > 1).
+# Процесс-приёмник получает обновления (long polling или webhook, см. BOT_MODE)
+# и раскладывает их по воркерам по хэшу user_id: все обновления пользователя
+# попадают в один процесс, а внутри него — в один шард ShardedWorkerPool,
+# поэтому порядок в рамках диалога сохраняется.
+# Воркеры — отдельные процессы (spawn) с полным запуском бота (bot.worker_main);
+# сессии — в общем хранилище (shared_state.py), анти-спам — в памяти воркера (throttling.py).
+# Очереди воркеров ограничены: при переполнении webhook отвечает 503, а polling
+# приостанавливает чтение getUpdates.
+
+import asyncio
+import logging
+import multiprocessing
+import queue as queue_errors
+import time
+import zlib
+from collections import deque
+from typing import Any, Callable, Dict, Hashable, List
+
+from webhook import ShardedWorkerPool, install_stop_signals, run_webhook, update_user_key
+
+logger = logging.getLogger(__name__)
+
+POLL_TIMEOUT = 30          # Long polling getUpdates, секунды
+SUBMIT_RETRY_DELAY = 0.05  # Пауза при полной очереди воркера (polling ждёт, а не отбрасывает)
+STOP_TIMEOUT = 40          # Сколько ждать завершения воркеров после сигнала остановки
+
+
+def partition(key: Hashable, workers: int) -> int:
+    """Номер воркера по ключу. Детерминирован между процессами (в отличие от hash() для строк)."""
+    if isinstance(key, int):
+        return key % workers
+    return zlib.crc32(str(key).encode("utf-8")) % workers
+
+
+def local_shard(key: Hashable, workers: int) -> int:
+    """
+    Ключ шарда ShardedWorkerPool внутри воркера. У всех ключей воркера один и тот же
+    partition(key, workers), поэтому шард берётся от независимой части ключа — иначе при
+    общем множителе (например, 4 процесса и 32 шарда) большинство шардов простаивает.
+    """
+    if isinstance(key, int):
+        return key // workers
+    return zlib.crc32(f"local:{key}".encode("utf-8"))
+
+
+class ProcessRouter:
+    """
+    Тот же интерфейс, что у ShardedWorkerPool (submit / stats), но элементы уходят
+    в очереди процессов-воркеров: (ключ, сырое обновление Telegram в виде dict).
+    """
+
+    def __init__(self, queues: list):
+        self._queues = queues
+        self.workers = len(queues)
+        self.routed = [0] * self.workers
+        self.rejected = 0
+
+    def submit(self, key: Hashable, item: Any) -> bool:
+        index = partition(key, self.workers)
+        try:
+            self._queues[index].put_nowait((key, item))
+        except queue_errors.Full:
+            self.rejected += 1
+            return False
+        self.routed[index] += 1
+        return True
+
+    async def submit_wait(self, key: Hashable, item: Any) -> None:
+        while not self.submit(key, item):
+            await asyncio.sleep(SUBMIT_RETRY_DELAY)
+
+    def stats(self) -> dict:
+        return {"workers": self.workers, "routed": self.routed, "rejected": self.rejected}
+
+
+async def poll_updates(bot, dp, router: ProcessRouter) -> None:
+    """
+    Long polling в процессе-приёмнике: сырые обновления уходят воркерам по user_id.
+    offset сдвигается только после постановки в очередь — при остановке недоставленное придёт снова.
+    Поэтому накопившиеся в Telegram обновления при запуске не сбрасываются (drop_pending_updates).
+    """
+    await bot.delete_webhook()
+    allowed_updates = dp.resolve_used_update_types()
+    offset, delay = None, 1.0
+    print(f"🚀 [BOT] Запуск polling, обновления распределяются по {router.workers} воркерам...")
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT, allowed_updates=allowed_updates)
+            delay = 1.0
+        except Exception as e:
+            logger.error(f"[WORKERS] Ошибка getUpdates: {e}. Повтор через {delay:.0f} с")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+            continue
+        for update in updates:
+            raw = update.model_dump(mode="json", exclude_unset=True)
+            await router.submit_wait(update_user_key(raw), raw)
+            offset = update.update_id + 1
+
+
+async def run_ingress(bot, dp, workers: int, queue_size: int, worker_target: Callable) -> None:
+    """
+    Процесс-приёмник: запускает воркеров worker_target(index, queue), принимает обновления
+    и распределяет их. При остановке воркерам отправляется None — они дорабатывают очередь и выходят.
+    """
+    import config
+
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(maxsize=queue_size) for _ in range(workers)]
+    processes: List[multiprocessing.Process] = [
+        context.Process(target=worker_target, args=(i, q), name=f"bot-worker-{i}") for i, q in enumerate(queues)
+    ]
+    for process in processes:
+        process.start()
+    logger.info(f"[WORKERS] Запущено воркеров: {workers} (pid {[p.pid for p in processes]})")
+
+    router = ProcessRouter(queues)
+    try:
+        if config.BOT_MODE == "webhook":
+            await run_webhook(bot, dp, router=router)
+        else:
+            stop = asyncio.Event()
+            install_stop_signals(stop)
+            poller = asyncio.create_task(poll_updates(bot, dp, router))
+            stopping = asyncio.create_task(stop.wait())
+            await asyncio.wait({poller, stopping}, return_when=asyncio.FIRST_COMPLETED)
+            for task in (poller, stopping):
+                task.cancel()
+            await asyncio.gather(poller, stopping, return_exceptions=True)
+    finally:
+        await asyncio.to_thread(_stop_workers, queues, processes)
+        logger.info(f"[WORKERS] Итоговая статистика приёмника: {router.stats()}")
+        await bot.session.close()
+
+
+def _stop_workers(queues: list, processes: list) -> None:
+    """
+    Отправляет каждому воркеру None. Полная очередь — ждём, пока воркер её разберёт
+    (не дольше STOP_TIMEOUT); не дождались — воркер останавливается принудительно.
+    """
+    deadline = time.monotonic() + STOP_TIMEOUT
+    for q, process in zip(queues, processes):
+        while process.is_alive():
+            try:
+                q.put(None, timeout=1)
+                break
+            except queue_errors.Full:
+                if time.monotonic() >= deadline:
+                    logger.warning(f"[WORKERS] Очередь {process.name} не освободилась за {STOP_TIMEOUT} с — останавливаем")
+                    process.terminate()
+                    break
+    _join(processes)
+
+
+def _join(processes: list) -> None:
+    for process in processes:
+        process.join(STOP_TIMEOUT)
+        if process.is_alive():
+            logger.warning(f"[WORKERS] {process.name} не завершился за {STOP_TIMEOUT} с — останавливаем")
+            process.terminate()
+
+
+async def consume(work_queue, handle: Callable, parse: Callable, workers: int,
+                  concurrency: int, queue_size: int) -> dict:
+    """
+    Цикл процесса-воркера: читает (ключ, обновление) из очереди приёмника и обрабатывает
+    локальным пулом (порядок по ключу сохраняется). None — сигнал остановки.
+    Шард пула полон — его обновления откладываются в отдельную очередь шарда (порядок тот же),
+    а остальные шарды продолжают получать свои. Отложено queue_size обновлений — чтение
+    останавливается, очередь приёмника заполняется (backpressure).
+    """
+    pool = ShardedWorkerPool(handle, concurrency, queue_size, shard=lambda key: local_shard(key, workers))
+    pool.start()
+    held: Dict[int, deque] = {}
+    releasers: List[asyncio.Task] = []
+
+    async def release(index: int, backlog: deque) -> None:
+        while backlog:
+            key, item = backlog[0]
+            if pool.submit(key, item):
+                backlog.popleft()
+            else:
+                await asyncio.sleep(SUBMIT_RETRY_DELAY)
+        del held[index]
+
+    while True:
+        message = await asyncio.to_thread(work_queue.get)
+        if message is None:
+            break
+        key, raw = message
+        try:
+            item = parse(raw)
+        except Exception as e:
+            logger.warning(f"[WORKERS] Некорректное обновление: {e}")
+            continue
+        index = pool.shard_of(key)
+        backlog = held.get(index)
+        if backlog is None:
+            if pool.submit(key, item):
+                continue
+            backlog = held[index] = deque()
+            releasers = [t for t in releasers if not t.done()]
+            releasers.append(asyncio.create_task(release(index, backlog)))
+        backlog.append((key, item))
+        while sum(len(b) for b in held.values()) >= queue_size:
+            await asyncio.sleep(SUBMIT_RETRY_DELAY)
+
+    if releasers:
+        _, stuck = await asyncio.wait(releasers, timeout=STOP_TIMEOUT)
+        for task in stuck:
+            task.cancel()
+        if stuck:
+            logger.warning(f"[WORKERS] За {STOP_TIMEOUT} с не переданы в пул {sum(len(b) for b in held.values())} обновлений")
+    await pool.drain(STOP_TIMEOUT)
+    return pool.stats()
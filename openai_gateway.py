@@ -0,0 +1,429 @@
+# openai_gateway.py
+# Единый выход к OpenAI: один синхронный и один асинхронный клиент на процесс
+# (вместо отдельных клиентов в llm.py, db.py и embeddings.py) и общий регулятор нагрузки:
+# - общий лимит одновременных запросов с очередью по приоритету: INTERACTIVE (ответ
+#   пользователю и всё, что на его пути) обслуживается раньше BACKGROUND (сводки диалога,
+#   теневые проверки классификатора, backfill), а фоновым задачам доступна только часть слотов;
+# - отдельные бюджеты запросов и токенов в минуту для chat и embeddings (rate_limit.TokenBucket);
+# - повтор при 429 / 5xx / сетевых ошибках: экспоненциальная задержка с джиттером, не меньше
+#   Retry-After от сервера; на время паузы слот освобождается;
+# - предохранитель (circuit breaker): после серии сбоев подряд запросы сразу отклоняются
+#   с OpenAIUnavailable, пока не пройдёт пробный запрос.
+# Очередь, запросы в работе и токены за последнюю минуту — stats() и периодический лог [OPENAI].
+# Синхронные вызовы (скрипты, старые синхронные функции) проходят через предохранитель и учёт
+# токенов, но без очереди; их повторы делает сам SDK.
+
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+import httpx
+from openai import APIConnectionError, APITimeoutError, AsyncOpenAI, InternalServerError, OpenAI, RateLimitError
+
+import config
+from rate_limit import TokenBucket, retry_async
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0  # Ответ пользователю и шаги, которых он ждёт
+BACKGROUND = 1   # Работа, которую можно отложить
+
+# Ошибки OpenAI, после которых имеет смысл повторить запрос
+RETRYABLE_OPENAI_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+# Признаки недоступности API, которые считает предохранитель (APITimeoutError — подкласс
+# APIConnectionError). 429 сюда не входит: сервис отвечает, это забота бюджетов и повторов.
+OUTAGE_ERRORS = (APIConnectionError, InternalServerError)
+
+DEFAULT_COMPLETION_TOKENS = 400  # Оценка длины ответа, если max_tokens не задан
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 20.0
+USAGE_WINDOW = 60.0  # Окно для «живых» запросов и токенов в минуту, секунды
+
+
+class OpenAIUnavailable(RuntimeError):
+    """Предохранитель разомкнут — запрос в OpenAI не отправлялся."""
+
+
+def estimate_tokens(text) -> int:
+    # Кириллица — примерно 2-3 символа на токен; оцениваем с запасом
+    if isinstance(text, (list, tuple)):
+        return sum(estimate_tokens(t) for t in text)
+    return len(text or "") // 2 + 1
+
+
+def _chat_tokens(kwargs: dict) -> int:
+    prompt = sum(estimate_tokens(str(m.get("content") or "")) for m in kwargs.get("messages", []))
+    return prompt + (kwargs.get("max_tokens") or DEFAULT_COMPLETION_TOKENS)
+
+
+def _usage_tokens(response, estimate: int) -> int:
+    usage = getattr(response, "usage", None)
+    return getattr(usage, "total_tokens", None) or estimate
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """Пауза из заголовков ответа (retry-after-ms / retry-after в секундах), если сервер её указал."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        try:
+            return float(headers[name]) * scale
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+
+class PriorityGate:
+    """
+    Семафор на limit слотов с очередью по приоритету (меньше — важнее, при равном — FIFO).
+    BACKGROUND занимает не больше background_limit слотов одновременно, чтобы под ответы
+    пользователям всегда оставались свободные.
+    """
+
+    def __init__(self, limit: int, background_limit: int):
+        self.limit = max(1, limit)
+        self.background_limit = max(1, min(background_limit, self.limit))
+        self.active = 0
+        self.active_background = 0
+        self.waiting = [0, 0]  # По приоритетам INTERACTIVE / BACKGROUND
+        self._heap: list = []  # (priority, seq, future); отменённые удаляются лениво
+        self._seq = itertools.count()
+
+    def _can_run(self, priority: int) -> bool:
+        if self.active >= self.limit:
+            return False
+        return priority < BACKGROUND or self.active_background < self.background_limit
+
+    def _take(self, priority: int) -> None:
+        self.active += 1
+        if priority >= BACKGROUND:
+            self.active_background += 1
+
+    def _wake(self) -> None:
+        # Голова кучи — самый важный ожидающий; если ему нельзя, остальным тоже
+        while self._heap:
+            priority, _, future = self._heap[0]
+            if future.done():
+                heapq.heappop(self._heap)
+                continue
+            if not self._can_run(priority):
+                return
+            heapq.heappop(self._heap)
+            self.waiting[priority] -= 1
+            self._take(priority)
+            future.set_result(None)
+
+    async def acquire(self, priority: int) -> None:
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), future))
+        self.waiting[priority] += 1
+        self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self.waiting[priority] -= 1
+            else:
+                self.release(priority)  # Слот уже выдан, но задачу отменили — возвращаем
+            raise
+
+    def release(self, priority: int) -> None:
+        self.active -= 1
+        if priority >= BACKGROUND:
+            self.active_background -= 1
+        self._wake()
+
+    def queued(self) -> int:
+        return sum(self.waiting)
+
+
+class CircuitBreaker:
+    """
+    closed — запросы идут; после threshold сбоев подряд — open: запросы отклоняются cooldown
+    секунд; затем half_open — пропускается один пробный запрос: ответ замыкает предохранитель,
+    сбой снова размыкает. Потокобезопасен (синхронные вызовы идут из потоков).
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self, claim: bool = True) -> None:
+        """Бросает OpenAIUnavailable, если запрос слать нельзя. claim=False — только проверка, без пробы."""
+        with self._lock:
+            if self.state == "open":
+                remaining = self.cooldown - (time.monotonic() - self._opened_at)
+                if remaining > 0:
+                    raise OpenAIUnavailable(f"OpenAI недоступен (предохранитель), повтор через {remaining:.0f} с")
+                if not claim:
+                    return
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self._probing:
+                    raise OpenAIUnavailable("OpenAI недоступен (предохранитель), идёт пробный запрос")
+                if claim:
+                    self._probing = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != "closed":
+                logger.info("[OPENAI] Предохранитель замкнут: API снова отвечает")
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.threshold):
+                self.state = "open"
+                self._opened_at = time.monotonic()
+                self.opened += 1
+                logger.warning(f"[OPENAI] Предохранитель разомкнут после {self.failures} сбоев подряд "
+                               f"на {self.cooldown:.0f} с")
+
+    def release_probe(self) -> None:
+        with self._lock:
+            self._probing = False
+
+
+class UsageWindow:
+    """Запросы и токены за последние USAGE_WINDOW секунд — фактические RPM / TPM."""
+
+    def __init__(self):
+        self._events: deque = deque()  # (время, токены)
+        self._lock = threading.Lock()
+
+    def _prune(self, now: float) -> None:
+        while self._events and self._events[0][0] < now - USAGE_WINDOW:
+            self._events.popleft()
+
+    def add(self, tokens: int) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._events.append((now, tokens))
+            self._prune(now)
+
+    def per_minute(self) -> tuple:
+        with self._lock:
+            self._prune(time.monotonic())
+            return len(self._events), sum(tokens for _, tokens in self._events)
+
+
+class OpenAIGateway:
+    """
+    chat / chat_stream / embed — асинхронные вызовы через очередь, бюджеты, повторы и предохранитель
+    (аргументы — как у chat.completions.create / embeddings.create). chat_sync / embed_sync — синхронные.
+    """
+
+    def __init__(self, api_key: str, max_concurrency: int, background_concurrency: int,
+                 chat_rpm: float, chat_tpm: float, embed_rpm: float, embed_tpm: float,
+                 max_attempts: int = 4, breaker_threshold: int = 5, breaker_cooldown: float = 30.0,
+                 http_client: Optional[httpx.AsyncClient] = None):
+        self.max_attempts = max(1, max_attempts)
+        self.sync_client = OpenAI(api_key=api_key, max_retries=self.max_attempts - 1)
+        # Повторяет асинхронные запросы шлюз (освобождая слот на время паузы), а не SDK
+        self.async_client = AsyncOpenAI(api_key=api_key, max_retries=0, http_client=http_client)
+        self.gate = PriorityGate(max_concurrency, background_concurrency)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        self.budgets = {
+            "chat": (TokenBucket.per_minute(chat_rpm), TokenBucket.per_minute(chat_tpm)),
+            "embed": (TokenBucket.per_minute(embed_rpm), TokenBucket.per_minute(embed_tpm)),
+        }
+        self.usage = {"chat": UsageWindow(), "embed": UsageWindow()}
+        self.requests = 0
+        self.attempts = 0
+        self.rate_limited = 0
+        self.failed = 0
+        self.rejected = 0
+        self._reporter: Optional[asyncio.Task] = None
+
+    def _record(self, error: Optional[BaseException]) -> None:
+        """Итог попытки для предохранителя: любой ответ API (в т.ч. 4xx и 429) значит, что сервис доступен."""
+        if isinstance(error, OUTAGE_ERRORS):
+            self.breaker.record_failure()
+        elif isinstance(error, asyncio.CancelledError):
+            self.breaker.release_probe()
+        else:
+            if isinstance(error, RateLimitError):
+                self.rate_limited += 1
+            self.breaker.record_success()
+
+    async def _call(self, kind: str, priority: int, tokens: int,
+                    create: Callable[[], Awaitable], hold: bool = False):
+        """
+        Попытка: предохранитель → слот → бюджеты → запрос; повторяется retry_async.
+        hold=True — слот остаётся занятым после ответа (поток), освобождает вызывающий.
+        """
+        requests_budget, tokens_budget = self.budgets[kind]
+
+        async def attempt():
+            self.attempts += 1
+            self.breaker.before_call(claim=False)  # Быстрый отказ, не занимая место в очереди
+            await self.gate.acquire(priority)
+            try:
+                await requests_budget.acquire()
+                await tokens_budget.acquire(tokens)
+                self.breaker.before_call()
+                try:
+                    response = await create()
+                except BaseException as e:
+                    self._record(e)
+                    raise
+                self._record(None)
+            except BaseException:
+                self.gate.release(priority)
+                raise
+            if not hold:
+                self.gate.release(priority)
+            return response
+
+        self.requests += 1
+        try:
+            return await retry_async(attempt, f"OpenAI {kind}", attempts=self.max_attempts,
+                                     base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY,
+                                     retry_on=RETRYABLE_OPENAI_ERRORS, retry_after=retry_after_seconds)
+        except OpenAIUnavailable:
+            self.rejected += 1
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+
+    def _call_sync(self, kind: str, tokens: int, create: Callable):
+        self.requests += 1
+        self.attempts += 1
+        try:
+            self.breaker.before_call()
+        except OpenAIUnavailable:
+            self.rejected += 1
+            raise
+        try:
+            response = create()
+        except BaseException as e:
+            self._record(e)
+            self.failed += 1
+            raise
+        self._record(None)
+        self.usage[kind].add(_usage_tokens(response, tokens))
+        return response
+
+    async def chat(self, priority: int = INTERACTIVE, **kwargs):
+        tokens = _chat_tokens(kwargs)
+        response = await self._call("chat", priority, tokens,
+                                    lambda: self.async_client.chat.completions.create(**kwargs))
+        self.usage["chat"].add(_usage_tokens(response, tokens))
+        return response
+
+    async def chat_stream(self, priority: int = INTERACTIVE, **kwargs):
+        """Потоковый ответ (события чанков). Слот занят до конца потока; повтор — только до начала ответа."""
+        tokens = _chat_tokens(kwargs)
+        kwargs.setdefault("stream_options", {"include_usage": True})
+        stream = await self._call("chat", priority, tokens,
+                                  lambda: self.async_client.chat.completions.create(stream=True, **kwargs),
+                                  hold=True)
+        used = None
+        try:
+            async for chunk in stream:
+                if getattr(chunk, "usage", None):
+                    used = chunk.usage.total_tokens
+                yield chunk
+        finally:
+            self.gate.release(priority)
+            self.usage["chat"].add(used or tokens)
+            await stream.close()
+
+    async def embed(self, input, model: str, priority: int = INTERACTIVE):
+        tokens = estimate_tokens(input)
+        response = await self._call("embed", priority, tokens,
+                                    lambda: self.async_client.embeddings.create(model=model, input=input))
+        self.usage["embed"].add(_usage_tokens(response, tokens))
+        return response
+
+    def chat_sync(self, **kwargs):
+        return self._call_sync("chat", _chat_tokens(kwargs),
+                               lambda: self.sync_client.chat.completions.create(**kwargs))
+
+    def embed_sync(self, input, model: str):
+        return self._call_sync("embed", estimate_tokens(input),
+                               lambda: self.sync_client.embeddings.create(model=model, input=input))
+
+    def stats(self) -> dict:
+        chat_rpm, chat_tpm = self.usage["chat"].per_minute()
+        embed_rpm, embed_tpm = self.usage["embed"].per_minute()
+        return {
+            "queued": {"interactive": self.gate.waiting[INTERACTIVE], "background": self.gate.waiting[BACKGROUND]},
+            "in_flight": self.gate.active,
+            "chat_rpm": chat_rpm,
+            "chat_tpm": chat_tpm,
+            "embed_rpm": embed_rpm,
+            "embed_tpm": embed_tpm,
+            "requests": self.requests,
+            "retries": self.attempts - self.requests,
+            "rate_limited": self.rate_limited,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "breaker": self.breaker.state,
+            "breaker_opened": self.breaker.opened,
+        }
+
+    def start_reporter(self, interval: float) -> None:
+        """Раз в interval секунд пишет stats() в лог — если были запросы или очередь не пуста."""
+        if interval > 0 and self._reporter is None:
+            self._reporter = asyncio.create_task(self._report_loop(interval))
+
+    async def _report_loop(self, interval: float) -> None:
+        reported = 0
+        while True:
+            await asyncio.sleep(interval)
+            if self.requests != reported or self.gate.queued():
+                reported = self.requests
+                logger.info(f"[OPENAI] {self.stats()}")
+
+    async def close(self) -> None:
+        if self._reporter is not None:
+            self._reporter.cancel()
+            await asyncio.gather(self._reporter, return_exceptions=True)
+            self._reporter = None
+        logger.info(f"[OPENAI] Итоговая статистика: {self.stats()}")
+        await self.async_client.close()
+        self.sync_client.close()
+
+
+# Бюджеты заданы на весь бот: каждый процесс-воркер (multiworker.py) получает свою долю
+_workers = max(1, config.BOT_WORKERS)
+
+gateway = OpenAIGateway(
+    config.OPENAI_API_KEY,
+    max_concurrency=config.OPENAI_MAX_CONCURRENCY,
+    background_concurrency=config.OPENAI_BACKGROUND_CONCURRENCY,
+    chat_rpm=config.OPENAI_CHAT_RPM / _workers,
+    chat_tpm=config.OPENAI_CHAT_TPM / _workers,
+    embed_rpm=config.OPENAI_EMBED_RPM / _workers,
+    embed_tpm=config.OPENAI_EMBED_TPM / _workers,
+    max_attempts=config.OPENAI_MAX_ATTEMPTS,
+    breaker_threshold=config.OPENAI_BREAKER_THRESHOLD,
+    breaker_cooldown=config.OPENAI_BREAKER_COOLDOWN,
+    # Общий пул keep-alive соединений для хендлеров бота
+    http_client=httpx.AsyncClient(
+        timeout=60,
+        limits=httpx.Limits(
+            max_connections=config.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=config.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=30,
+        ),
+    ),
+)
@@ -0,0 +1,160 @@
+# query_classifier.py
+# Быстрый локальный классификатор перед llm.is_product_query.
+# Очевидные случаи (приветствие, спасибо, название товара из каталога)
+# решаются за микросекунды; в LLM уходят только неоднозначные сообщения.
+
+import asyncio
+import logging
+import random
+import re
+from typing import Awaitable, Callable, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+_WORD = re.compile(r"[a-zа-яё0-9-]+")
+STEM_LEN = 5  # Грубый стемминг по префиксу: "шампуни" и "шампунь" оба дают "шампу"
+
+GREETINGS = {"привет", "здравствуйте", "здравствуй", "здрасте", "добрый", "доброе", "салам", "салем",
+             "hi", "hello", "хай", "приветствую"}
+THANKS = {"спасибо", "благодарю", "спс", "рахмет", "thanks", "спасибки"}
+SMALL_TALK = {"ок", "окей", "ok", "хорошо", "понятно", "ясно", "ладно", "да", "нет", "пока", "кто", "ты",
+              "дела", "как", "день", "вечер", "утро", "не", "надо", "нужно", "интересует", "бот", "до", "свидания"}
+MANAGER_WORDS = {"менеджер", "заказ", "связь", "оператор"}
+# Уточнения по предыдущему списку — пусть решает LLM (правило 4 в промте классификатора)
+CLARIFICATION_WORDS = {"первый", "второй", "третий", "номер", "подробнее"}
+PRODUCT_INTENT = {"цена", "стоит", "сколько", "купить", "есть", "наличии", "каталог", "для", "от", "против",
+                  "помогает", "средство", "посоветуйте", "подскажите", "порекомендуйте", "ищу", "нужен", "нужна"}
+
+
+class Decision(NamedTuple):
+    is_product: Optional[bool]  # None — классификатор не знает, ответ за LLM
+    confidence: float
+    reason: str
+
+
+def _stem(word: str) -> str:
+    return word[:STEM_LEN]
+
+
+class QueryClassifier:
+    """
+    Правила + лексикон из названий и тегов каталога.
+    classify() возвращает решение с уверенностью; всё, что ниже порога, уходит в LLM.
+    Ведёт статистику согласия с LLM, чтобы подбирать порог.
+    """
+
+    def __init__(self, threshold: float = 0.85, shadow_rate: float = 0.0):
+        self.threshold = threshold
+        self.shadow_rate = shadow_rate
+        self.lexicon: set = set()
+        self.decided_locally = 0
+        self.sent_to_llm = 0
+        self.compared = 0
+        self.agreed = 0
+
+    def update_lexicon(self, products, stopwords=frozenset()) -> None:
+        """Строит лексикон (стемы слов) из name и search_tags товаров."""
+        lexicon = set()
+        for p in products:
+            text = f"{p.get('name') or ''} {p.get('search_tags') or ''}".lower()
+            for word in _WORD.findall(text):
+                if len(word) >= 3 and word not in stopwords and not word.isdigit():
+                    lexicon.add(_stem(word))
+        self.lexicon = lexicon
+        logger.info(f"[CLASSIFIER] Лексикон каталога: {len(lexicon)} стемов")
+
+    def classify(self, text: str) -> Decision:
+        words = _WORD.findall(text.lower())
+        if not words:
+            return Decision(False, 0.9, "empty")
+
+        word_set = set(words)
+        catalog_hits = [w for w in words if len(w) >= 3 and _stem(w) in self.lexicon and w not in SMALL_TALK]
+        short = len(words) <= 4
+
+        if word_set & MANAGER_WORDS:
+            return Decision(False, 0.9, "manager")
+        if word_set & CLARIFICATION_WORDS:
+            return Decision(None, 0.0, "clarification")
+
+        chit_chat = GREETINGS | THANKS | SMALL_TALK
+        if short and not catalog_hits and word_set <= chit_chat:
+            return Decision(False, 0.95, "small_talk")
+
+        if catalog_hits:
+            if short:
+                return Decision(True, 0.9, "catalog_term")
+            if word_set & PRODUCT_INTENT:
+                return Decision(True, 0.9, "catalog_term+intent")
+            return Decision(True, 0.7, "catalog_term_long")
+
+        if word_set & PRODUCT_INTENT:
+            return Decision(True, 0.65, "intent")
+        if len(words) <= 3 and "?" not in text:
+            # Короткая именная фраза без знакомых слов: похоже на товар, но не уверены
+            return Decision(True, 0.5, "short_phrase")
+        return Decision(None, 0.0, "unknown")
+
+    def is_confident(self, decision: Decision) -> bool:
+        return decision.is_product is not None and decision.confidence >= self.threshold
+
+    # ------------------------------------------------------------------
+    # СТАТИСТИКА СОГЛАСИЯ С LLM
+    # ------------------------------------------------------------------
+
+    def record(self, decision: Decision, llm_result: bool) -> None:
+        """Учитывает ответ LLM для сообщения, по которому у локального классификатора было мнение."""
+        if decision.is_product is None:
+            return
+        self.compared += 1
+        if decision.is_product == llm_result:
+            self.agreed += 1
+        else:
+            logger.info(f"[CLASSIFIER] Расхождение с LLM: локально={decision.is_product} "
+                        f"({decision.reason}, {decision.confidence:.2f}), LLM={llm_result}")
+        if self.compared % 50 == 0:
+            logger.info(f"[CLASSIFIER] Статистика: {self.stats()}")
+
+    def maybe_shadow_check(self, text: str, decision: Decision, llm_call: Callable[[str], Awaitable[bool]]) -> None:
+        """Для доли локально решённых сообщений в фоне спрашивает LLM, чтобы мерить согласие."""
+        if self.shadow_rate <= 0 or random.random() >= self.shadow_rate:
+            return
+
+        async def _check():
+            try:
+                self.record(decision, await llm_call(text))
+            except Exception as e:
+                logger.warning(f"[CLASSIFIER] Теневая проверка не удалась: {e}")
+
+        asyncio.create_task(_check())
+
+    def stats(self) -> dict:
+        total = self.decided_locally + self.sent_to_llm
+        return {
+            "decided_locally": self.decided_locally,
+            "sent_to_llm": self.sent_to_llm,
+            "local_rate": round(self.decided_locally / total, 3) if total else 0.0,
+            "compared": self.compared,
+            "agreement": round(self.agreed / self.compared, 3) if self.compared else None,
+        }
+
+
+async def classify_with_fallback(classifier: QueryClassifier, text: str,
+                                 llm_call: Callable[[str], Awaitable[bool]],
+                                 shadow_call: Optional[Callable[[str], Awaitable[bool]]] = None) -> tuple:
+    """
+    Сначала локальный классификатор; если он не уверен — LLM.
+    Возвращает (is_product, decision) — decision нужен вызывающему коду, чтобы знать, кто решил.
+    shadow_call — вызов LLM для теневых проверок (например, с фоновым приоритетом); по умолчанию llm_call.
+    """
+    decision = classifier.classify(text)
+    if classifier.is_confident(decision):
+        classifier.decided_locally += 1
+        logger.info(f"[CLASSIFIER] ⚡ Локально: {decision.is_product} ({decision.reason}, {decision.confidence:.2f})")
+        classifier.maybe_shadow_check(text, decision, shadow_call or llm_call)
+        return decision.is_product, decision
+
+    classifier.sent_to_llm += 1
+    result = await llm_call(text)
+    classifier.record(decision, result)
+    return result, decision
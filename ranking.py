@@ -0,0 +1,110 @@
+# ranking.py
+# Этап ранжирования гибридного поиска (db.search_products).
+# Каждый ретривер даёт свой ранжированный список товаров; списки сливаются
+# взвешенным Reciprocal Rank Fusion, фрагменты одного товара схлопываются
+# в лучший, а хвост с низкой оценкой отрезается.
+
+import logging
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+RRF_K = 60  # Стандартная константа RRF: сглаживает разницу между соседними рангами
+
+# Вклад ретриверов: точное вхождение надёжнее семантики, ключевые слова — запасной источник
+DEFAULT_WEIGHTS = {"exact": 2.0, "chunks": 1.0, "keywords": 0.75}
+
+
+class Ranked(NamedTuple):
+    product_id: int
+    score: float                  # итоговая оценка RRF
+    source: str                   # ретривер с наибольшим вкладом
+    similarity: Optional[float]   # лучшая косинусная близость фрагмента (если товар найден векторным поиском)
+
+
+def ordered_ranks(ids: Iterable) -> List[Tuple[int, float]]:
+    """Упорядоченный список: ранги 1, 2, 3… в порядке выдачи, повторы пропускаются."""
+    ranks, seen = [], set()
+    for pid in ids:
+        if pid not in seen:
+            seen.add(pid)
+            ranks.append((pid, float(len(ranks) + 1)))
+    return ranks
+
+
+def tied_ranks(ids: Iterable) -> List[Tuple[int, float]]:
+    """Неупорядоченное множество (keyword-поиск): все получают средний ранг, порядок ничего не значит."""
+    ids = sorted(set(ids))
+    rank = (len(ids) + 1) / 2
+    return [(pid, rank) for pid in ids]
+
+
+def dedupe_chunks(chunks: list) -> Tuple[List[int], Dict[int, float], Dict[int, list]]:
+    """
+    Схлопывает фрагменты по товару.
+    Возвращает (ID товаров по убыванию лучшей близости, лучшая близость, фрагменты товара по убыванию близости).
+    """
+    by_product: Dict[int, list] = {}
+    for chunk in sorted(chunks, key=lambda c: c.get("similarity") or 0.0, reverse=True):
+        by_product.setdefault(chunk["product_id"], []).append(chunk)
+    best = {pid: items[0].get("similarity") or 0.0 for pid, items in by_product.items()}
+    return list(by_product), best, by_product
+
+
+def fuse(rankings: Dict[str, List[Tuple[int, float]]], weights: Dict[str, float] = None, k: int = RRF_K) -> Dict[int, tuple]:
+    """Взвешенный RRF: score = Σ w_r / (k + rank_r). Возвращает {product_id: (score, лучший ретривер)}."""
+    weights = weights or DEFAULT_WEIGHTS
+    scores: Dict[int, float] = {}
+    best_source: Dict[int, tuple] = {}
+    for name, ranks in rankings.items():
+        weight = weights.get(name, 1.0)
+        for pid, rank in ranks:
+            contribution = weight / (k + rank)
+            scores[pid] = scores.get(pid, 0.0) + contribution
+            if contribution > best_source.get(pid, (0.0, ""))[0]:
+                best_source[pid] = (contribution, name)
+    return {pid: (score, best_source[pid][1]) for pid, score in scores.items()}
+
+
+def rank_candidates(exact_ids: list, chunks: list, keyword_ids: Iterable,
+                    weights: Dict[str, float] = None, k: int = RRF_K,
+                    min_relative_score: float = 0.0, min_chunk_similarity: float = 0.0,
+                    max_results: Optional[int] = None, chunks_per_product: int = 2) -> Tuple[List[Ranked], list]:
+    """
+    Сливает результаты ретриверов и отрезает хвост:
+    - товар, найденный только векторным поиском, с близостью ниже min_chunk_similarity — шум;
+    - товар с оценкой ниже min_relative_score от лучшей — отбрасывается (лучший остаётся всегда);
+    - не больше max_results товаров.
+    Возвращает (ранжированные товары, фрагменты оставшихся товаров — не больше chunks_per_product на товар).
+    """
+    chunk_order, best_similarity, chunks_by_product = dedupe_chunks(chunks)
+    rankings = {
+        "exact": ordered_ranks(exact_ids),
+        "chunks": ordered_ranks(chunk_order),
+        "keywords": tied_ranks(keyword_ids),
+    }
+    fused = fuse(rankings, weights, k)
+    ranked = sorted(
+        (Ranked(pid, score, source, best_similarity.get(pid)) for pid, (score, source) in fused.items()),
+        key=lambda r: (-r.score, r.product_id),
+    )
+
+    exact_set, keyword_set = set(exact_ids), set(keyword_ids)
+    kept = []
+    for r in ranked:
+        chunk_only = r.product_id not in exact_set and r.product_id not in keyword_set
+        if chunk_only and (r.similarity or 0.0) < min_chunk_similarity:
+            continue
+        if kept and r.score < min_relative_score * kept[0].score:
+            continue
+        kept.append(r)
+    if max_results:
+        kept = kept[:max_results]
+    if len(kept) < len(ranked):
+        logger.info(f"[RANK] Отсечено {len(ranked) - len(kept)} из {len(ranked)} кандидатов по порогу")
+
+    kept_chunks = []
+    for r in kept:
+        kept_chunks.extend(chunks_by_product.get(r.product_id, [])[:chunks_per_product])
+    kept_chunks.sort(key=lambda c: c.get("similarity") or 0.0, reverse=True)
+    return kept, kept_chunks
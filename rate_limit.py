@@ -0,0 +1,126 @@
+# rate_limit.py
+# Асинхронный token bucket и повтор запросов с экспоненциальной задержкой.
+# Используется пакетными задачами (embeddings.py) и общим шлюзом к OpenAI (openai_gateway.py),
+# чтобы упираться в лимиты OpenAI / Supabase плавно, а не получать 429 пачками.
+# KeyedRateLimiter — token bucket на каждый ключ (пользователя) с ограниченной памятью,
+# для анти-спама в боте (throttling.py).
+
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable, Optional, Tuple, Type
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Ведро на capacity токенов, пополняется со скоростью rate токенов в секунду.
+    acquire(n) ждёт, пока в ведре не наберётся n токенов. Запросы крупнее
+    capacity не блокируются навсегда: ведро уходит в минус и следующие ждут дольше.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def per_minute(cls, limit: float) -> "TokenBucket":
+        """Лимиты OpenAI задаются в минуту (RPM / TPM); ведро на минутный объём."""
+        return cls(rate=limit / 60.0, capacity=limit)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        """Неблокирующая попытка: True, если токены списаны."""
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        # Лок держится на время ожидания: запросы обслуживаются по очереди (FIFO)
+        async with self._lock:
+            self._refill()
+            needed = min(tokens, self.capacity)
+            if self._tokens < needed:
+                await asyncio.sleep((needed - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= tokens
+
+
+class KeyedRateLimiter:
+    """
+    Token bucket на ключ: burst токенов, пополнение rate токенов в секунду.
+    Состояние ключа — кортеж (токены, время) в LRU-словаре примерно на maxsize ключей;
+    все операции O(1). Сверх maxsize вытесняется самый давно активный ключ, но только если
+    его ведро уже успело наполниться (простой не меньше burst / rate) — тогда вытеснение
+    не ослабляет лимит. Если таких нет, словарь временно растёт: его размер ограничен числом
+    ключей, активных за последние burst / rate секунд.
+    """
+
+    def __init__(self, rate: float, burst: float, maxsize: int = 100_000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.allowed = 0
+        self.throttled = 0
+        self.evicted = 0
+
+    def allow(self, key: Hashable, cost: float = 1.0, now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        state = self._buckets.pop(key, None)
+        tokens = self.burst if state is None else min(self.burst, state[0] + (now - state[1]) * self.rate)
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+            self.allowed += 1
+        else:
+            self.throttled += 1
+        # pop + вставка переносит ключ в конец LRU
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.maxsize:
+            oldest_tokens, oldest_at = next(iter(self._buckets.values()))
+            if oldest_tokens + (now - oldest_at) * self.rate < self.burst:
+                break  # Самый давний ключ ещё не восстановился — остальные тем более
+            self._buckets.popitem(last=False)
+            self.evicted += 1
+        return allowed
+
+    def stats(self) -> dict:
+        return {"keys": len(self._buckets), "allowed": self.allowed,
+                "throttled": self.throttled, "evicted": self.evicted}
+
+
+async def retry_async(call: Callable[[], Awaitable], what: str, attempts: int = 5,
+                      base_delay: float = 1.0, max_delay: float = 30.0,
+                      retry_on: Tuple[Type[BaseException], ...] = (Exception,),
+                      retry_after: Optional[Callable[[BaseException], Optional[float]]] = None):
+    """
+    Вызывает call() до attempts раз; между попытками — экспоненциальная задержка
+    с джиттером (base_delay * 2^n, не больше max_delay). Последняя ошибка пробрасывается.
+    retry_after(ошибка) — пауза, которую просит сервер (заголовок Retry-After у 429):
+    ждём не меньше неё, но тоже не дольше max_delay.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return await call()
+        except retry_on as e:
+            if attempt == attempts:
+                raise
+            delay = min(max_delay, base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+            hint = retry_after(e) if retry_after else None
+            if hint:
+                delay = min(max_delay, max(delay, hint))
+            logger.warning(f"[RETRY] {what}: попытка {attempt}/{attempts} не удалась ({e}), повтор через {delay:.1f} с")
+            await asyncio.sleep(delay)
@@ -0,0 +1,193 @@
+# reranker.py
+# Необязательный локальный реранкер (cross-encoder в ONNX) после RRF-ранжирования.
+# Оценивает пары (запрос, текст товара) одним батчем на CPU и переставляет top-N.
+# Работает офлайн: модель и токенизатор лежат локально (RERANKER_MODEL_PATH):
+#   <path>/model.onnx      — cross-encoder (например, квантованный mMiniLM / bge-reranker)
+#   <path>/tokenizer.json  — токенизатор HuggingFace
+# Нужны пакеты onnxruntime и tokenizers. Без них (или без модели) реранкер выключен.
+#
+#   python reranker.py --bench                 — добавленная задержка на запрос
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+PRODUCT_TEXT_CHARS = 600  # Длиннее cross-encoder всё равно обрежет по max_length токенов
+
+
+def product_text(product: dict) -> str:
+    parts = [product.get("name") or "", product.get("search_tags") or "", product.get("description") or ""]
+    return ". ".join(p.strip() for p in parts if p and p.strip())[:PRODUCT_TEXT_CHARS]
+
+
+class Reranker:
+    """
+    Ленивая загрузка модели при первом вызове. rerank() укладывается в бюджет
+    времени: не успели — возвращается исходный (RRF) порядок. Одновременно
+    выполняется не больше одного батча; пока модель занята, запрос не ждёт, а идёт без реранка.
+    """
+
+    def __init__(self, model_path: str, top_n: int = 10, budget_ms: float = 150,
+                 max_length: int = 256, threads: int = 2):
+        self.model_path = model_path
+        self.top_n = top_n
+        self.budget = budget_ms / 1000
+        self.max_length = max_length
+        self.threads = threads
+        self._session = None
+        self._tokenizer = None
+        self._input_names: List[str] = []
+        self._load_failed = False
+        self._load_lock = threading.Lock()
+        self._busy = threading.Lock()
+        self.applied = 0
+        self.fallbacks = 0
+
+    # ------------------------------------------------------------------
+    # ЗАГРУЗКА
+    # ------------------------------------------------------------------
+
+    def _load(self) -> bool:
+        if self._session is not None:
+            return True
+        if self._load_failed:
+            return False
+        with self._load_lock:
+            if self._session is not None:
+                return True
+            try:
+                import onnxruntime as ort
+                from tokenizers import Tokenizer
+            except ImportError:
+                logger.warning("[RERANK] Нет пакетов onnxruntime / tokenizers — реранкер выключен")
+                self._load_failed = True
+                return False
+            try:
+                started = time.perf_counter()
+                options = ort.SessionOptions()
+                options.intra_op_num_threads = self.threads
+                options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+                session = ort.InferenceSession(os.path.join(self.model_path, "model.onnx"), options,
+                                               providers=["CPUExecutionProvider"])
+                tokenizer = Tokenizer.from_file(os.path.join(self.model_path, "tokenizer.json"))
+                tokenizer.enable_truncation(max_length=self.max_length)
+                tokenizer.enable_padding()
+                self._input_names = [i.name for i in session.get_inputs()]
+                self._tokenizer = tokenizer
+                self._session = session
+                logger.info(f"[RERANK] Модель загружена за {(time.perf_counter() - started) * 1000:.0f} мс: {self.model_path}")
+                return True
+            except Exception as e:
+                logger.error(f"[RERANK] Не удалось загрузить модель {self.model_path}: {e}")
+                self._load_failed = True
+                return False
+
+    # ------------------------------------------------------------------
+    # ОЦЕНКА
+    # ------------------------------------------------------------------
+
+    def score(self, query: str, texts: List[str]) -> List[float]:
+        """Оценки релевантности пар (query, text) одним батчем. Синхронно, для пула потоков."""
+        import numpy as np
+
+        encodings = self._tokenizer.encode_batch([(query, text) for text in texts])
+        feeds = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+        logits = self._session.run(None, {name: feeds[name] for name in self._input_names if name in feeds})[0]
+        logits = np.asarray(logits, dtype=np.float32)
+        # [N, 1] — одна оценка; [N, 2] — классы (нерелевантно, релевантно)
+        return (logits[:, -1] if logits.ndim == 2 else logits).tolist()
+
+    def _score_exclusive(self, query: str, texts: List[str]) -> Optional[List[float]]:
+        if not self._busy.acquire(blocking=False):
+            return None
+        try:
+            return self.score(query, texts)
+        finally:
+            self._busy.release()
+
+    async def rerank(self, query: str, products: list) -> list:
+        """Переставляет первые top_n товаров по оценке модели; остальные идут следом без изменений."""
+        if len(products) < 2:
+            return products
+        # Первая загрузка модели — в пуле потоков, чтобы не блокировать event loop
+        if self._session is None and not await asyncio.to_thread(self._load):
+            return products
+        head, tail = products[:self.top_n], products[self.top_n:]
+        started = time.perf_counter()
+        try:
+            # Поток не прерывается по таймауту, но результат опоздавшего батча просто не используется
+            scores = await asyncio.wait_for(
+                asyncio.to_thread(self._score_exclusive, query, [product_text(p) for p in head]),
+                self.budget,
+            )
+        except asyncio.TimeoutError:
+            scores = None
+        except Exception as e:
+            logger.warning(f"[RERANK] Ошибка реранкера: {e}")
+            scores = None
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if scores is None:
+            self.fallbacks += 1
+            logger.info(f"[RERANK] ⏱ {elapsed_ms:.0f} мс — бюджет {self.budget * 1000:.0f} мс превышен "
+                        f"или модель занята, оставляем порядок RRF")
+            return products
+
+        self.applied += 1
+        order = sorted(range(len(head)), key=lambda i: scores[i], reverse=True)
+        for i in order:
+            head[i]["_rerank"] = round(scores[i], 4)
+        logger.info(f"[RERANK] ⏱ {elapsed_ms:.0f} мс, {len(head)} товаров, новый порядок: {[head[i]['id'] for i in order]}")
+        return [head[i] for i in order] + tail
+
+    def stats(self) -> dict:
+        return {"applied": self.applied, "fallbacks": self.fallbacks}
+
+
+def _bench(model_path: str, top_n: int, runs: int, max_length: int, threads: int) -> None:
+    """Добавленная задержка реранка на запрос на синтетических карточках типичной длины."""
+    reranker = Reranker(model_path, top_n=top_n, max_length=max_length, threads=threads)
+    if not reranker._load():
+        raise SystemExit("Модель не загружена, см. лог выше")
+
+    description = ("Натуральный продукт на основе растительных экстрактов. Подходит для ежедневного применения, "
+                   "мягко очищает и увлажняет. Состав: алоэ вера, экстракт ромашки, витамин E, глицерин. ") * 3
+    texts = [f"Товар {i}. уход, кожа, растительный. {description}"[:PRODUCT_TEXT_CHARS] for i in range(top_n)]
+    queries = ["шампунь от перхоти", "что есть для иммунитета", "крем для сухой кожи рук", "зубная паста без фтора"]
+
+    reranker.score(queries[0], texts)  # Прогрев
+    timings = []
+    for i in range(runs):
+        started = time.perf_counter()
+        reranker.score(queries[i % len(queries)], texts)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    print(f"Реранк {top_n} товаров (max_length={max_length}, потоков={threads}), {runs} запросов:")
+    print(f"  mean={sum(timings) / len(timings):.1f} мс  p50={timings[len(timings) // 2]:.1f} мс  "
+          f"p95={timings[min(len(timings) - 1, int(len(timings) * 0.95))]:.1f} мс  max={timings[-1]:.1f} мс")
+
+
+if __name__ == "__main__":
+    import argparse
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bench", action="store_true", help="Замерить добавленную задержку на запрос")
+    parser.add_argument("--model", default=os.getenv("RERANKER_MODEL_PATH", ""), help="Папка с model.onnx и tokenizer.json")
+    parser.add_argument("--top-n", type=int, default=10)
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--max-length", type=int, default=256)
+    parser.add_argument("--threads", type=int, default=2)
+    args = parser.parse_args()
+    if args.bench:
+        _bench(args.model, args.top_n, args.runs, args.max_length, args.threads)
+    else:
+        parser.print_help()
@@ -21,6 +21,7 @@ create table public.products (
   pv int,               -- "Personal Volume" или другие баллы
   search_tags text,     -- Сгенерированные LLM теги для улучшения поиска
   embedding vector(1536), -- Вектор для семантического поиска (модель text-embedding-3-small)
+  embedding_hash text,    -- Хэш (модель + текст), из которого посчитан embedding: пересчёт только при изменении
   created_at timestamptz default now()
 );
 
@@ -31,7 +32,9 @@ create table public.users (
   first_name text,
   last_name text,
   username text,
-  last_search_results jsonb,  -- Хранит JSON с последними найденными товарами для контекста
+  last_search_results jsonb,  -- Последние найденные товары для контекста: {"v": 2, "q": hash запроса, "items": [{"id", "s", "src"}]} (старый формат — список карточек — читается и переписывается)
+  history_summary text,          -- Краткое содержание старой части диалога (conversation_memory.py)
+  history_summary_upto bigint,   -- ID последнего сообщения, вошедшего в history_summary
   created_at timestamptz default now()
 );
 
@@ -52,6 +55,7 @@ create table public.catalog_chunks (
   product_id bigint references public.products(id) on delete cascade, -- Связь с конкретным товаром
   content text not null, -- Текст фрагмента
   embedding vector(1536), -- Вектор фрагмента
+  embedding_hash text,    -- Хэш (модель + текст фрагмента), из которого посчитан embedding
   created_at timestamptz default now()
 );
 
@@ -149,4 +153,70 @@ as $$
     SELECT bool_and(name ILIKE '%' || term || '%' OR search_tags ILIKE '%' || term || '%')
     FROM unnest(search_terms) as term
   );
-$$;
\ No newline at end of file
+$$;
+
+-- 9. Миграция для существующих баз: хэши содержимого эмбеддингов (embeddings.py)
+-- Строки без хэша при следующем backfill считаются новыми и пересчитываются один раз.
+alter table public.products add column if not exists embedding_hash text;
+alter table public.catalog_chunks add column if not exists embedding_hash text;
+
+-- 10. Версия (отпечаток) каталога для in-memory снимка (catalog_index.py)
+-- Меняется при любом изменении товаров или фрагментов, в т.ч. при пересчёте эмбеддингов
+-- (embedding_hash), — бот перезагружает снимок.
+create or replace function catalog_version()
+returns text
+language sql stable
+as $$
+  select md5(
+    coalesce((
+      select string_agg(
+        md5(p.id::text || coalesce(p.name, '') || coalesce(p.description, '') || coalesce(p.price::text, '')
+            || coalesce(p.images, '') || coalesce(p.pv::text, '') || coalesce(p.search_tags, '')
+            || coalesce(p.embedding_hash, '')),
+        ',' order by p.id)
+      from public.products as p
+    ), '')
+    || '|' ||
+    coalesce((
+      select md5(string_agg(cc.id::text || ':' || coalesce(cc.embedding_hash, ''), ',' order by cc.id))
+      from public.catalog_chunks as cc
+    ), '')
+  );
+$$;
+
+-- 11. Атомарная замена фрагментов товара (embeddings.py, шаг 3)
+-- p_chunks: [{"content": ..., "embedding": [...] | null, "embedding_hash": ...}, ...] в порядке следования.
+-- Если embedding не передан, вектор берётся из старого фрагмента с тем же embedding_hash
+-- (текст не изменился — пересчитывать эмбеддинг не нужно). Всё в одной транзакции.
+create or replace function replace_product_chunks(p_product_id bigint, p_chunks jsonb)
+returns int
+language plpgsql
+as $$
+declare
+  inserted int;
+begin
+  with old as (
+    delete from public.catalog_chunks
+    where product_id = p_product_id
+    returning embedding, embedding_hash
+  )
+  insert into public.catalog_chunks (product_id, content, embedding, embedding_hash)
+  select
+    p_product_id,
+    c.value->>'content',
+    coalesce(
+      case when jsonb_typeof(c.value->'embedding') = 'array' then (c.value->'embedding')::text::vector end,
+      (select o.embedding from old as o where o.embedding_hash = c.value->>'embedding_hash' limit 1)
+    ),
+    c.value->>'embedding_hash'
+  from jsonb_array_elements(coalesce(p_chunks, '[]'::jsonb)) with ordinality as c(value, ord)
+  order by c.ord;
+
+  get diagnostics inserted = row_count;
+  return inserted;
+end;
+$$;
+
+-- 12. Миграция для существующих баз: сжатая память диалога (conversation_memory.py)
+alter table public.users add column if not exists history_summary text;
+alter table public.users add column if not exists history_summary_upto bigint;
@@ -0,0 +1,179 @@
+# session_store.py
+# Сессии пользователей: последние найденные товары для пагинации (show_page_)
+# и карточек (product_). В памяти хранятся только ID товаров в порядке ранга,
+# сами карточки берутся из общего кэша (db.get_products_cached_async).
+# Supabase (users.last_search_results) — долговременный слой с отложенной записью.
+# При нескольких процессах-воркерах сессии дублируются в общее хранилище
+# (shared_state.py): его видят все процессы, и изменения не теряются при перезапуске
+# до отложенной записи в Supabase.
+
+import asyncio
+import hashlib
+import json
+import logging
+from typing import NamedTuple, Optional
+
+import db
+from cache import TTLCache, normalize_query_text
+from shared_state import SharedStore
+
+logger = logging.getLogger(__name__)
+
+SEARCH_RESULTS_VERSION = 2
+
+
+class SessionItem(NamedTuple):
+    id: int
+    score: Optional[float]   # similarity / итоговая оценка ранжирования (если есть)
+    source: str              # ретривер: exact / chunks / keywords / price / category / legacy
+
+
+class Session(NamedTuple):
+    items: tuple              # SessionItem в порядке ранга
+    query_hash: str
+
+
+_CLEARED = Session((), "")  # Пустая сессия (контекст очищен) — тоже валидное закэшированное состояние
+
+
+def query_hash(query: str) -> str:
+    return hashlib.sha1(normalize_query_text(query).encode("utf-8")).hexdigest()[:12] if query else ""
+
+
+def encode_search_results(session: Session) -> Optional[dict]:
+    """
+    Компактный формат users.last_search_results (v2) — только ID, оценки и источник:
+    {"v": 2, "q": "<hash запроса>", "items": [{"id": 12, "s": 0.83, "src": "chunks"}, ...]}
+    """
+    if not session.items:
+        return None
+    items = []
+    for item in session.items:
+        row = {"id": item.id, "src": item.source}
+        if item.score is not None:
+            row["s"] = round(item.score, 4)
+        items.append(row)
+    return {"v": SEARCH_RESULTS_VERSION, "q": session.query_hash, "items": items}
+
+
+def decode_search_results(raw) -> tuple:
+    """
+    Возвращает (Session, legacy_products).
+    Старый формат (список полных карточек) распознаётся автоматически: карточки
+    отдаются вторым элементом, чтобы положить их в кэш и переписать строку в v2.
+    """
+    if isinstance(raw, dict) and raw.get("v") == SEARCH_RESULTS_VERSION:
+        items = tuple(SessionItem(row["id"], row.get("s"), row.get("src", "")) for row in raw.get("items", []) if "id" in row)
+        return Session(items, raw.get("q", "")), []
+    if isinstance(raw, list):
+        products = [p for p in raw if isinstance(p, dict) and p.get("id") is not None]
+        items = tuple(SessionItem(p["id"], None, "legacy") for p in products)
+        return Session(items, ""), products
+    return _CLEARED, []
+
+
+def _session_from_products(products: list, query: str, default_source: str) -> Session:
+    items = tuple(
+        SessionItem(p["id"], p.get("_score"), p.get("_source") or default_source)
+        for p in products if p and p.get("id") is not None
+    )
+    return Session(items, query_hash(query))
+
+
+class SessionStore:
+    """
+    LRU + TTL по user_id → Session (ID товаров с оценками, индекс = ранг).
+    Запись в Supabase — write-behind: изменения копятся и сбрасываются фоновой
+    задачей раз в flush_interval секунд; несколько записей подряд схлопываются в одну.
+    shared — общее хранилище между памятью процесса и Supabase (None — только память).
+    """
+
+    def __init__(self, maxsize: int, ttl: float, flush_interval: float, shared: Optional[SharedStore] = None):
+        self._sessions = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self._dirty: dict = {}  # user_id -> Session (пустая — очистка)
+        self._flushing: dict = {}  # Изменения, которые сейчас записываются в Supabase
+        self.migrated = 0
+
+    async def _load(self, user_id: int) -> Session:
+        session = self._sessions.get(user_id)
+        if session is not None:
+            return session
+        # Вытеснена из памяти до отложенной записи (или запись не удалась) — свежее состояние здесь,
+        # а в общем хранилище и Supabase может быть предыдущее
+        session = self._dirty.get(user_id) or self._flushing.get(user_id)
+        if session is not None:
+            self._sessions.set(user_id, session)
+            return session
+        if self.shared is not None:
+            raw = await self.shared.get(f"session:{user_id}")
+            if raw is not None:
+                session, _ = decode_search_results(json.loads(raw))
+                self._sessions.set(user_id, session)
+                return session
+        # Промах (рестарт, вытеснение) — поднимаем из Supabase
+        session, legacy_products = decode_search_results(await db.get_last_products_async(user_id))
+        if legacy_products:
+            # Прозрачная миграция: карточки — в общий кэш, строку — переписать в компактном виде
+            db.remember_products(legacy_products)
+            self._dirty.setdefault(user_id, session)
+            self.migrated += 1
+        self._sessions.set(user_id, session)
+        return session
+
+    async def _remember(self, user_id: int, session: Session) -> None:
+        self._sessions.set(user_id, session)
+        self._dirty[user_id] = session
+        if self.shared is not None:
+            try:
+                await self.shared.set(f"session:{user_id}", json.dumps(encode_search_results(session)), self.ttl)
+            except Exception as e:
+                logger.error(f"[SESSION] Ошибка записи в общее хранилище для {user_id}: {e}")
+
+    async def get_products(self, user_id: int) -> list:
+        session = await self._load(user_id)
+        if not session.items:
+            return []
+        return await db.get_products_cached_async([item.id for item in session.items])
+
+    async def set_products(self, user_id: int, products: list, query: str = "", default_source: str = "search") -> None:
+        db.remember_products(products)
+        await self._remember(user_id, _session_from_products(products, query, default_source))
+
+    async def clear(self, user_id: int) -> None:
+        if self._sessions.get(user_id) == _CLEARED:
+            return  # Уже пусто — лишняя запись в БД не нужна
+        await self._remember(user_id, _CLEARED)
+
+    async def flush(self) -> None:
+        """Сбрасывает накопленные изменения в Supabase."""
+        if not self._dirty:
+            return
+        pending, self._dirty = self._dirty, {}
+        self._flushing = pending
+        try:
+            await self._write(pending)
+        finally:
+            self._flushing = {}
+
+    async def _write(self, pending: dict) -> None:
+        for user_id, session in pending.items():
+            try:
+                if session.items:
+                    await db.save_last_products_async(user_id, encode_search_results(session))
+                else:
+                    await db.clear_last_products_async(user_id)
+            except Exception as e:
+                logger.error(f"[SESSION] Ошибка отложенной записи для {user_id}: {e}")
+                # Не затираем более свежее изменение, если оно успело появиться
+                self._dirty.setdefault(user_id, session)
+
+    async def run_flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def stats(self) -> dict:
+        return {**self._sessions.stats(), "pending_writes": len(self._dirty), "migrated_legacy": self.migrated}
@@ -0,0 +1,152 @@
+# shared_state.py
+# Общее состояние бота (сессии пользователей) за одним интерфейсом — чтобы несколько
+# процессов-воркеров (multiworker.py) или реплик видели одно и то же.
+#   memory — словарь в памяти процесса (один процесс; поведение как раньше);
+#   sqlite — файл SQLite, общий для процессов на одной машине (STATE_SQLITE_PATH);
+#   redis  — Redis или совместимый сервер (STATE_REDIS_URL), нужен пакет redis.
+# Значения — строки, у каждой записи своё время жизни.
+
+import abc
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "greenleaf:"
+
+
+class SharedStore(abc.ABC):
+    """get / set — строковые значения с TTL (секунды)."""
+
+    shared = False  # True — состояние видят другие процессы
+
+    @abc.abstractmethod
+    async def get(self, key: str) -> Optional[str]:
+        ...
+
+    @abc.abstractmethod
+    async def set(self, key: str, value: str, ttl: float) -> None:
+        ...
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryStore(SharedStore):
+    """LRU-словарь с истечением записей; не больше maxsize ключей."""
+
+    def __init__(self, maxsize: int = 100_000):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, value)
+
+    def _live(self, key: str) -> Optional[str]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[0] < time.time():
+            del self._data[key]
+            return None
+        return item[1]
+
+    def _put(self, key: str, value: str, ttl: float) -> None:
+        self._data[key] = (time.time() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[str]:
+        return self._live(key)
+
+    async def set(self, key: str, value: str, ttl: float) -> None:
+        self._put(key, value, ttl)
+
+
+class SQLiteStore(SharedStore):
+    """
+    Таблица kv в общем файле; каждый процесс открывает своё соединение (WAL, busy_timeout).
+    Запросы выполняются в пуле потоков, чтобы не блокировать event loop.
+    """
+
+    shared = True
+    PURGE_EVERY = 1000  # Раз в столько записей удаляются просроченные ключи
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("pragma journal_mode=wal")
+        self._conn.execute("pragma synchronous=normal")
+        self._conn.execute(
+            "create table if not exists kv (key text primary key, value text not null, expires_at real not null)"
+        )
+        self._writes = 0
+
+    def _execute(self, sql: str, params: tuple) -> sqlite3.Cursor:
+        with self._lock:
+            return self._conn.execute(sql, params)
+
+    def _get(self, key: str) -> Optional[str]:
+        row = self._execute("select value from kv where key = ? and expires_at >= ?", (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def _set(self, key: str, value: str, ttl: float) -> None:
+        self._execute(
+            "insert into kv (key, value, expires_at) values (?, ?, ?) "
+            "on conflict(key) do update set value = excluded.value, expires_at = excluded.expires_at",
+            (key, value, time.time() + ttl),
+        )
+        self._maybe_purge()
+
+    def _maybe_purge(self) -> None:
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self._execute("delete from kv where expires_at < ?", (time.time(),))
+
+    async def get(self, key: str) -> Optional[str]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: str, ttl: float) -> None:
+        await asyncio.to_thread(self._set, key, value, ttl)
+
+    async def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class RedisStore(SharedStore):
+    """Redis (или совместимый: KeyDB, Valkey, Dragonfly) через redis.asyncio."""
+
+    shared = True
+
+    def __init__(self, url: str):
+        try:
+            import redis.asyncio as aioredis
+        except ImportError:
+            raise RuntimeError("Для STATE_BACKEND=redis нужен пакет redis: pip install redis")
+        self._redis = aioredis.from_url(url, decode_responses=True)
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self._redis.get(KEY_PREFIX + key)
+
+    async def set(self, key: str, value: str, ttl: float) -> None:
+        await self._redis.set(KEY_PREFIX + key, value, px=max(1, int(ttl * 1000)))
+
+    async def close(self) -> None:
+        await self._redis.aclose()
+
+
+def create_store(backend: str, sqlite_path: str = "", redis_url: str = "") -> SharedStore:
+    if backend == "sqlite":
+        logger.info(f"[STATE] Общее состояние: SQLite {sqlite_path}")
+        return SQLiteStore(sqlite_path)
+    if backend == "redis":
+        logger.info(f"[STATE] Общее состояние: Redis {redis_url.split('@')[-1]}")
+        return RedisStore(redis_url)
+    if backend != "memory":
+        raise ValueError(f"Неизвестный STATE_BACKEND: {backend} (memory / sqlite / redis)")
+    return MemoryStore()
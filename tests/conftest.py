@@ -0,0 +1,10 @@
+# Тесты импортируют модули бота из корня репозитория.
+# config.py падает без обязательных переменных окружения — для тестов хватает заглушек,
+# к внешним сервисам тесты не обращаются.
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for name in ("TELEGRAM_TOKEN", "SUPABASE_URL", "SUPABASE_KEY", "OPENAI_API_KEY"):
+    os.environ.setdefault(name, "test")
@@ -0,0 +1,225 @@
+# Тесты import_catalog.py: нормализация полей, план импорта и защита от массового удаления.
+# Внешние сервисы не нужны: файл — tests/data/catalog.csv, таблица — список словарей в памяти.
+
+import asyncio
+import json
+import os
+import sys
+import types
+
+import httpx
+import pytest
+
+import import_catalog
+from import_catalog import (
+    RowError, build_plan, download_export, import_catalog as run_import, iter_catalog_rows,
+    normalize_images, normalize_price, normalize_pv,
+)
+
+CATALOG_CSV = os.path.join(os.path.dirname(__file__), "data", "catalog.csv")
+
+
+def _images(*urls) -> str:
+    return json.dumps(list(urls), ensure_ascii=False)
+
+
+# Таблица products до импорта (в формате SupabaseCatalogStore.fetch_all)
+EXISTING = [
+    {"id": 1, "name": "Шампунь травяной", "description": "Мягкий шампунь для ежедневного ухода",
+     "price": 1990, "pv": 12, "images": _images("https://img.example/shampoo.jpg"), "search_tags": "шампунь"},
+    {"id": 2, "name": "Крем для рук", "description": "Питательный крем с маслом ши",
+     "price": 1400, "pv": 8, "images": _images("https://img.example/cream1.jpg", "https://img.example/cream2.jpg"),
+     "search_tags": "крем"},
+    {"id": 3, "name": "Чай женьшеневый", "description": "Старый рецепт",
+     "price": 2500, "pv": 15, "images": None, "search_tags": "чай"},
+    {"id": 4, "name": "Капсулы снятые с продажи", "description": None,
+     "price": 500, "pv": 2, "images": None, "search_tags": None},
+]
+
+
+class MemoryStore:
+    """Хранилище с интерфейсом SupabaseCatalogStore поверх списка в памяти."""
+
+    supports_embeddings = True
+
+    def __init__(self, rows):
+        self.rows = {row["id"]: dict(row) for row in rows}
+        self.next_id = max(self.rows, default=0) + 1
+
+    async def fetch_all(self):
+        return [dict(row) for _, row in sorted(self.rows.items())]
+
+    async def insert(self, rows):
+        ids = []
+        for row in rows:
+            self.rows[self.next_id] = {"id": self.next_id, **row}
+            ids.append(self.next_id)
+            self.next_id += 1
+        return ids
+
+    async def update(self, rows):
+        for row in rows:
+            self.rows[row["id"]].update(row)
+
+    async def delete(self, ids):
+        for product_id in ids:
+            del self.rows[product_id]
+
+
+# ------------------------------------------------------------------
+# НОРМАЛИЗАЦИЯ
+# ------------------------------------------------------------------
+
+@pytest.mark.parametrize("value, expected", [
+    ("1 990 ₸", 1990),
+    ("1990,50", 1990.5),
+    ("1,990.50", 1990.5),
+    (1990, 1990),
+    (12.5, 12.5),
+    ("", None),
+    (None, None),
+])
+def test_normalize_price(value, expected):
+    assert normalize_price(value) == expected
+
+
+@pytest.mark.parametrize("value", ["не указана", "-100"])
+def test_normalize_price_rejects_invalid(value):
+    with pytest.raises(RowError):
+        normalize_price(value)
+
+
+@pytest.mark.parametrize("value, expected", [("12", 12), ("7,6", 8), (3.2, 3), (" ", None), (None, None)])
+def test_normalize_pv(value, expected):
+    assert normalize_pv(value) == expected
+
+
+def test_normalize_pv_rejects_invalid():
+    with pytest.raises(RowError):
+        normalize_pv("много")
+
+
+def test_normalize_images():
+    raw = "https://img.example/a.jpg, https://img.example/b.jpg\nhttps://img.example/a.jpg"
+    assert json.loads(normalize_images(raw)) == ["https://img.example/a.jpg", "https://img.example/b.jpg"]
+    # JSON-массив из таблицы читается так же
+    assert normalize_images('["https://img.example/a.jpg"]') == _images("https://img.example/a.jpg")
+    assert normalize_images("нет фото") is None
+    assert normalize_images(None) is None
+
+
+# ------------------------------------------------------------------
+# ПЛАН ИМПОРТА
+# ------------------------------------------------------------------
+
+def test_build_plan():
+    plan = build_plan(iter_catalog_rows(CATALOG_CSV), EXISTING)
+
+    assert [row["name"] for row in plan.inserts] == ["Масло криля"]
+    assert plan.inserts[0]["price"] == 7900
+    updates = {row["id"]: row for row in plan.updates}
+    assert set(updates) == {2, 3}
+    # Изменилась только цена — теги сохраняются
+    assert updates[2]["price"] == 1490.5
+    assert updates[2]["search_tags"] == "крем"
+    # Изменилось описание — теги сбрасываются и генерируются заново
+    assert updates[3]["description"] == "Новый рецепт: женьшень и мята"
+    assert updates[3]["search_tags"] is None
+    assert plan.deletes == [4]
+    assert plan.summary() == {"insert": 1, "update": 2, "delete": 1, "unchanged": 1,
+                              "errors": 2, "duplicates": 1}
+
+
+def test_build_plan_deletes_duplicate_names_in_table():
+    existing = EXISTING[:1] + [dict(EXISTING[0], id=10, name="  шампунь ТРАВЯНОЙ")]
+    rows = [(2, {"name": "Шампунь травяной", "description": "Мягкий шампунь для ежедневного ухода",
+                 "price": "1990", "pv": "12", "images": "https://img.example/shampoo.jpg"})]
+    plan = build_plan(iter(rows), existing)
+    assert plan.deletes == [10]
+    assert plan.unchanged == 1
+
+
+# ------------------------------------------------------------------
+# ПРИМЕНЕНИЕ
+# ------------------------------------------------------------------
+
+def test_import_refuses_to_delete_most_of_catalog(tmp_path):
+    path = tmp_path / "truncated.csv"
+    path.write_text("name,price\nШампунь травяной,1990\n", encoding="utf-8")
+    store = MemoryStore(EXISTING)
+
+    with pytest.raises(RuntimeError, match="удалил бы 3 из 4"):
+        asyncio.run(run_import(str(path), store, embed=False))
+    assert len(store.rows) == 4
+
+    # Без удаления (или с большим порогом) тот же файл применяется
+    summary = asyncio.run(run_import(str(path), store, allow_delete=False, embed=False))
+    assert summary["delete"] == 3
+    assert len(store.rows) == 4
+
+
+def test_import_applies_plan(monkeypatch):
+    calls = []
+
+    async def backfill(product_ids):
+        calls.append(product_ids)
+        return {"embedded": len(product_ids)}
+
+    monkeypatch.setitem(sys.modules, "embeddings",
+                        types.SimpleNamespace(backfill_product_embeddings_async=backfill))
+    store = MemoryStore(EXISTING)
+
+    assert asyncio.run(run_import(CATALOG_CSV, store, dry_run=True))["insert"] == 1
+    assert store.rows[3]["description"] == "Старый рецепт"
+
+    summary = asyncio.run(run_import(CATALOG_CSV, store))
+    assert summary["queued_for_embedding"] == 3
+    assert summary["embeddings"] == {"embedded": 3}
+    assert 4 not in store.rows
+    assert store.rows[3]["search_tags"] is None
+    assert sorted(calls[0]) == [2, 3, 5]
+
+
+def test_import_queues_embeddings_in_batches(monkeypatch):
+    calls = []
+
+    async def backfill(product_ids):
+        calls.append(len(product_ids))
+        return {"embedded": len(product_ids)}
+
+    monkeypatch.setitem(sys.modules, "embeddings",
+                        types.SimpleNamespace(backfill_product_embeddings_async=backfill))
+    total = import_catalog.WRITE_BATCH_SIZE * 2 + 1
+    plan = build_plan(((i, {"name": f"Товар {i}", "price": "100"}) for i in range(total)), [])
+    monkeypatch.setattr(import_catalog, "build_plan", lambda rows, existing: plan)
+    monkeypatch.setattr(import_catalog, "iter_catalog_rows", lambda path: iter(()))
+
+    summary = asyncio.run(run_import("unused.csv", MemoryStore([])))
+    assert calls == [import_catalog.WRITE_BATCH_SIZE, import_catalog.WRITE_BATCH_SIZE, 1]
+    assert summary["embeddings"] == {"embedded": total}
+
+
+# ------------------------------------------------------------------
+# СКАЧИВАНИЕ ВЫГРУЗКИ
+# ------------------------------------------------------------------
+
+def _serve(monkeypatch, content_type: str, body: bytes):
+    transport = httpx.MockTransport(lambda request: httpx.Response(
+        200, headers={"content-type": content_type}, content=body))
+    monkeypatch.setattr(import_catalog.httpx, "stream", httpx.Client(transport=transport).stream)
+
+
+def test_download_export_csv(monkeypatch):
+    _serve(monkeypatch, "text/csv; charset=utf-8", "name,price\nЧай,100\n".encode("utf-8"))
+    path = download_export("https://docs.google.com/spreadsheets/d/abc123/edit#gid=0")
+    try:
+        assert path.endswith(".csv")
+        assert [raw["name"] for _, raw in iter_catalog_rows(path)] == ["Чай"]
+    finally:
+        os.remove(path)
+
+
+def test_download_export_rejects_html(monkeypatch):
+    _serve(monkeypatch, "text/html; charset=utf-8", b"<html>Google Drive can't scan this file for viruses</html>")
+    with pytest.raises(RuntimeError, match="text/html"):
+        download_export("https://drive.google.com/file/d/abc123/view")
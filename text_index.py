@@ -0,0 +1,116 @@
+# text_index.py
+# Локальный n-граммный инвертированный индекс по name / search_tags / description.
+# Заменяет последовательные сканы ILIKE '%…%' в Postgres для точного
+# и keyword-поиска (search_products_by_exact_match, keyword_search_products).
+
+import logging
+from typing import Iterable
+
+logger = logging.getLogger(__name__)
+
+NGRAM = 3
+FIELDS = ("name", "search_tags", "description")
+KEYWORD_FIELDS = ("name", "search_tags")  # keyword_search_products смотрит только сюда
+EXACT_MATCH_FIELDS = ("id", "name", "price", "description", "search_tags")
+
+
+def _ngrams(text: str) -> set:
+    return {text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+
+class TextIndex:
+    """
+    Инвертированный индекс триграмм → множество ID товаров.
+    Семантика совпадает с ILIKE '%term%': индекс даёт кандидатов,
+    затем вхождение проверяется по нижнему регистру поля. Термы короче
+    триграммы проверяются прямым перебором (таких запросов мало).
+    Обновляется инкрементально: upsert()/remove() трогают только один товар.
+    """
+
+    def __init__(self):
+        self._postings: dict = {}   # ngram -> set(product_id)
+        self._fields: dict = {}     # product_id -> {field: lowercased text}
+        self._grams: dict = {}      # product_id -> set(ngram), чтобы быстро удалять
+        self._products: dict = {}   # product_id -> исходная строка товара
+
+    def __len__(self) -> int:
+        return len(self._products)
+
+    # ------------------------------------------------------------------
+    # ОБНОВЛЕНИЕ
+    # ------------------------------------------------------------------
+
+    def upsert(self, product: dict) -> None:
+        pid = product["id"]
+        fields = {f: str(product.get(f) or "").lower() for f in FIELDS}
+        if self._fields.get(pid) == fields:
+            self._products[pid] = product
+            return
+
+        self.remove(pid)
+        grams = set()
+        for text in fields.values():
+            grams |= _ngrams(text)
+        for gram in grams:
+            self._postings.setdefault(gram, set()).add(pid)
+        self._fields[pid] = fields
+        self._grams[pid] = grams
+        self._products[pid] = product
+
+    def remove(self, pid) -> None:
+        for gram in self._grams.pop(pid, ()):
+            ids = self._postings.get(gram)
+            if ids is not None:
+                ids.discard(pid)
+                if not ids:
+                    del self._postings[gram]
+        self._fields.pop(pid, None)
+        self._products.pop(pid, None)
+
+    def sync(self, products: dict) -> dict:
+        """Приводит индекс к словарю {id: product}, переиндексируя только изменённые товары."""
+        removed = [pid for pid in self._products if pid not in products]
+        for pid in removed:
+            self.remove(pid)
+        for product in products.values():
+            self.upsert(product)
+        stats = {"total": len(self._products), "removed": len(removed), "ngrams": len(self._postings)}
+        logger.info(f"[TEXT_INDEX] Индекс синхронизирован: {stats}")
+        return stats
+
+    # ------------------------------------------------------------------
+    # ЗАПРОСЫ
+    # ------------------------------------------------------------------
+
+    def _candidates(self, term: str) -> Iterable:
+        if len(term) < NGRAM:
+            return self._fields.keys()
+        postings = []
+        for gram in _ngrams(term):
+            ids = self._postings.get(gram)
+            if not ids:
+                return ()
+            postings.append(ids)
+        postings.sort(key=len)
+        return set.intersection(*postings)
+
+    def _matches(self, pid, term: str, fields: tuple) -> bool:
+        indexed = self._fields[pid]
+        return any(term in indexed[f] for f in fields)
+
+    def exact_match(self, phrase: str, limit: int = 10) -> list:
+        """Аналог `name|search_tags|description ILIKE '%phrase%'`. Формат строк — как у точного поиска в db.py."""
+        phrase = phrase.lower()
+        ids = sorted(pid for pid in self._candidates(phrase) if self._matches(pid, phrase, FIELDS))
+        return [{f: self._products[pid].get(f) for f in EXACT_MATCH_FIELDS} for pid in ids[:limit]]
+
+    def all_terms(self, terms: list) -> list:
+        """Аналог RPC keyword_search_products: КАЖДЫЙ терм входит в name или search_tags."""
+        terms = [t.lower() for t in terms if t]
+        if not terms:
+            return []
+        # Начинаем с самого селективного терма (длинные термы дают меньше кандидатов)
+        terms.sort(key=len, reverse=True)
+        ids = [pid for pid in self._candidates(terms[0])
+               if all(self._matches(pid, t, KEYWORD_FIELDS) for t in terms)]
+        return [dict(self._products[pid]) for pid in sorted(ids)]
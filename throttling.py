@@ -0,0 +1,45 @@
+# throttling.py
+# Анти-спам как outer-middleware aiogram: проверяется до фильтров и хендлеров,
+# поэтому покрывает и сообщения, и нажатия кнопок (callback_query).
+# Лимит — token bucket на пользователя (rate_limit.KeyedRateLimiter): можно прислать
+# несколько сообщений подряд (burst), дальше — не чаще refill в секунду.
+# Состояние в памяти процесса: при нескольких воркерах (multiworker.py) все обновления
+# пользователя приходят в один процесс, так что лимит остаётся точным.
+
+import logging
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, TelegramObject
+
+from rate_limit import KeyedRateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Обновление сверх лимита до хендлера не доходит: сообщение молча пропускается,
+    на callback отвечаем без текста, чтобы у кнопки пропали «часики».
+    kind — отдельный счётчик и отдельное ведро ("message" / "callback").
+    """
+
+    def __init__(self, limiter: KeyedRateLimiter, kind: str):
+        self.limiter = limiter
+        self.kind = kind
+        self.throttled = 0
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        user = data.get("event_from_user")
+        if user is None or self.limiter.allow((self.kind, user.id)):
+            return await handler(event, data)
+
+        self.throttled += 1
+        logger.info(f"[THROTTLE] {self.kind} от {user.id} пропущен: превышен лимит")
+        if isinstance(event, CallbackQuery):
+            try:
+                await event.answer()
+            except Exception as e:
+                logger.info(f"[THROTTLE] Не удалось ответить на callback: {e}")
+        return None
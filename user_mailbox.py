@@ -0,0 +1,137 @@
+# user_mailbox.py
+# Почтовый ящик пользователя для on_text: одновременно выполняется не больше
+# одного конвейера (классификация → поиск → ответ) на пользователя.
+# - Сообщения, пришедшие во время обработки, копятся и уходят следующим ходом
+#   одним объединённым запросом.
+# - Если ход ещё не начал отвечать (до Turn.commit()), новое сообщение делает его
+#   устаревшим: ход отменяется, и его сообщения объединяются с новыми.
+# - После commit() ход доводится до конца — пользователь уже видит ответ.
+# - Ход, отменённый не ящиком (а, например, общим кодом, который он вызывал), не считается
+#   устаревшим: это ошибка, пользователь получает обычный ответ on_failure.
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Turn:
+    """Один ход диалога: одно или несколько подряд идущих сообщений пользователя."""
+
+    def __init__(self, user_id: int, messages: list, saved: int = 0):
+        self.user_id = user_id
+        self.messages = messages
+        self.saved = saved          # Сколько первых сообщений уже сохранено в истории (отменённым ходом)
+        self.committed = False
+
+    @property
+    def message(self):
+        """Последнее сообщение — на него отвечаем."""
+        return self.messages[-1]
+
+    @property
+    def texts(self) -> List[str]:
+        return [t for t in ((m.text or "").strip() for m in self.messages) if t]
+
+    @property
+    def text(self) -> str:
+        return "\n".join(self.texts)
+
+    def commit(self) -> None:
+        """С этого момента ход не отменяется (начинается ответ пользователю)."""
+        self.committed = True
+
+
+class _Slot:
+    def __init__(self):
+        self.pending: list = []
+        self.carry: list = []       # Сообщения отменённого хода
+        self.carry_saved = 0
+        self.turn: Turn = None
+        self.current: asyncio.Task = None
+        self.superseded = False     # Текущий ход отменил сам ящик (пришло новое сообщение)
+        self.runner: asyncio.Task = None
+
+
+class UserMailbox:
+    """
+    submit(user_id, message) не ждёт обработки: ход выполняется фоновой задачей,
+    поэтому обработчик обновлений сразу свободен для следующих сообщений.
+    on_failure(turn) — ответ пользователю, если ход отменили не из-за нового сообщения.
+    """
+
+    def __init__(self, handler: Callable[[Turn], Awaitable[None]],
+                 on_failure: Optional[Callable[[Turn], Awaitable[None]]] = None):
+        self.handler = handler
+        self.on_failure = on_failure
+        self._slots: Dict[int, _Slot] = {}
+        self.turns = 0
+        self.merged = 0
+        self.cancelled = 0
+        self.failed = 0
+
+    def submit(self, user_id: int, message) -> None:
+        slot = self._slots.get(user_id)
+        if slot is None:
+            slot = self._slots[user_id] = _Slot()
+        slot.pending.append(message)
+        if slot.runner is None:
+            slot.runner = asyncio.create_task(self._run(user_id, slot))
+        elif slot.current is not None and not slot.turn.committed and not slot.current.done():
+            # Ответ ещё не начат — новое сообщение делает ход устаревшим
+            slot.superseded = True
+            slot.current.cancel()
+
+    async def _run(self, user_id: int, slot: _Slot) -> None:
+        try:
+            while slot.pending:
+                messages = slot.carry + slot.pending
+                turn = Turn(user_id, messages, saved=slot.carry_saved)
+                slot.pending, slot.carry, slot.carry_saved = [], [], 0
+                if len(messages) > 1:
+                    self.merged += len(messages) - 1
+                slot.turn, slot.superseded = turn, False
+                slot.current = asyncio.create_task(self.handler(turn))
+                # wait() не пробрасывает отмену вложенной задачи — отличаем её от остановки самого ящика
+                await asyncio.wait({slot.current})
+                if slot.current.cancelled() and slot.superseded:
+                    self.cancelled += 1
+                    slot.carry, slot.carry_saved = messages, turn.saved
+                    logger.info(f"[MAILBOX] Ход пользователя {user_id} отменён: пришло новое сообщение")
+                    continue
+                self.turns += 1
+                if slot.current.cancelled():
+                    self.failed += 1
+                    logger.error(f"[MAILBOX] Ход пользователя {user_id} отменён не почтовым ящиком")
+                    await self._fail(turn)
+                    continue
+                if slot.current.exception() is not None:
+                    self.failed += 1
+                    logger.error(f"[MAILBOX] Ошибка хода пользователя {user_id}: {slot.current.exception()}")
+        finally:
+            if slot.current is not None and not slot.current.done():
+                slot.current.cancel()
+            self._slots.pop(user_id, None)
+
+    async def _fail(self, turn: Turn) -> None:
+        if self.on_failure is None:
+            return
+        try:
+            await self.on_failure(turn)
+        except Exception as e:
+            logger.error(f"[MAILBOX] Не удалось ответить пользователю {turn.user_id} после сбоя: {e}")
+
+    async def close(self, timeout: float) -> None:
+        """Дожидается текущих ходов (не дольше timeout), остальные отменяет."""
+        runners = [slot.runner for slot in self._slots.values() if slot.runner is not None]
+        if not runners:
+            return
+        done, pending = await asyncio.wait(runners, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {"active": len(self._slots), "turns": self.turns, "merged": self.merged,
+                "cancelled": self.cancelled, "failed": self.failed}
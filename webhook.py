@@ -0,0 +1,215 @@
+# webhook.py
+# Режим webhook (BOT_MODE=webhook) вместо long polling.
+# aiohttp-сервер принимает POST от Telegram, сверяет секретный токен
+# (заголовок X-Telegram-Bot-Api-Secret-Token) и сразу отвечает 200, а обработку
+# отдаёт ограниченному пулу воркеров в том же процессе:
+# - пул разбит на шарды по пользователю: обновления одного пользователя идут
+#   в одну очередь и обрабатываются строго по порядку, разные — параллельно;
+# - очереди ограничены: если шард переполнен, сервер отвечает 503 и Telegram
+#   повторит доставку позже (backpressure вместо неограниченного роста памяти).
+# Нагрузочный тест: python webhook_loadtest.py --help
+
+import asyncio
+import hmac
+import logging
+import signal
+import time
+from typing import Any, Awaitable, Callable, Hashable, List, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+DRAIN_TIMEOUT = 30  # Сколько ждать обработки принятых обновлений при остановке, секунды
+
+
+def update_user_key(data: dict) -> Hashable:
+    """Ключ упорядочивания: ID пользователя (или чата) из любого типа обновления, иначе update_id."""
+    for field, event in data.items():
+        if field == "update_id" or not isinstance(event, dict):
+            continue
+        sender = event.get("from") or event.get("user") or {}
+        if sender.get("id") is not None:
+            return sender["id"]
+        chat = event.get("chat") or (event.get("message") or {}).get("chat") or {}
+        if chat.get("id") is not None:
+            return chat["id"]
+    return data.get("update_id")
+
+
+class ShardedWorkerPool:
+    """
+    workers шардов, в каждом — своя очередь (до queue_size / workers элементов) и один воркер.
+    submit(key, item) — неблокирующая постановка: False, если очередь шарда заполнена.
+    shard(key) — число, остаток от деления которого на workers даёт шард (по умолчанию hash).
+    """
+
+    def __init__(self, handle: Callable[[Any], Awaitable[None]], workers: int, queue_size: int,
+                 shard: Callable[[Hashable], int] = hash):
+        self.handle = handle
+        self.workers = max(1, workers)
+        self._shard_key = shard
+        shard_size = max(1, queue_size // self.workers)
+        self._queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=shard_size) for _ in range(self.workers)]
+        self._tasks: List[asyncio.Task] = []
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker(q)) for q in self._queues]
+
+    def shard_of(self, key: Hashable) -> int:
+        return self._shard_key(key) % self.workers
+
+    def submit(self, key: Hashable, item: Any) -> bool:
+        try:
+            self._queues[self.shard_of(key)].put_nowait((time.perf_counter(), item))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.accepted += 1
+        return True
+
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        while True:
+            enqueued_at, item = await queue.get()
+            try:
+                await self.handle(item)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"[WEBHOOK] Ошибка обработки обновления: {e}")
+            finally:
+                latency = time.perf_counter() - enqueued_at
+                self._latency_total += latency
+                self._latency_max = max(self._latency_max, latency)
+                queue.task_done()
+
+    async def drain(self, timeout: float) -> None:
+        """Дожидается обработки уже принятых обновлений (не дольше timeout) и останавливает воркеров."""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"[WEBHOOK] За {timeout} с не обработано {self.queued()} обновлений")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def queued(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self) -> dict:
+        done = self.processed + self.failed
+        return {
+            "workers": self.workers,
+            "queued": self.queued(),
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "failed": self.failed,
+            "avg_latency_ms": round(self._latency_total / done * 1000, 1) if done else 0.0,
+            "max_latency_ms": round(self._latency_max * 1000, 1),
+        }
+
+
+def create_app(pool: ShardedWorkerPool, parse: Callable[[dict], Tuple[Hashable, Any]],
+               secret: str, path: str) -> web.Application:
+    """
+    POST path — приём обновления: 401 при неверном токене, 400 при битом JSON,
+    503 при переполненной очереди, иначе 200 сразу после постановки в очередь.
+    GET /healthz — статистика пула.
+    """
+
+    async def handle_update(request: web.Request) -> web.Response:
+        if secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+            return web.Response(status=401)
+        try:
+            key, item = parse(await request.json())
+        except Exception as e:
+            logger.warning(f"[WEBHOOK] Некорректное обновление: {e}")
+            return web.Response(status=400)
+        if not pool.submit(key, item):
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        return web.Response(status=200)
+
+    async def health(_request: web.Request) -> web.Response:
+        return web.json_response(pool.stats())
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    app.router.add_get("/healthz", health)
+    return app
+
+
+async def serve(app: web.Application, host: str, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"[WEBHOOK] Сервер слушает {host}:{port}")
+    return runner
+
+
+def install_stop_signals(stop: asyncio.Event) -> None:
+    """SIGINT / SIGTERM выставляют stop — для корректной остановки (в т.ч. docker stop)."""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows: остановка по Ctrl+C через KeyboardInterrupt
+
+
+async def run_webhook(bot, dp, router=None) -> None:
+    """
+    Запуск бота в режиме webhook: сервер + пул воркеров, регистрация webhook в Telegram.
+    router (multiworker.ProcessRouter) — обновления уходят процессам-воркерам в сыром виде,
+    без него обрабатываются локальным пулом в этом процессе.
+    """
+    # config проверяет переменные окружения при импорте — нагрузочному тесту они не нужны
+    import config
+    from aiogram.types import Update
+
+    if router is None:
+        pool = ShardedWorkerPool(lambda update: dp.feed_update(bot, update),
+                                 config.WEBHOOK_WORKERS, config.WEBHOOK_QUEUE_SIZE)
+
+        def parse(data: dict) -> Tuple[Hashable, Any]:
+            return update_user_key(data), Update.model_validate(data, context={"bot": bot})
+    else:
+        pool = router
+
+        def parse(data: dict) -> Tuple[Hashable, Any]:
+            Update.model_validate(data)  # Битое обновление отклоняем здесь (400), а не в воркере
+            return update_user_key(data), data
+
+    app = create_app(pool, parse, config.WEBHOOK_SECRET, config.WEBHOOK_PATH)
+    if router is None:
+        pool.start()
+    runner = await serve(app, config.WEBHOOK_HOST, config.WEBHOOK_PORT)
+
+    stop = asyncio.Event()
+    install_stop_signals(stop)
+
+    url = config.WEBHOOK_URL.rstrip("/") + config.WEBHOOK_PATH
+    await bot.set_webhook(
+        url=url,
+        secret_token=config.WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+    )
+    print(f"🚀 [BOT] Webhook зарегистрирован: {url}")
+    try:
+        await stop.wait()
+    finally:
+        # Webhook в Telegram не снимаем: при перезапуске недоставленные обновления придут повторно
+        await runner.cleanup()
+        if router is None:
+            await pool.drain(DRAIN_TIMEOUT)
+        logger.info(f"[WEBHOOK] Итоговая статистика: {pool.stats()}")
@@ -0,0 +1,138 @@
+# webhook_loadtest.py
+# Нагрузочный тест приёма обновлений в режиме webhook (webhook.py).
+# Шлёт синтетические обновления Telegram (текстовые сообщения от --users пользователей)
+# и меряет пропускную способность (обновлений/с), задержку ответа сервера и долю 503.
+#
+#   python webhook_loadtest.py --local                        — поднять пул с заглушкой-обработчиком
+#                                                                в этом же процессе (без Telegram и OpenAI)
+#   python webhook_loadtest.py --url http://127.0.0.1:8080/telegram/webhook --secret <WEBHOOK_SECRET>
+#                                                              — запущенный бот (BOT_MODE=webhook)
+#
+# В режиме --local дополнительно меряется задержка до конца обработки и проверяется,
+# что обновления каждого пользователя обработаны строго по порядку.
+
+import argparse
+import asyncio
+import random
+import time
+
+import aiohttp
+
+from webhook import SECRET_HEADER, ShardedWorkerPool, create_app, serve, update_user_key
+
+
+def synthetic_update(update_id: int, user_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"Load{user_id}"},
+            "chat": {"id": user_id, "type": "private"},
+            "text": random.choice(["чай для похудения", "шампунь от выпадения", "что есть для иммунитета"]),
+        },
+    }
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def post_updates(url: str, secret: str, total: int, users: int, concurrency: int) -> dict:
+    """Шлёт total обновлений с concurrency одновременными запросами. Обновления одного пользователя — по порядку."""
+    latencies, statuses = [], {}
+    queue: asyncio.Queue = asyncio.Queue()
+    for update_id in range(1, total + 1):
+        queue.put_nowait(update_id)
+    headers = {SECRET_HEADER: secret} if secret else {}
+
+    async def sender(session: aiohttp.ClientSession):
+        while not queue.empty():
+            update_id = queue.get_nowait()
+            started = time.perf_counter()
+            async with session.post(url, json=synthetic_update(update_id, update_id % users), headers=headers) as resp:
+                await resp.read()
+                statuses[resp.status] = statuses.get(resp.status, 0) + 1
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(sender(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return {"elapsed": elapsed, "latencies": latencies, "statuses": statuses}
+
+
+def report(title: str, total: int, result: dict) -> None:
+    latencies = result["latencies"]
+    print(f"{title}: {total} обновлений за {result['elapsed']:.2f} с — {total / result['elapsed']:.0f} обновлений/с")
+    print(f"  ответ сервера: p50={percentile(latencies, 0.5):.1f} мс  p95={percentile(latencies, 0.95):.1f} мс  "
+          f"p99={percentile(latencies, 0.99):.1f} мс  max={max(latencies, default=0):.1f} мс")
+    print(f"  статусы: {dict(sorted(result['statuses'].items()))}")
+
+
+async def run_local(args) -> None:
+    """Пул с заглушкой вместо dp.feed_update: обработка занимает --handler-ms."""
+    processed_at, order_violations, last_seen = {}, 0, {}
+
+    async def handle(data: dict) -> None:
+        nonlocal order_violations
+        await asyncio.sleep(args.handler_ms / 1000)
+        user_id, update_id = update_user_key(data), data["update_id"]
+        if update_id < last_seen.get(user_id, 0):
+            order_violations += 1
+        last_seen[user_id] = update_id
+        processed_at[update_id] = time.perf_counter()
+
+    pool = ShardedWorkerPool(handle, args.workers, args.queue_size)
+    submitted_at = {}
+
+    def parse(data: dict):
+        submitted_at[data["update_id"]] = time.perf_counter()
+        return update_user_key(data), data
+
+    app = create_app(pool, parse, args.secret, "/webhook")
+    pool.start()
+    runner = await serve(app, "127.0.0.1", args.port)
+    try:
+        result = await post_updates(f"http://127.0.0.1:{args.port}/webhook", args.secret,
+                                    args.updates, args.users, args.concurrency)
+        await pool.drain(timeout=60)
+    finally:
+        await runner.cleanup()
+
+    report(f"Локальный пул ({args.workers} воркеров, очередь {args.queue_size}, обработка {args.handler_ms} мс)",
+           args.updates, result)
+    end_to_end = [(processed_at[u] - submitted_at[u]) * 1000 for u in processed_at]
+    print(f"  до конца обработки: p50={percentile(end_to_end, 0.5):.1f} мс  p95={percentile(end_to_end, 0.95):.1f} мс  "
+          f"max={max(end_to_end, default=0):.1f} мс")
+    print(f"  пул: {pool.stats()}, нарушений порядка по пользователю: {order_violations}")
+
+
+async def run_remote(args) -> None:
+    result = await post_updates(args.url, args.secret, args.updates, args.users, args.concurrency)
+    report(f"Сервер {args.url}", args.updates, result)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный тест webhook-приёма обновлений")
+    parser.add_argument("--local", action="store_true", help="Поднять пул с заглушкой-обработчиком в этом процессе")
+    parser.add_argument("--url", default="", help="Адрес webhook запущенного бота")
+    parser.add_argument("--secret", default="loadtest", help="Секретный токен (WEBHOOK_SECRET)")
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=40, help="Одновременных запросов (как max_connections Telegram)")
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--queue-size", type=int, default=2000)
+    parser.add_argument("--handler-ms", type=float, default=20, help="Длительность обработки в заглушке (--local)")
+    parser.add_argument("--port", type=int, default=8099)
+    args = parser.parse_args()
+    if args.local:
+        asyncio.run(run_local(args))
+    elif args.url:
+        asyncio.run(run_remote(args))
+    else:
+        parser.print_help()